@@ -3,7 +3,8 @@ from django.db import models
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
-from markupfield.fields import MarkupField
+
+from django_comments_tree.fields import CommentMarkupField
 
 COMMENT_MAX_LENGTH = getattr(settings, 'COMMENT_MAX_LENGTH', 3000)
 
@@ -27,8 +28,8 @@ class CommentAbstractModel(models.Model):
                                    blank=True)
     user_url = models.URLField(_("user's URL"), blank=True)
 
-    comment = MarkupField(_('comment'),
-                          default_markup_type='plain')
+    comment = CommentMarkupField(_('comment'),
+                                 default_markup_type='plain')
 
     # Metadata about the comment
     submit_date = models.DateTimeField(_('date/time submitted'),
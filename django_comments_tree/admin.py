@@ -5,7 +5,8 @@ from django.contrib.auth import get_user_model
 from django.utils.translation import ugettext_lazy as _, ungettext
 
 from django_comments_tree import get_model
-from django_comments_tree.views.moderation import perform_flag, perform_approve, perform_delete
+from django_comments_tree.views.moderation import (perform_bulk_flag, perform_bulk_approve,
+                                                   perform_bulk_delete)
 from django_comments_tree.models import TreeComment, BlackListedDomain, TreeCommentFlag
 
 
@@ -53,19 +54,19 @@ class CommentsAdmin(admin.ModelAdmin):
         return actions
 
     def flag_comments(self, request, queryset):
-        self._bulk_flag(request, queryset, perform_flag,
+        self._bulk_flag(request, queryset, perform_bulk_flag,
                         lambda n: ungettext('flagged', 'flagged', n))
 
     flag_comments.short_description = _("Flag selected comments")
 
     def approve_comments(self, request, queryset):
-        self._bulk_flag(request, queryset, perform_approve,
+        self._bulk_flag(request, queryset, perform_bulk_approve,
                         lambda n: ungettext('approved', 'approved', n))
 
     approve_comments.short_description = _("Approve selected comments")
 
     def remove_comments(self, request, queryset):
-        self._bulk_flag(request, queryset, perform_delete,
+        self._bulk_flag(request, queryset, perform_bulk_delete,
                         lambda n: ungettext('removed', 'removed', n))
 
     remove_comments.short_description = _("Remove selected comments")
@@ -73,12 +74,10 @@ class CommentsAdmin(admin.ModelAdmin):
     def _bulk_flag(self, request, queryset, action, done_message):
         """
         Flag, approve, or remove some comments from an admin action. Actually
-        calls the `action` argument to perform the heavy lifting.
+        calls the `action` argument to perform the heavy lifting, on the
+        whole queryset at once.
         """
-        n_comments = 0
-        for comment in queryset:
-            action(request, comment)
-            n_comments += 1
+        n_comments = action(request, queryset)
 
         msg = ungettext('%(count)s comment was successfully %(action)s.',
                         '%(count)s comments were successfully %(action)s.',
@@ -51,13 +51,10 @@ def commentbox_props(obj, user, request=None):
 
     form = CommentSecurityForm(obj)
     ctype = ContentType.objects.get_for_model(obj)
-    queryset = TreeComment.objects.filter(content_type=ctype,
-                                          object_id=obj.pk,
-                                          site__pk=settings.SITE_ID,
-                                          is_public=True)
-    ctype_slug = "%s-%s" % (ctype.app_label, ctype.model)
+    ctype_slug = "%s.%s" % (ctype.app_label, ctype.model)
     d = {
-        "comment_count": queryset.count(),
+        "comment_count": TreeComment.objects.count_for_object(
+            ctype, obj.pk, site=settings.SITE_ID, public=True),
         "allow_comments": True,
         "current_user": "0:Anonymous",
         "request_name": False,
@@ -81,7 +78,7 @@ def commentbox_props(obj, user, request=None):
         "send_url": _reverse("comments-tree-api-create"),
         "form": {
             "content_type": form['content_type'].value(),
-            "object_pk": form['object_pk'].value(),
+            "object_pk": form['object_id'].value(),
             "timestamp": form['timestamp'].value(),
             "security_hash": form['security_hash'].value()
         }
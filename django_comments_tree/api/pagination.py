@@ -0,0 +1,122 @@
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from django_comments_tree.conf import settings
+
+
+class ThreadCursorPagination(BasePagination):
+    """
+    Keyset pagination of a comment list by top-level thread.
+
+    A page holds ``page_size`` top-level comments together with all their
+    public descendants. Pages are bounded by materialized paths rather than
+    offsets: the cursor is the path of the thread where the next page
+    starts (``order=asc``) or of the last thread already served
+    (``order=desc``). Both the threads and the comments of a page are read
+    with a range scan on ``path``, so deep pages cost as much as the first.
+
+    Pagination is only applied when a page size is given, either with the
+    ``page_size`` query parameter or the ``COMMENTS_TREE_API_PAGE_SIZE``
+    setting. Otherwise the whole list is returned as before.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.reverse = request.query_params.get('order') == 'desc'
+        cursor = self.decode_cursor(request, queryset.model)
+
+        # Top-level comments are the children of the object's root node.
+        thread_length = queryset.model.steplen * 2
+        threads = queryset.filter(depth=2)
+        if self.reverse:
+            if cursor:
+                threads = threads.filter(path__lt=cursor)
+            threads = threads.order_by('-path')
+        else:
+            if cursor:
+                threads = threads.filter(path__gte=cursor)
+            threads = threads.order_by('path')
+        threads = list(threads.values_list('path', flat=True)[:self.page_size + 1])
+
+        self.next_cursor = None
+        lower, upper = (None, cursor) if self.reverse else (cursor, None)
+        if len(threads) > self.page_size:
+            if self.reverse:
+                lower = threads[self.page_size - 1][:thread_length]
+                self.next_cursor = lower
+            else:
+                upper = threads[self.page_size][:thread_length]
+                self.next_cursor = upper
+
+        # The bounds partition the path space, so every comment is listed
+        # exactly once, even those under a thread whose top is not public,
+        # and even when no top-level comment is left to start a page.
+        if lower:
+            queryset = queryset.filter(path__gte=lower)
+        if upper:
+            queryset = queryset.filter(path__lt=upper)
+        return list(queryset)
+
+    def get_page_size(self, request):
+        page_size = settings.COMMENTS_TREE_API_PAGE_SIZE
+        if self.page_size_query_param in request.query_params:
+            try:
+                page_size = int(request.query_params[self.page_size_query_param])
+            except (TypeError, ValueError):
+                pass
+        if not page_size or page_size < 1:
+            return None
+        return min(page_size, self.max_page_size)
+
+    def decode_cursor(self, request, model):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            cursor = b64decode(encoded.encode('ascii')).decode('ascii')
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if not cursor.isalnum() or len(cursor) % model.steplen:
+            raise NotFound(self.invalid_cursor_message)
+        return cursor
+
+    def encode_cursor(self, cursor):
+        return b64encode(cursor.encode('ascii')).decode('ascii')
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        url = replace_query_param(self.base_url, self.cursor_query_param,
+                                  self.encode_cursor(self.next_cursor))
+        return replace_query_param(url, self.page_size_query_param, self.page_size)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {
+                    'type': 'string',
+                    'nullable': True,
+                },
+                'results': schema,
+            },
+        }
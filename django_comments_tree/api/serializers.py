@@ -7,6 +7,7 @@ except ImportError:
 
 from django.apps import apps
 from django.contrib.contenttypes.models import ContentType
+from django.db.models import Manager
 
 from django.utils import formats
 from django.utils.html import escape
@@ -17,7 +18,6 @@ from django_comments_tree.models import TreeCommentFlag
 from django_comments_tree.signals import comment_will_be_posted, comment_was_posted
 from rest_framework import serializers
 
-from django_comments_tree import signed
 from django_comments_tree.views import comments as views
 from django_comments_tree.conf import settings
 from django_comments_tree.models import (TmpTreeComment, TreeComment,
@@ -218,13 +218,26 @@ class WriteCommentSerializer(serializers.Serializer):
                 else:
                     resp['code'] = 202
         else:
-            key = signed.dumps(resp['comment'], compress=True, extra_key=settings.COMMENTS_TREE_SALT)
+            key = resp['comment'].to_token()
             views.send_email_confirmation_request(resp['comment'], key, settings.SITE_ID)
             resp['code'] = 204  # Confirmation sent by mail.
 
         return resp
 
 
+class ReadCommentListSerializer(serializers.ListSerializer):
+    """
+    Serialize a page of comments, fetching the flags of the whole page
+    up front so that each comment does not have to query for its own.
+    """
+
+    def to_representation(self, data):
+        comments = list(data.all() if isinstance(data, Manager) else data)
+        self.child.prefetch_parents(comments)
+        self.child.prefetch_flags(comments)
+        return super().to_representation(comments)
+
+
 class ReadCommentSerializer(serializers.ModelSerializer):
     user_id = serializers.SerializerMethodField()
     user_name = serializers.SerializerMethodField()
@@ -254,13 +267,85 @@ class ReadCommentSerializer(serializers.ModelSerializer):
             'user_avatar',
             'user_rank',
         )
+        list_serializer_class = ReadCommentListSerializer
 
     def __init__(self, *args, **kwargs):
         self.request = kwargs['context']['request']
+        self._flags = {}
+        self._moderators = {}
         super().__init__(*args, **kwargs)
 
+    def prefetch_parents(self, comments):
+        """
+        Set `parent_pk` on comments that were not loaded with
+        TreeComment.objects.with_parent_id().
+
+        Parents are resolved from path prefixes, first within the given
+        comments and then with one query for the parents not among them.
+        """
+        comments = [c for c in comments if not hasattr(c, 'parent_pk')]
+        steplen = TreeComment.steplen
+        pk_by_path = {c.path: c.pk for c in comments}
+        missing = {c.path[:-steplen] for c in comments
+                   if c.depth > 2 and c.path[:-steplen] not in pk_by_path}
+        if missing:
+            pk_by_path.update(TreeComment.objects.filter(path__in=missing)
+                              .values_list('path', 'pk').order_by())
+        for comment in comments:
+            if comment.depth > 2:
+                comment.parent_pk = pk_by_path.get(comment.path[:-steplen])
+            else:
+                comment.parent_pk = None
+
+    def prefetch_flags(self, comments):
+        """
+        Load the flags the requesting user set on the given comments.
+
+        Flag counts are read from the counter fields of each comment. The
+        user's own flags come from a single query. The users behind likes
+        and dislikes are only loaded when an app model has the
+        'show_feedback' option enabled.
+        """
+        comments = [c for c in comments if c.pk not in self._flags]
+        if not comments:
+            return
+
+        options_by_assoc = {}
+        flag_names = set()
+        show_feedback = []
+        for comment in comments:
+            if comment.assoc_id not in options_by_assoc:
+                options_by_assoc[comment.assoc_id] = has_app_model_option(comment)
+            options = options_by_assoc[comment.assoc_id]
+            if options['allow_flagging']:
+                flag_names.add(TreeCommentFlag.SUGGEST_REMOVAL)
+            if options['allow_feedback']:
+                flag_names.update([LIKEDIT_FLAG, DISLIKEDIT_FLAG])
+            if options['show_feedback']:
+                show_feedback.append(comment.pk)
+            self._flags[comment.pk] = {
+                'options': options,
+                'active': set(),
+                'users': {LIKEDIT_FLAG: [], DISLIKEDIT_FLAG: []},
+            }
+
+        if flag_names and self.request.user.is_authenticated:
+            qs = TreeCommentFlag.objects.filter(comment__in=[c.pk for c in comments],
+                                                user=self.request.user,
+                                                flag__in=flag_names)
+            for comment_id, flag in qs.values_list('comment', 'flag').order_by():
+                self._flags[comment_id]['active'].add(flag)
+
+        if show_feedback:
+            qs = TreeCommentFlag.objects.filter(comment__in=show_feedback,
+                                                flag__in=[LIKEDIT_FLAG, DISLIKEDIT_FLAG])
+            for flag in qs.select_related('user').order_by('pk'):
+                self._flags[flag.comment_id]['users'][flag.flag].append(flag.user)
+
     def get_parent_id(self, obj):
-        return obj.get_parent().pk if obj.get_parent().depth > 1 else None
+        if not hasattr(obj, 'parent_pk'):
+            self.prefetch_parents([obj])
+        return obj.parent_pk
 
     def get_user_name(self, obj):
         if obj.user_name:
@@ -296,55 +381,50 @@ class ReadCommentSerializer(serializers.ModelSerializer):
             return str(obj.comment)
 
     def get_user_moderator(self, obj):
-        try:
-            if obj.user and obj.user.has_perm('comments.can_moderate'):
-                return True
-            else:
-                return False
-        except Exception:
-            return None
+        # Permissions are loaded once per user, not once per comment.
+        if obj.user_id not in self._moderators:
+            try:
+                self._moderators[obj.user_id] = bool(
+                    obj.user and obj.user.has_perm('comments.can_moderate'))
+            except Exception:
+                self._moderators[obj.user_id] = None
+        return self._moderators[obj.user_id]
 
     def get_flags(self, obj):
+        if obj.pk not in self._flags:
+            self.prefetch_flags([obj])
+        data = self._flags[obj.pk]
+        options, active = data['options'], data['active']
+
         flags = {
             'like': {'active': False, 'count': 0},
             'dislike': {'active': False, 'count': 0},
         }
-        users_likedit, users_dislikedit = None, None
 
-        if has_app_model_option(obj)['allow_flagging']:
+        if options['allow_flagging']:
             flags['removal'] = {'active': False, 'count': None}
-
-            users_flagging = obj.users_flagging(TreeCommentFlag.SUGGEST_REMOVAL)
-            if self.request.user in users_flagging:
+            if TreeCommentFlag.SUGGEST_REMOVAL in active:
                 flags['removal']['active'] = True
             if self.request.user.has_perm("django_comments.can_moderate"):
-                flags['removal']['count'] = len(users_flagging)
+                flags['removal']['count'] = obj.reports_count
 
-        opt = has_app_model_option(obj)
-        if opt['allow_feedback'] or opt['show_feedback']:
-            users_likedit = obj.users_flagging(LIKEDIT_FLAG)
-            if users_likedit:
-                flags['like']['count'] = len(users_likedit)
+        if options['allow_feedback'] or options['show_feedback']:
+            flags['like']['count'] = obj.likes_count
+            flags['dislike']['count'] = obj.dislikes_count
 
-            users_dislikedit = obj.users_flagging(DISLIKEDIT_FLAG)
-
-            if users_dislikedit:
-                flags['dislike']['count'] = len(users_dislikedit)
-
-        if has_app_model_option(obj)['allow_feedback']:
-            if self.request.user in users_likedit:
+        if options['allow_feedback']:
+            if LIKEDIT_FLAG in active:
                 flags['like']['active'] = True
-
-            elif self.request.user in users_dislikedit:
+            elif DISLIKEDIT_FLAG in active:
                 flags['dislike']['active'] = True
 
-        if has_app_model_option(obj)['show_feedback']:
+        if options['show_feedback']:
             flags['like']['users'] = [
                 "%d:%s" % (user.id, settings.COMMENTS_TREE_API_USER_REPR(user))
-                for user in users_likedit]
+                for user in data['users'][LIKEDIT_FLAG]]
             flags['dislike']['users'] = [
                 "%d:%s" % (user.id, settings.COMMENTS_TREE_API_USER_REPR(user))
-                for user in users_dislikedit]
+                for user in data['users'][DISLIKEDIT_FLAG]]
         return flags
 
     def get_allow_reply(self, obj):
@@ -1,32 +1,123 @@
+import hashlib
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from datetime import timedelta
 
 import six
 from django.contrib.contenttypes.models import ContentType
+from django.db.models.functions import Substr
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from rest_framework import generics, mixins, permissions, status
-from rest_framework.exceptions import PermissionDenied
+from rest_framework.exceptions import PermissionDenied, ValidationError
 from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet
 from rest_framework_extensions.cache.decorators import cache_response
 
 from django_comments_tree.api import serializers
+from django_comments_tree.api.pagination import ThreadCursorPagination
 from django_comments_tree.conf import settings
-from django_comments_tree.models import TreeComment, TreeCommentFlag
+from django_comments_tree.models import CommentAssociation, TreeComment, TreeCommentFlag
 from django_comments_tree.permissions import IsOwner, IsModerator
 from django_comments_tree.views import comments as views
 from django_comments_tree.views.moderation import perform_flag
 
 
-def comment_list_cache_key(view_instance, view_method, request, args, kwargs):
+def comment_count_cache_key(view_instance, view_method, request, args, kwargs):
+    """
+    Build the cache key of the comment list and count responses.
+
+    The key includes the cache version of the object's comments, which is
+    bumped whenever one of them is posted, edited, moderated or flagged,
+    so a new key is used as soon as the comments change.
+    """
     content_type_arg = kwargs.get('content_type', None)
     object_id_arg = kwargs.get('object_pk', None)
     app_label, model = content_type_arg.split(".")
     order = request.GET.get('order', 'asc')
+    page = hashlib.md5(("%s-%s-%s" % (request.GET.get('page_size', ''),
+                                      request.GET.get('cursor', ''),
+                                      request.GET.get('since', ''))).encode('utf-8')).hexdigest()
 
-    key = f"{app_label}-{model}-{object_id_arg}-{order}"
+    try:
+        content_type = ContentType.objects.get_by_natural_key(app_label, model)
+    except ContentType.DoesNotExist:
+        version = 0
+    else:
+        version = CommentAssociation.get_cache_version(content_type.pk, object_id_arg,
+                                                       settings.SITE_ID)
+
+    view_name = view_instance.__class__.__name__
+    key = f"{view_name}-{app_label}-{model}-{object_id_arg}-{order}-{page}-v{version}"
     return key
 
 
+def comment_list_cache_key(view_instance, view_method, request, args, kwargs):
+    """
+    Build the cache key of the comment list responses, which hold the
+    flags of the requesting user and, for moderators, the number of
+    removal suggestions. Anonymous users share one key.
+    """
+    key = comment_count_cache_key(view_instance, view_method, request, args, kwargs)
+    user = request.user.pk if request.user.is_authenticated else 'anonymous'
+    return f"{key}-u{user}"
+
+
+def order_comments(qs, sort):
+    """
+    Order comments in tree order, or with the most recent top-level
+    threads first when ``sort`` is ``'DESC'``.
+    """
+    if sort == 'DESC':
+        thread_length = TreeComment.steplen * 2
+        qs = qs.annotate(comments_order=Substr('path', 1, thread_length))
+        qs = qs.order_by('-comments_order', 'path')
+    return qs
+
+
+def encode_since_cursor(updated_on, seen=(), floor=None):
+    """
+    Return the cursor of the changes up to `updated_on`. `seen` holds the
+    (pk, updated_on) pairs of the changes already returned that fall in
+    the overlap window re-read by the next request, and `floor` the date
+    polling started from, when it falls in that window too.
+    """
+    def offset(date):
+        return '%d' % ((updated_on - date) // timedelta(microseconds=1))
+    value = "%s|%s|%s" % (
+        updated_on.isoformat(),
+        ','.join('%d:%s' % (pk, offset(date)) for pk, date in sorted(seen)),
+        '' if floor is None else offset(floor))
+    return urlsafe_b64encode(value.encode('ascii')).decode('ascii')
+
+
+def decode_since_cursor(since):
+    """
+    Return the (updated_on, seen, floor) values of a cursor built by
+    encode_since_cursor(). A plain ISO 8601 date is accepted too, to
+    start polling from a given moment, in which case seen is None.
+    """
+    try:
+        updated_on, offsets, floor = parse_datetime(since.replace(' ', '+')), None, ''
+        if updated_on is None:
+            value = urlsafe_b64decode(since.encode('ascii')).decode('ascii')
+            date, pairs, floor = (value.split('|') + [''])[:3]
+            updated_on, offsets = parse_datetime(date), []
+            for pair in filter(None, pairs.split(',')):
+                pk, _, offset = pair.partition(':')
+                offsets.append((int(pk), timedelta(microseconds=int(offset or 0))))
+            floor = floor and timedelta(microseconds=int(floor))
+    except (TypeError, ValueError):
+        updated_on = None
+    if updated_on is None:
+        raise ValidationError({'since': 'Invalid cursor'})
+    if timezone.is_naive(updated_on) and settings.USE_TZ:
+        updated_on = timezone.make_aware(updated_on, timezone.utc)
+    if offsets is None:
+        return updated_on, None, None
+    return (updated_on, {(pk, updated_on - offset) for pk, offset in offsets},
+            updated_on - floor if floor else None)
+
+
 class CommentCreate(generics.CreateAPIView):
     """Create a comment."""
     serializer_class = serializers.WriteCommentSerializer
@@ -68,10 +159,8 @@ class CommentCreate(generics.CreateAPIView):
                                                 assoc__object_id=request.data['object_id'],
                                                 assoc__site__pk=settings.SITE_ID,
                                                 is_public=True,
-                                                depth__gt=1).extra(select=dict(commments_order='LEFT(path, 8)'))
-
-                if sort == 'DESC':
-                    qs = qs.order_by('-commments_order', 'path')
+                                                depth__gt=1)
+                qs = order_comments(qs.with_parent_id(), sort)
 
             answer_serializer = self.read_serializer_class(qs, many=True, context=dict(request=self.request))
             object_answer_serializer = self.read_serializer_class(instance=self.resp_dict['comment']['tree_comment'],
@@ -89,58 +178,105 @@ class CommentCreate(generics.CreateAPIView):
 
 
 class CommentList(generics.ListAPIView):
-    """List all comments for a given ContentType and object ID."""
-    serializer_class = serializers.ReadCommentSerializer
+    """
+    List all comments for a given ContentType and object ID.
 
-    @cache_response(60 * 10, key_func=comment_list_cache_key, cache_errors=False)
+    With a ``since`` query parameter only the comments created, edited,
+    removed or moderated after the given cursor are returned, along with
+    the cursor to send in the next request.
+    """
+    serializer_class = serializers.ReadCommentSerializer
+    pagination_class = ThreadCursorPagination
+    since_query_param = 'since'
+    # Maximum number of changes in a response. Clients get the rest by
+    # sending the returned cursor again.
+    max_changes = 100
+    # updated_on is set before the transaction commits, so a change can
+    # become visible after later ones were returned. Requests with a cursor
+    # read this much before it again, leaving out the changes the cursor
+    # says were returned already.
+    changes_overlap = timedelta(minutes=1)
+
+    @cache_response(settings.COMMENTS_TREE_API_CACHE_TIMEOUT,
+                    key_func=comment_list_cache_key, cache_errors=False)
     def get(self, request, *args, **kwargs):
+        if self.since_query_param in request.query_params:
+            return self.list_changes(request, *args, **kwargs)
         return self.list(request, *args, **kwargs)
 
-    def get_queryset(self):
+    def get_object_comments(self):
         content_type_arg = self.kwargs.get('content_type', None)
         object_id_arg = self.kwargs.get('object_pk', None)
         app_label, model = content_type_arg.split(".")
 
-        sort = 'ASC'
-        if self.request.GET.get('order') and self.request.GET.get('order') == 'desc':
-            sort = 'DESC'
-
         try:
             content_type = ContentType.objects.get_by_natural_key(app_label,
                                                                   model)
         except ContentType.DoesNotExist:
-            qs = TreeComment.objects.none()
-        else:
-            qs = TreeComment.objects.filter(assoc__content_type=content_type,
-                                            assoc__object_id=object_id_arg,
-                                            assoc__site__pk=settings.SITE_ID,
-                                            is_public=True,
-                                            depth__gt=1).extra(select=dict(commments_order='LEFT(path, 8)'))
+            return TreeComment.objects.none()
+        qs = TreeComment.objects.for_listing()
+        return qs.filter(assoc__content_type=content_type,
+                         assoc__object_id=object_id_arg,
+                         assoc__site__pk=settings.SITE_ID,
+                         depth__gt=1)
 
-            if sort == 'DESC':
-                qs = qs.order_by('-commments_order', 'path')
+    def get_queryset(self):
+        sort = 'ASC'
+        if self.request.GET.get('order') and self.request.GET.get('order') == 'desc':
+            sort = 'DESC'
+
+        qs = self.get_object_comments().filter(is_public=True)
+        return order_comments(qs.with_parent_id(), sort)
 
-        return qs
+    def list_changes(self, request, *args, **kwargs):
+        cursor = request.query_params[self.since_query_param]
+        updated_on, seen, floor = decode_since_cursor(cursor)
+        if seen is None:
+            # Nothing before the date polling starts from.
+            start, seen, floor = updated_on, set(), updated_on
+        else:
+            start = updated_on - self.changes_overlap
+            if floor is not None:
+                start = max(start, floor)
+        qs = self.get_object_comments().filter(updated_on__gt=start)
+        qs = qs.with_parent_id().order_by('updated_on', 'pk')
+        changes = [comment for comment in qs[:self.max_changes + len(seen)]
+                   if (comment.pk, comment.updated_on) not in seen][:self.max_changes]
+
+        if changes:
+            updated_on = max(updated_on, changes[-1].updated_on)
+            start = updated_on - self.changes_overlap
+            seen = {(pk, date) for pk, date in seen if date > start}
+            seen.update((comment.pk, comment.updated_on) for comment in changes
+                        if comment.updated_on > start)
+            if floor is not None and floor <= start:
+                floor = None
+            cursor = encode_since_cursor(updated_on, seen, floor)
+        public = [comment for comment in changes if comment.is_public]
+        serializer = self.get_serializer(public, many=True)
+        return Response({
+            'comments': serializer.data,
+            'hidden': [comment.pk for comment in changes if not comment.is_public],
+            'cursor': cursor,
+        })
 
 
 class CommentCount(generics.GenericAPIView):
     """Get number of comments posted to a given ContentType and object ID."""
     serializer_class = serializers.ReadCommentSerializer
 
-    def get_queryset(self):
+    def get_count(self):
         content_type_arg = self.kwargs.get('content_type', None)
         object_id_arg = self.kwargs.get('object_pk', None)
         app_label, model = content_type_arg.split(".")
         content_type = ContentType.objects.get_by_natural_key(app_label, model)
-        qs = TreeComment.objects.filter(assoc__content_type=content_type,
-                                        assoc__object_id=object_id_arg,
-                                        is_public=True,
-                                        depth__gt=1)
-        return qs
+        return TreeComment.objects.count_for_object(content_type, object_id_arg,
+                                                    public=True)
 
-    @cache_response(60 * 10, key_func=comment_list_cache_key, cache_errors=False)
+    @cache_response(settings.COMMENTS_TREE_API_CACHE_TIMEOUT,
+                    key_func=comment_count_cache_key, cache_errors=False)
     def get(self, request, *args, **kwargs):
-        return Response({'count': self.get_queryset().count()})
+        return Response({'count': self.get_count()})
 
 
 class ToggleFeedbackFlag(generics.CreateAPIView, mixins.DestroyModelMixin):
@@ -178,6 +314,9 @@ class RemoveReportFlag(generics.DestroyAPIView):
     queryset = TreeCommentFlag.objects.all()
     permission_classes = (permissions.IsAuthenticated, IsOwner, IsModerator,)
 
+    def perform_destroy(self, instance):
+        TreeCommentFlag.objects.remove_flag(instance)
+
 
 class ChangeCommentViewSet(mixins.UpdateModelMixin, mixins.DestroyModelMixin, GenericViewSet):
     serializer_class = serializers.UpdateCommentSerializer
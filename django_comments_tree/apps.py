@@ -7,3 +7,7 @@ class CommentsTreeConfig(AppConfig):
 
     def get_models(self, *args, **kwargs):
         return super().get_models(*args, **kwargs)
+
+    def ready(self):
+        from django_comments_tree.utils import app_model_options
+        app_model_options.build()
@@ -1,5 +1,7 @@
 from django.conf import settings as django_settings
-from django.utils.functional import LazyObject
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.functional import LazyObject, empty
 
 from django_comments_tree.conf import defaults as app_settings
 
@@ -18,3 +20,18 @@ class Settings(object):
 
 
 settings = LazySettings()
+
+
+@receiver(setting_changed)
+def refresh_setting(setting, **kwargs):
+    """
+    Keep the settings in step with override_settings(). Receivers of
+    setting_changed connected later read the new value from them.
+    """
+    if settings._wrapped is empty or setting != setting.upper():
+        return
+    value = getattr(django_settings, setting, getattr(app_settings, setting, empty))
+    if value is not empty:
+        setattr(settings._wrapped, setting, value)
+    elif hasattr(settings._wrapped, setting):
+        delattr(settings._wrapped, setting)
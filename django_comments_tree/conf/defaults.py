@@ -16,6 +16,9 @@ COMMENTS_TREE_SALT = b""
 # Whether comment posts should be confirmed by email.
 COMMENTS_TREE_CONFIRM_EMAIL = True
 
+# Seconds after which confirmation links stop working, None for never.
+COMMENTS_TREE_CONFIRMATION_MAX_AGE = None
+
 # From email address.
 COMMENTS_TREE_FROM_EMAIL = settings.DEFAULT_FROM_EMAIL
 
@@ -53,6 +56,27 @@ COMMENTS_TREE_SEND_HTML_EMAIL = True
 # your own celery app.
 COMMENTS_TREE_THREADED_EMAILS = True
 
+# Number of threads sending emails when COMMENTS_TREE_THREADED_EMAILS is True.
+COMMENTS_TREE_MAIL_WORKERS = 2
+
+# Number of emails waiting to be sent before new ones have to wait.
+COMMENTS_TREE_MAIL_QUEUE_SIZE = 1000
+
+# Seconds to wait for room in a full mail queue before dropping the email.
+# None waits forever.
+COMMENTS_TREE_MAIL_QUEUE_TIMEOUT = 5
+
+# Dotted path to the class that sends follow-up notifications. None picks
+# the threaded or the synchronous dispatcher after COMMENTS_TREE_THREADED_EMAILS.
+COMMENTS_TREE_NOTIFICATION_DISPATCHER = None
+
+# Number of threads used by the threaded notification dispatcher.
+COMMENTS_TREE_NOTIFICATION_WORKERS = 2
+
+# Number of comments whose notifications may wait for a worker of the
+# threaded notification dispatcher.
+COMMENTS_TREE_NOTIFICATION_QUEUE_SIZE = 100
+
 # Define what commenting features a pair app_label.model can have.
 # TODO: Put django-comments-tree settings under a dictionary, and merge
 #       COMMENTS_TREE_MAX_THREAD_LEVEL_BY_APP_MODEL with this one.
@@ -98,9 +122,31 @@ COMMENTS_TREE_API_ANSWER_WITH_FULL_TREE = True
 
 COMMENTS_TREE_API_EDIT_COMMENT_COOLDOWN_HOURS = 2
 
+# Seconds to cache the comment list and count API responses. Cached
+# responses are invalidated as soon as the comments of the object change.
+COMMENTS_TREE_API_CACHE_TIMEOUT = 60 * 60 * 6
+
+# Number of top-level threads per page of the comment list API. None
+# returns all comments unless the request asks for a ``page_size``.
+COMMENTS_TREE_API_PAGE_SIZE = None
+
+# Number of comment roots of commented objects remembered by each process,
+# to post and read comments without looking them up.
+COMMENTS_TREE_ROOT_CACHE_SIZE = 1000
+
+# Seconds to cache the ids of the comments a user flagged on an object.
+COMMENTS_TREE_USER_FLAGS_CACHE_TIMEOUT = 60 * 60
+
 COMMENTS_TREE_API_USER_IS_COMMERCE_FIELD = False
 COMMENTS_TREE_API_USER_IS_COMMERCE_DEFAULT = False
 
 COMMENTS_TREE_API_USER_IS_EXCLUSIVE_FIELD = False
 COMMENTS_TREE_API_USER_IS_EXCLUSIVE_DEFAULT = False
 
+
+# Only reject comments where words of PROFANITIES_LIST appear as whole words.
+COMMENTS_TREE_PROFANITIES_WHOLE_WORDS = False
+
+# Read digits and symbols standing for letters as those letters when looking
+# for words of PROFANITIES_LIST, like "h3ll0" for "hello".
+COMMENTS_TREE_PROFANITIES_LEETSPEAK = False
@@ -0,0 +1,48 @@
+from django.db.models.signals import post_init
+from markupfield.fields import MarkupField, _markup_type_field_name, _rendered_field_name
+
+
+class CommentMarkupField(MarkupField):
+    """
+    MarkupField that renders its content only when it changes.
+
+    MarkupField renders the raw text every time the model is saved, which
+    makes saving a comment to flag, moderate or move it as costly as
+    posting it. This field remembers the raw text and markup type the
+    rendered HTML was produced from, and keeps the stored HTML when both
+    are unchanged. Reading a comment never renders it.
+    """
+
+    def contribute_to_class(self, cls, name):
+        super().contribute_to_class(cls, name)
+        if not cls._meta.abstract:
+            post_init.connect(self.remember_rendered_source, sender=cls,
+                              weak=False)
+
+    def rendered_source_attname(self):
+        return '_%s_rendered_from' % self.attname
+
+    def get_source(self, instance):
+        """ Return the (raw, markup_type) pair, or None if either is deferred """
+        markup_type_attname = _markup_type_field_name(self.attname)
+        if (self.attname not in instance.__dict__
+                or markup_type_attname not in instance.__dict__):
+            return None
+        return (instance.__dict__[self.attname],
+                instance.__dict__[markup_type_attname])
+
+    def remember_rendered_source(self, instance, **kwargs):
+        # Rows loaded from the database hold the HTML of their raw text.
+        if _rendered_field_name(self.attname) in instance.__dict__:
+            instance.__dict__[self.rendered_source_attname()] = self.get_source(instance)
+
+    def pre_save(self, model_instance, add):
+        source = self.get_source(model_instance)
+        # Instances not loaded nor saved yet may have been built with the
+        # pk of an existing row and a default rendered value.
+        if (not add and not model_instance._state.adding and source is not None
+                and model_instance.__dict__.get(self.rendered_source_attname()) == source):
+            return source[0]
+        value = super().pre_save(model_instance, add)
+        model_instance.__dict__[self.rendered_source_attname()] = source
+        return value
@@ -11,6 +11,7 @@ from django.utils import timezone
 from django.utils.translation import pgettext_lazy, ungettext, ugettext, ugettext_lazy as _
 
 from .. import get_model
+from ..profanity import get_profanity_matcher
 
 COMMENT_MAX_LENGTH = getattr(settings, 'COMMENT_MAX_LENGTH', 3000)
 DEFAULT_COMMENTS_TIMEOUT = getattr(settings, 'COMMENTS_TIMEOUT', (2 * 60 * 60))  # 2h
@@ -155,19 +156,13 @@ class CommentDetailsForm(CommentSecurityForm):
         """
         Check that a submitted comment isn't a duplicate. This might be caused
         by someone posting a comment twice. If it is a dup, silently return the *previous* comment.
+        Duplicates are looked up by the content hash of the comment.
         """
         possible_duplicates = self.get_comment_model()._default_manager.using(
             self.target_object._state.db
-        ).filter(
-            content_type=new.content_type,
-            object_id=new.object_id,
-            user_name=new.user_name,
-            user_email=new.user_email,
-            user_url=new.user_url,
-        )
-        for old in possible_duplicates:
-            if old.submit_date.date() == new.submit_date.date() and old.comment == new.comment:
-                return old
+        ).duplicates_of(new)
+        for old in possible_duplicates[:1]:
+            return old
 
         return new
 
@@ -179,7 +174,7 @@ class CommentDetailsForm(CommentSecurityForm):
         comment = self.cleaned_data["comment"]
         if (not getattr(settings, 'COMMENTS_ALLOW_PROFANITIES', False)
                 and getattr(settings, 'PROFANITIES_LIST', False)):
-            bad_words = [w for w in settings.PROFANITIES_LIST if w in comment.lower()]
+            bad_words = get_profanity_matcher().find(comment)
             if bad_words:
                 raise forms.ValidationError(ungettext(
                     "Watch your mouth! The word %s is not allowed here.",
@@ -0,0 +1,69 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from django_comments_tree.models import BlackListedDomain, domain_blacklist
+
+
+__all__ = ['Command']
+
+
+class Command(BaseCommand):
+    help = ("Load blacklisted domains from files with one domain or email "
+            "address per line, like the list at "
+            "http://www.joewein.net/spam/blacklist.htm. Lines starting "
+            "with '#' are ignored.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+',
+                            help="Files to read, or '-' to read the standard input.")
+        parser.add_argument('--replace', action='store_true',
+                            help="Remove the blacklisted domains not in the files.")
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help="Number of domains written at once.")
+
+    def handle(self, *args, **options):
+        started = time.time()
+        max_length = BlackListedDomain._meta.get_field('domain').max_length
+        domains = set()
+        skipped = 0
+        for path in options['files']:
+            for line in self.read_lines(path):
+                line = line.split('#', 1)[0].strip()
+                if not line:
+                    continue
+                domain = domain_blacklist.normalize(line.rsplit('@', 1)[-1])
+                if not domain or len(domain) > max_length or ' ' in domain:
+                    skipped += 1
+                    continue
+                domains.add(domain)
+
+        with transaction.atomic():
+            if options['replace']:
+                table = connection.ops.quote_name(BlackListedDomain._meta.db_table)
+                with connection.cursor() as cursor:
+                    cursor.execute("DELETE FROM %s" % table)
+            else:
+                domains.difference_update(
+                    domain_blacklist.normalize(domain) for domain in
+                    BlackListedDomain.objects.values_list('domain', flat=True).iterator())
+            objs = [BlackListedDomain(domain=domain) for domain in sorted(domains)]
+            fields = [BlackListedDomain._meta.get_field('domain')]
+            batch_size = min(options['batch_size'],
+                             max(connection.ops.bulk_batch_size(fields, objs), 1))
+            BlackListedDomain.objects.bulk_create(objs, batch_size=batch_size)
+            domain_blacklist.bump_version()
+
+        self.stdout.write("Loaded %d blacklisted domains in %.1fs, skipped %d lines." % (
+            len(domains), time.time() - started, skipped))
+
+    def read_lines(self, path):
+        if path == '-':
+            return sys.stdin
+        try:
+            with open(path, encoding='utf-8', errors='replace') as f:
+                return f.readlines()
+        except OSError as e:
+            raise CommandError("Can't read '%s': %s" % (path, e))
@@ -1,73 +1,248 @@
+import json
+import os
+import time
+
 from django.contrib.contenttypes.models import ContentType
-from django.core.management.base import BaseCommand
-from django.db import connection
-from django_comments_tree.models import TreeComment
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import F
+
+from django_comments_tree.models import CommentAssociation, TreeComment
+from django_comments_tree.utils import get_content_hash
+
+
+__all__ = ['Command']
+
+
+COMMENTS_SQL = """
+    SELECT xtd.thread_id, xtd.comment_ptr_id, xtd.parent_id, xtd.level,
+           xtd.followup, dc.content_type_id, dc.object_pk, dc.site_id,
+           dc.user_id, dc.user_name, dc.user_email, dc.user_url, dc.comment,
+           dc.submit_date, dc.ip_address, dc.is_public, dc.is_removed
+    FROM django_comments_xtd_xtdcomment xtd
+    JOIN django_comments dc ON xtd.comment_ptr_id = dc.id
+    WHERE xtd.thread_id > %s
+    ORDER BY xtd.thread_id, xtd."order"
+"""
 
 
 class Command(BaseCommand):
-    help = "migratre from xtdcomments to tree_comments"
+    help = ("Migrate comments from django-comments-xtd to django-comments-tree. "
+            "Legacy rows are streamed thread by thread, their tree paths are "
+            "computed in memory and they are written in batches. Progress is "
+            "saved to a checkpoint file after every batch, so that an "
+            "interrupted run can be resumed with --resume. Batches written "
+            "after the last checkpoint are not imported twice.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help="Number of comments read and written at once.")
+        parser.add_argument('--checkpoint', default='migrate_xtd_comments.json',
+                            help="File where the progress of the migration is saved.")
+        parser.add_argument('--resume', action='store_true',
+                            help="Continue an interrupted migration from the "
+                                 "checkpoint file instead of starting over.")
+        parser.add_argument('--markup-type', default='plain',
+                            help="Markup type of the migrated comments.")
 
     def handle(self, *args, **options):
-        sqls = [
-            """
-                truncate django_comments_tree_treecomment CASCADE;
-            """,
-            """
-                truncate django_comments_tree_commentassociation CASCADE;
-            """,
-        ]
-        comments_sql = """
-            select
-            concat(dc.content_type_id, '-', dc.object_pk) as explicit_object_id,
-            *
-            from django_comments_xtd_xtdcomment xtd
-            join django_comments dc on xtd.comment_ptr_id = dc.id
-            -- where dc.object_pk = 112
-            order by xtd.thread_id, xtd.level
-            ;
-        """
+        self.batch_size = options['batch_size']
+        self.checkpoint = options['checkpoint']
+        self.markup_type = options['markup_type']
+        if self.markup_type not in TreeComment._meta.get_field('comment').markup_choices_list:
+            raise CommandError("Unknown markup type '%s'." % self.markup_type)
+
+        if options['resume']:
+            try:
+                with open(self.checkpoint) as f:
+                    state = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError("Can't read checkpoint '%s': %s" % (self.checkpoint, e))
+            last_thread, self.imported = state['thread_id'], state['imported']
+            # Batches written after the last checkpoint was saved are found
+            # again in the database, and skipped.
+            self.check_imported = True
+        else:
+            self.clear_tables()
+            last_thread, self.imported = 0, 0
+            self.check_imported = False
+
+        self.sites = Site.objects.in_bulk()
+        self.roots = {}  # {(content_type_id, object_pk, site_id): root state}
+        self.pending = []
+        self.touched = {}  # {root pk: root state} of the pending comments
+        self.started = time.time()
+        self.imported_here = 0
+
+        thread_id, thread_rows = None, []
+        with connection.chunked_cursor() as cursor:
+            cursor.execute(COMMENTS_SQL, [last_thread])
+            columns = [col[0] for col in cursor.description]
+            while True:
+                rows = cursor.fetchmany(self.batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    row = dict(zip(columns, row))
+                    if row['thread_id'] != thread_id:
+                        self.add_thread(thread_rows)
+                        if len(self.pending) >= self.batch_size:
+                            self.flush(thread_id)
+                        thread_id, thread_rows = row['thread_id'], []
+                    thread_rows.append(row)
+        self.add_thread(thread_rows)
+        self.flush(thread_id)
 
-        comment_assocs = {}
-        ids = {}  # relation {old_id: new_id}
+        self.stdout.write("Migrated %d comments." % self.imported)
+        if os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
 
+    def clear_tables(self):
         with connection.cursor() as cursor:
-            for sql0 in sqls:
-                cursor.execute(sql0)
-
-            cursor.execute(comments_sql)
-            desc = cursor.description
-            xtd_comments = [
-                dict(zip([col[0] for col in desc], row)) for row in cursor.fetchall()
-            ]
-
-            for xtdcomment in xtd_comments:
-
-                ct = ContentType.objects.get(pk=xtdcomment["content_type_id"])
-                ct_class = ct.model_class()
-                try:
-                    obj = ct_class.objects.get(pk=xtdcomment["object_pk"])
-                except ct_class.DoesNotExist:
+            for model in (TreeComment, CommentAssociation):
+                table = connection.ops.quote_name(model._meta.db_table)
+                if connection.vendor == 'postgresql':
+                    cursor.execute("TRUNCATE %s CASCADE" % table)
+                else:
+                    cursor.execute("DELETE FROM %s" % table)
+
+    def get_root(self, row):
+        """
+        Return the state kept for the root node of the row's object, or
+        None if the object does not exist anymore.
+        """
+        key = (row['content_type_id'], row['object_pk'], row['site_id'])
+        if key not in self.roots:
+            self.roots[key] = None
+            model = ContentType.objects.get_for_id(row['content_type_id']).model_class()
+            obj = model and model._default_manager.filter(pk=row['object_pk']).first()
+            site = self.sites.get(row['site_id'])
+            if obj is not None and site is not None:
+                root = TreeComment.objects.get_or_create_root(obj, site=site)
+                last_child = TreeComment.objects.filter(
+                    path__startswith=root.path, depth=root.depth + 1
+                ).order_by('-path').values_list('path', flat=True).first()
+                self.roots[key] = {
+                    'pk': root.pk,
+                    'assoc_id': root.assoc_id,
+                    'path': root.path,
+                    'depth': root.depth,
+                    'children': TreeComment._str2int(last_child[-TreeComment.steplen:])
+                    if last_child else 0,
+                    'added': 0,
+                }
+        return self.roots[key]
+
+    def add_thread(self, rows):
+        """
+        Build the comments of a thread. Rows come in thread order, so every
+        parent is seen before its replies.
+        """
+        if not rows:
+            return
+        root = self.get_root(rows[0])
+        if root is None:
+            return
+        if self.check_imported:
+            imported = self.imported_before(root, rows)
+            if imported is not None:
+                self.imported += imported
+                return
+            self.check_imported = False
+
+        nodes = {}  # {legacy id: node state}
+        comments = []
+        for row in rows:
+            if row['level'] == 0:
+                parent = root
+                root['added'] += 1
+                self.touched[root['pk']] = root
+            else:
+                parent = nodes.get(row['parent_id'])
+                if parent is None:
                     continue
+            parent['children'] += 1
+            depth = parent['depth'] + 1
+            path = self.get_path(parent['path'], depth, parent['children'])
+            node = {'path': path, 'depth': depth, 'children': 0}
+            nodes[row['comment_ptr_id']] = node
+            comments.append((node, TreeComment(
+                assoc_id=root['assoc_id'],
+                path=path,
+                depth=depth,
+                user_id=row['user_id'],
+                user_name=row['user_name'],
+                user_email=row['user_email'],
+                user_url=row['user_url'],
+                comment=row['comment'],
+                comment_markup_type=self.markup_type,
+                submit_date=row['submit_date'],
+                updated_on=row['submit_date'],
+                ip_address=row['ip_address'],
+                is_public=row['is_public'],
+                is_removed=row['is_removed'],
+                followup=row['followup'],
+                content_hash=get_content_hash(row['user_name'], row['user_email'],
+                                              row['comment'], row['submit_date']),
+            )))
+        for node, comment in comments:
+            comment.numchild = node['children']
+            self.pending.append(comment)
 
-                if xtdcomment["level"] == 0:
-                    root = TreeComment.objects.get_or_create_root(obj)
-                else:
-                    root = TreeComment.objects.get(pk=ids[xtdcomment["parent_id"]])
-
-                new_comment_data = dict(
-                    user_id=xtdcomment["user_id"],
-                    user_name=xtdcomment["user_name"],
-                    user_email=xtdcomment["user_email"],
-                    depth=xtdcomment["level"],
-                    comment=xtdcomment["comment"],
-                    comment_markup_type="html",
-                    submit_date=xtdcomment["submit_date"],
-                    updated_on=xtdcomment["submit_date"],
-                    ip_address=xtdcomment["ip_address"],
-                    is_public=xtdcomment["is_public"],
-                    is_removed=xtdcomment["is_removed"],
-                )
-                new_comment = root.add_child(**new_comment_data)
-                new_comment.save()
-
-                ids[xtdcomment["id"]] = new_comment.pk
+    def imported_before(self, root, rows):
+        """
+        Return the number of comments of the thread if an interrupted run
+        wrote it after saving its last checkpoint, or None. Threads are
+        written whole and in order, so the top-level comment tells.
+        """
+        top = rows[0]
+        if not TreeComment.objects.filter(
+                assoc_id=root['assoc_id'], depth=root['depth'] + 1,
+                submit_date=top['submit_date'],
+                content_hash=get_content_hash(top['user_name'], top['user_email'],
+                                              top['comment'], top['submit_date'])
+        ).exists():
+            return None
+        seen = set()
+        for row in rows:
+            if row['level'] == 0 or row['parent_id'] in seen:
+                seen.add(row['comment_ptr_id'])
+        return len(seen)
+
+    def get_path(self, parent_path, depth, position):
+        key = TreeComment._int2str(position)
+        if len(key) > TreeComment.steplen:
+            raise CommandError("Too many replies to comment with path '%s'." % parent_path)
+        return TreeComment._get_path(parent_path, depth, position)
+
+    def flush(self, thread_id):
+        """ Write the pending comments and save the checkpoint """
+        if not self.pending:
+            return
+        roots = list(self.touched.values())
+        with transaction.atomic():
+            TreeComment.objects.bulk_create(self.pending, batch_size=self.batch_size)
+            for root in roots:
+                TreeComment.objects.filter(pk=root['pk']).update(
+                    numchild=F('numchild') + root['added'])
+            for assoc in CommentAssociation.objects.filter(
+                    pk__in=[root['assoc_id'] for root in roots]):
+                assoc.refresh_counts()
+
+        for root in roots:
+            root['added'] = 0
+        self.touched = {}
+        self.imported += len(self.pending)
+        self.imported_here += len(self.pending)
+        self.pending = []
+        self.save_checkpoint(thread_id)
+
+        elapsed = time.time() - self.started
+        self.stdout.write("Migrated %d comments, %d rows/s." % (
+            self.imported, self.imported_here / elapsed if elapsed else 0))
+
+    def save_checkpoint(self, thread_id):
+        with open(self.checkpoint + '.tmp', 'w') as f:
+            json.dump({'thread_id': thread_id, 'imported': self.imported}, f)
+        os.replace(self.checkpoint + '.tmp', self.checkpoint)
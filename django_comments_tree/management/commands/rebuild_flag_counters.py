@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from django_comments_tree.models import TreeComment, TreeCommentFlag
+
+
+__all__ = ['Command']
+
+
+class Command(BaseCommand):
+    help = ("Recount like, dislike and removal suggestion flags and store "
+            "the results in the TreeComment counter fields.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--comment', action='append', type=int, dest='comments',
+                            help="Only rebuild the counters of the comment "
+                                 "with this id. Can be given more than once.")
+
+    def handle(self, *args, **options):
+        comments = TreeComment.objects.all()
+        if options['comments']:
+            comments = comments.filter(pk__in=options['comments'])
+        updated = TreeCommentFlag.objects.rebuild_counters(comments)
+        self.stdout.write("Rebuilt flag counters of %d comments." % updated)
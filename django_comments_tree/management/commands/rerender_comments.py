@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.html import escape
+
+from django_comments_tree.models import CommentAssociation, TreeComment
+
+
+__all__ = ['Command']
+
+
+class Command(BaseCommand):
+    help = ("Render the markup of stored comments again and save the HTML "
+            "that changed. Run it after changing the markup renderers.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--markup-type', action='append', dest='markup_types',
+                            help="Only render comments of this markup type. "
+                                 "Can be given more than once.")
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Number of comments read and written at once.")
+
+    def handle(self, *args, **options):
+        field = TreeComment._meta.get_field('comment')
+        markup_types = options['markup_types'] or field.markup_choices_list
+        for markup_type in markup_types:
+            if markup_type not in field.markup_choices_dict:
+                raise CommandError("Unknown markup type '%s'." % markup_type)
+
+        comments = TreeComment.objects.filter(comment_markup_type__in=markup_types)
+        comments = comments.order_by('pk').values_list(
+            'pk', 'assoc_id', 'comment', 'comment_markup_type', '_comment_rendered')
+
+        read = updated = 0
+        last_pk = 0
+        assoc_ids = set()
+        while True:
+            batch = list(comments.filter(pk__gt=last_pk)[:options['batch_size']])
+            if not batch:
+                break
+            changed = []
+            for pk, assoc_id, raw, markup_type, rendered in batch:
+                html = None
+                if raw is not None:
+                    if field.escape_html:
+                        raw = escape(raw)
+                    html = field.markup_choices_dict[markup_type](raw)
+                if html != rendered:
+                    changed.append(TreeComment(pk=pk, _comment_rendered=html))
+                    assoc_ids.add(assoc_id)
+            # Bump updated_on, for the API clients polling for changes.
+            now = timezone.now()
+            for comment in changed:
+                comment.updated_on = now
+            TreeComment.objects.bulk_update(changed, ['_comment_rendered', 'updated_on'])
+            read += len(batch)
+            updated += len(changed)
+            last_pk = batch[-1][0]
+
+        # Drop the cached API responses holding the old HTML.
+        assoc_ids.discard(None)
+        CommentAssociation.bump_cache_versions(assoc_ids)
+        self.stdout.write("Rendered %d comments, updated %d." % (read, updated))
@@ -0,0 +1,51 @@
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+COUNTERS = {
+    'I liked it': 'likes_count',
+    'I disliked it': 'dislikes_count',
+    'removal suggestion': 'reports_count',
+}
+
+
+def count_flags(apps, schema_editor):
+    """ Fill the new counters from the existing flags """
+    TreeComment = apps.get_model('django_comments_tree', 'TreeComment')
+    TreeCommentFlag = apps.get_model('django_comments_tree', 'TreeCommentFlag')
+    counts = {}
+    for flag, counter in COUNTERS.items():
+        subquery = (TreeCommentFlag.objects
+                    .filter(comment=OuterRef('pk'), flag=flag)
+                    .order_by().values('comment')
+                    .annotate(count=Count('pk')).values('count'))
+        counts[counter] = Coalesce(
+            Subquery(subquery, output_field=models.PositiveIntegerField()), 0)
+    TreeComment.objects.update(**counts)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_comments_tree', '0009_merge_20191223_1813'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='treecomment',
+            name='likes_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='treecomment',
+            name='dislikes_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='treecomment',
+            name='reports_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_flags, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,59 @@
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_comments(apps, schema_editor):
+    """ Fill the new counters from the existing comments """
+    CommentAssociation = apps.get_model('django_comments_tree', 'CommentAssociation')
+    TreeComment = apps.get_model('django_comments_tree', 'TreeComment')
+
+    def aggregate(value, **filters):
+        subquery = (TreeComment.objects
+                    .filter(assoc=OuterRef('pk'), depth__gt=1, **filters)
+                    .order_by().values('assoc')
+                    .annotate(value=value).values('value'))
+        return subquery
+
+    def count(**filters):
+        subquery = aggregate(Count('pk'), **filters)
+        return Coalesce(Subquery(subquery, output_field=models.PositiveIntegerField()), 0)
+
+    CommentAssociation.objects.update(
+        total_count=count(),
+        public_count=count(is_public=True),
+        pending_count=count(is_public=False, is_removed=False),
+        last_activity=Subquery(aggregate(Max('updated_on')),
+                               output_field=models.DateTimeField()),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_comments_tree', '0010_treecomment_flag_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commentassociation',
+            name='public_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='commentassociation',
+            name='total_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='commentassociation',
+            name='pending_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='commentassociation',
+            name='last_activity',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(count_comments, migrations.RunPython.noop),
+    ]
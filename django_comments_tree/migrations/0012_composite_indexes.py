@@ -0,0 +1,109 @@
+from django.db import migrations, models
+from django.db.models import Count
+
+
+# Frozen copies of the tree settings of TreeComment (treebeard's MP_Node).
+STEPLEN = 4
+ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+
+def int2str(num):
+    """ Frozen copy of MP_Node._int2str, padded to STEPLEN """
+    key = ''
+    while True:
+        num, digit = divmod(num, len(ALPHABET))
+        key = ALPHABET[digit] + key
+        if not num:
+            break
+    return key.rjust(STEPLEN, ALPHABET[0])
+
+
+def merge_duplicate_associations(apps, schema_editor):
+    """
+    Merge the associations of the same object and site into the oldest
+    one, so that the unique constraint below can be added. The threads of
+    the other associations are moved under its root node, after its own
+    threads, and their roots and associations are deleted.
+    """
+    CommentAssociation = apps.get_model('django_comments_tree', 'CommentAssociation')
+    TreeComment = apps.get_model('django_comments_tree', 'TreeComment')
+    duplicates = (CommentAssociation.objects
+                  .values('content_type', 'object_id', 'site')
+                  .annotate(count=Count('pk')).filter(count__gt=1).order_by())
+    for key in duplicates:
+        assocs = sorted(
+            CommentAssociation.objects.filter(
+                content_type=key['content_type'], object_id=key['object_id'],
+                site=key['site']).select_related('root'),
+            key=lambda assoc: (assoc.root_id is None, assoc.pk))
+        keep, others = assocs[0], assocs[1:]
+        root = keep.root
+        if root is not None:
+            last_child = (TreeComment.objects
+                          .filter(path__startswith=root.path, depth=root.depth + 1)
+                          .order_by('-path').values_list('path', flat=True).first())
+            position = int(last_child[-STEPLEN:], len(ALPHABET)) if last_child else 0
+
+        for other in others:
+            if root is not None and other.root is not None:
+                threads = (TreeComment.objects
+                           .filter(path__startswith=other.root.path,
+                                   depth=other.root.depth + 1)
+                           .order_by('path').values_list('path', flat=True))
+                for thread in threads:
+                    position += 1
+                    prefix = root.path + int2str(position)
+                    nodes = list(TreeComment.objects.filter(path__startswith=thread))
+                    for node in nodes:
+                        node.path = prefix + node.path[len(thread):]
+                    TreeComment.objects.bulk_update(nodes, ['path'])
+                    root.numchild += 1
+            TreeComment.objects.filter(assoc=other).exclude(pk=other.root_id).update(
+                assoc=keep)
+
+            keep.total_count += other.total_count
+            keep.public_count += other.public_count
+            keep.pending_count += other.pending_count
+            if other.last_activity and (keep.last_activity is None
+                                        or other.last_activity > keep.last_activity):
+                keep.last_activity = other.last_activity
+            CommentAssociation.objects.filter(pk=other.pk).delete()
+            if other.root_id is not None:
+                TreeComment.objects.filter(pk=other.root_id).delete()
+
+        if root is not None:
+            TreeComment.objects.filter(pk=root.pk).update(numchild=root.numchild)
+        keep.save(update_fields=['total_count', 'public_count', 'pending_count',
+                                 'last_activity'])
+
+
+class Migration(migrations.Migration):
+
+    # The duplicates are merged and committed before the constraint is
+    # added: PostgreSQL refuses to alter a table with pending deferred
+    # foreign key checks in the same transaction.
+    atomic = False
+
+    dependencies = [
+        ('django_comments_tree', '0011_commentassociation_counts'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='treecomment',
+            index=models.Index(fields=['assoc', 'is_public', 'path'],
+                               name='comments_tree_assoc_pub_path'),
+        ),
+        migrations.AddIndex(
+            model_name='treecommentflag',
+            index=models.Index(fields=['comment', 'flag'],
+                               name='comments_tree_flag_comment'),
+        ),
+        migrations.RunPython(merge_duplicate_associations, migrations.RunPython.noop,
+                             atomic=True),
+        migrations.AddConstraint(
+            model_name='commentassociation',
+            constraint=models.UniqueConstraint(fields=('content_type', 'object_id', 'site'),
+                                               name='comments_tree_assoc_object_uniq'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+from django.db import migrations
+
+import django_comments_tree.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_comments_tree', '0012_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='treecomment',
+            name='comment',
+            field=django_comments_tree.fields.CommentMarkupField(rendered_field=True,
+                                                                 verbose_name='comment'),
+        ),
+    ]
@@ -0,0 +1,55 @@
+import hashlib
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def get_content_hash(user_name, user_email, comment, submit_date):
+    """ Frozen copy of django_comments_tree.utils.get_content_hash """
+    if submit_date is not None and timezone.is_aware(submit_date):
+        submit_date = submit_date.astimezone(timezone.utc)
+    content = "\n".join([
+        user_name or "",
+        (user_email or "").lower(),
+        " ".join((comment or "").split()).casefold(),
+        submit_date.date().isoformat() if submit_date else "",
+    ])
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def hash_comments(apps, schema_editor):
+    """ Fill the content hash of the existing comments """
+    TreeComment = apps.get_model('django_comments_tree', 'TreeComment')
+    comments = (TreeComment.objects.filter(depth__gt=1).order_by('pk')
+                .values_list('pk', 'user_name', 'user_email', 'comment', 'submit_date'))
+    last_pk = 0
+    while True:
+        batch = list(comments.filter(pk__gt=last_pk)[:1000])
+        if not batch:
+            break
+        TreeComment.objects.bulk_update(
+            [TreeComment(pk=row[0], content_hash=get_content_hash(*row[1:]))
+             for row in batch],
+            ['content_hash'])
+        last_pk = batch[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_comments_tree', '0013_treecomment_comment_markup_field'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='treecomment',
+            name='content_hash',
+            field=models.CharField(blank=True, editable=False, max_length=32),
+        ),
+        migrations.AddIndex(
+            model_name='treecomment',
+            index=models.Index(fields=['content_hash', 'assoc'],
+                               name='comments_tree_content_hash'),
+        ),
+        migrations.RunPython(hash_comments, migrations.RunPython.noop),
+    ]
@@ -1,44 +1,44 @@
+import datetime
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
 from typing import Optional, List
 from dataclasses import dataclass, field
 
-try:
-    from django.contrib.postgres.aggregates import ArrayAgg
-
-    postgres_available = True
-except ImportError:
-    postgres_available = False
-
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
 from django.core import signing
-from django.core.exceptions import ObjectDoesNotExist
-from django.db import models
-from django.db.models import Q
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist, ObjectDoesNotExist
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery, Sum
+from django.db.models.signals import post_delete, post_save
+from django.db.models.functions import Coalesce, Greatest, Length, Substr
 from django.dispatch import receiver
 from django.urls import reverse
 from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 from django.utils.translation import ugettext_lazy as _
 
-from django_comments_tree.signals import comment_was_flagged
-from django_comments_tree import get_structured_data_class
+from django_comments_tree.signals import comment_was_flagged, comments_were_flagged
+from django_comments_tree import get_structured_data_class, signed
 
-from django.conf import settings as djsettings
 from django_comments_tree.conf import settings
-from treebeard.mp_tree import MP_Node, MP_NodeManager
+from django_comments_tree.utils import app_model_options, get_content_hash
+from treebeard.mp_tree import MP_Node, MP_NodeManager, MP_NodeQuerySet
 
 from .abstract import CommentAbstractModel
 
 LIKEDIT_FLAG = "I liked it"
 DISLIKEDIT_FLAG = "I disliked it"
 
+# Marks a comment whose counted state could not be read from its fields.
+UNKNOWN_STATE = object()
+
 
 def max_thread_level_for_content_type(content_type):
-    app_model = "%s.%s" % (content_type.app_label, content_type.model)
-    if app_model in settings.COMMENTS_TREE_MAX_THREAD_LEVEL_BY_APP_MODEL:
-        return settings.COMMENTS_TREE_MAX_THREAD_LEVEL_BY_APP_MODEL[app_model]
-    else:
-        return settings.COMMENTS_TREE_MAX_THREAD_LEVEL
+    return app_model_options.max_thread_level(content_type.pk)
 
 
 class MaxThreadLevelExceededException(Exception):
@@ -50,30 +50,168 @@ class MaxThreadLevelExceededException(Exception):
         return "Max thread level reached for comment %d" % self.comment.id
 
 
+class TreeCommentQuerySet(MP_NodeQuerySet):
+
+    def with_parent_id(self):
+        """
+        Annotate each comment with `parent_pk`, the id of its parent comment.
+
+        The parent path is the comment path minus its last step, so the
+        parent is found with an indexed lookup on path in the same query,
+        instead of a get_parent() query per comment. Top level comments,
+        whose parent is the root node, get None.
+        """
+        steplen = self.model.steplen
+        parents = self.model._default_manager.filter(
+            path=Substr(OuterRef('path'), 1, Length(OuterRef('path')) - steplen),
+            depth__gt=1)
+        return self.annotate(parent_pk=Subquery(parents.values('pk')[:1]))
+
+    def with_context(self, content_objects=True):
+        """
+        Join the association of each comment, with its content type and
+        site, so that `content_type`, `object_id`, `site` and
+        get_absolute_url() don't query per comment.
+
+        With `content_objects`, the commented objects are prefetched too,
+        grouped by content type like GenericForeignKey prefetches, so a
+        page of comments on objects of several models takes one more query
+        per model.
+        """
+        qs = self.select_related('assoc__content_type', 'assoc__site')
+        if content_objects:
+            qs = qs.prefetch_related('assoc__content_object')
+        return qs
+
+    def for_listing(self):
+        """
+        Read comments to list them, in the API, the comment tree and the
+        comment list view: with_context() without the commented objects,
+        the user joined too, and the LISTING_DEFERRED_FIELDS not loaded.
+        """
+        return (self.with_context(content_objects=False)
+                .select_related('user')
+                .defer(*self.model.LISTING_DEFERRED_FIELDS))
+
+
+class RootCache:
+    """
+    Map the (content_type_id, object_id, site_id) of commented objects to
+    the (assoc_id, root_id) of their comments.
+
+    Entries are kept in a process-local LRU, of
+    COMMENTS_TREE_ROOT_CACHE_SIZE entries, backed by the default cache
+    shared by all processes. They may outlive the rows they point to, so
+    users must check them against the database.
+    """
+
+    def __init__(self):
+        self.local = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def cache_key(key):
+        return "comments-tree-root-%s-%s-%s" % key
+
+    def get(self, key):
+        with self.lock:
+            entry = self.local.get(key)
+            if entry is not None:
+                self.local.move_to_end(key)
+                return entry
+        entry = cache.get(self.cache_key(key))
+        if entry is not None:
+            entry = tuple(entry)
+            self.set_local(key, entry)
+        return entry
+
+    def set(self, key, entry):
+        self.set_local(key, entry)
+        cache.set(self.cache_key(key), entry, None)
+
+    def set_local(self, key, entry):
+        with self.lock:
+            self.local[key] = entry
+            self.local.move_to_end(key)
+            while len(self.local) > settings.COMMENTS_TREE_ROOT_CACHE_SIZE:
+                self.local.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.local.pop(key, None)
+        cache.delete(self.cache_key(key))
+
+    def clear(self):
+        """ Empty the process-local tier """
+        with self.lock:
+            self.local.clear()
+
+
+root_cache = RootCache()
+
+
 class CommentManager(MP_NodeManager):
 
     def _validate_assoc(self, root, association):
-        if root.assoc is None:
+        if not CommentAssociation.content_type.is_cached(association):
+            # From the ContentType cache, for add_child().
+            association.content_type = ContentType.objects.get_for_id(
+                association.content_type_id)
+        if root.assoc_id is None:
             root.assoc = association
             root.save()
+        elif root.assoc_id == association.pk:
+            root.assoc = association
+
+    def _root_key(self, obj, site):
+        content_type = ContentType.objects.get_for_model(obj)
+        site_id = settings.SITE_ID if site is None else site.pk
+        return (content_type.pk, obj.pk, site_id)
+
+    def _cached_root(self, key):
+        """
+        Return the root cached for key, in one query, if it is still the
+        root of the object's comments.
+        """
+        entry = root_cache.get(key)
+        if entry is None:
+            return None
+        assoc_id, root_id = entry
+        try:
+            root = self.get_queryset().select_related(
+                'commentassociation__content_type').get(pk=root_id)
+            assoc = root.commentassociation
+        except ObjectDoesNotExist:
+            assoc = None
+        if (assoc is None or assoc.pk != assoc_id
+                or (assoc.content_type_id, assoc.object_id, assoc.site_id) != key):
+            root_cache.delete(key)
+            return None
+        self._validate_assoc(root, assoc)
+        return root
 
     def get_root(self, obj, site=None):
         """ Return the root for the given object """
-        if site is None:
-            site = Site.objects.get(pk=settings.SITE_ID)
+        key = self._root_key(obj, site)
+        root = self._cached_root(key)
+        if root is not None:
+            return root
 
+        content_type_id, object_id, site_id = key
         try:
-            ct = ContentType.objects.get_for_model(obj)
             qs = CommentAssociation.objects.select_related("root")
             assoc = qs.get(
-                content_type=ct,
-                object_id=obj.id,
-                site=site)
-
-            self._validate_assoc(assoc.root, assoc)
-            return assoc.root
+                content_type_id=content_type_id,
+                object_id=object_id,
+                site_id=site_id)
         except ObjectDoesNotExist:
             return None
+        if assoc.root is None:
+            return None
+
+        self._validate_assoc(assoc.root, assoc)
+        root_cache.set(key, (assoc.pk, assoc.root_id))
+        return assoc.root
 
     def get_or_create_root(self, obj, site=None):
         """
@@ -88,34 +226,57 @@ class CommentManager(MP_NodeManager):
 
         - Or not nested at all
 
+        Roots are looked up in root_cache first, so getting an existing
+        root usually takes one query. The association is created with
+        get_or_create, relying on its unique constraint, so concurrent
+        requests end up with the same root.
 
         :param obj:
         :param site:
         :return:
         """
-        ct = ContentType.objects.get_for_model(obj)
-
-        if site is None:
-            site = Site.objects.get(pk=settings.SITE_ID)
-
-        try:
-            assoc = CommentAssociation.objects.select_related("root").get(
-                content_type=ct,
-                object_id=obj.id,
-                site=site)
+        key = self._root_key(obj, site)
+        root = self._cached_root(key)
+        if root is not None:
+            return root
+
+        content_type_id, object_id, site_id = key
+        with transaction.atomic(using=self.db):
+            assoc, created = CommentAssociation.objects.select_related("root").get_or_create(
+                content_type_id=content_type_id,
+                object_id=object_id,
+                site_id=site_id)
+            if assoc.root_id is None:
+                # Lock the association, so that only one root is added to it.
+                assoc = CommentAssociation.objects.select_for_update().get(pk=assoc.pk)
+            if assoc.root_id is None:
+                root = TreeComment.add_root(assoc=assoc)
+                assoc.root = root
+                assoc.save(update_fields=['root'])
+                created = True
             self._validate_assoc(assoc.root, assoc)
-        except ObjectDoesNotExist:
-            root = TreeComment.add_root()
-            assoc = CommentAssociation.objects.create(content_type=ct,
-                                                      object_id=obj.id,
-                                                      content_object=obj,
-                                                      site=site,
-                                                      root=root)
-            root.assoc = assoc
-            root.save()
+
+        entry = (assoc.pk, assoc.root_id)
+        if created:
+            # Not before the new root is visible to other processes.
+            transaction.on_commit(lambda: root_cache.set(key, entry), using=self.db)
+        else:
+            root_cache.set(key, entry)
 
         return assoc.root
 
+    def duplicates_of(self, comment):
+        """
+        Comments on the same object as the TmpTreeComment `comment` that
+        have the same content hash.
+        """
+        return self.get_queryset().filter(
+            content_hash=comment.get_content_hash(),
+            assoc__content_type=comment.content_type,
+            assoc__object_id=comment.object_id,
+            assoc__site_id=comment.site_id,
+            depth__gt=1)
+
     def create_for_object(self, obj, **kwargs):
         root = self.get_or_create_root(obj)
         return root.add_child(**kwargs)
@@ -175,90 +336,78 @@ class CommentManager(MP_NodeManager):
 
         return qs
 
-    def count_for_content_types(self, content_types: List[str], site: int = None) -> int:
-        """ Retrieve a count of comments for the given list of content types """
-        qs = self.for_content_types(content_types=content_types, site=site)
-        return qs.count()
+    def _sum_counts(self, counter, content_types, object_id=None, site=None):
+        """ Add up a counter of the associations matching the arguments """
+        qs = CommentAssociation.objects.filter(content_type__in=content_types)
+        if object_id is not None:
+            qs = qs.filter(object_id=object_id)
+        if site is not None:
+            qs = qs.filter(site=site)
+        return qs.aggregate(count=Coalesce(Sum(counter), 0))['count']
 
-    def count_for_model(self, model, site: int = None) -> int:
+    def count_for_content_types(self, content_types: List[str], site: int = None) -> int:
         """ Retrieve a count of comments for the given list of content types """
+        return self._sum_counts('total_count', content_types, site=site)
 
-        qs = self.for_model(model=model, site=site)
-        return qs.count()
-
-    def get_queryset(self):
-        qs = super().get_queryset()
-        qs = qs.select_related(
-            'commentassociation', 'commentassociation__content_type')
-        return qs
-
-    def user_flags_for_model(self, user, model, content_type=None):
+    def count_for_model(self, model, site: int = None, public: bool = False) -> int:
         """
-        Retrieve a summary of flags for the given user and model
-
-        The return value is a dict with a list of comment id's that the user
-        has liked, disliked and reported.
-
-        The method returns a queryset, that should have 1 or 0 values
-
-        Use the result like this:
+        Retrieve a count of comments for a model (either an instance or a class).
+        Only public comments are counted if `public` is True.
+        """
+        content_type = ContentType.objects.get_for_model(model)
+        object_id = None
+        if isinstance(model, models.Model):
+            object_id = model._get_pk_val()
+        return self.count_for_object(content_type, object_id, site=site, public=public)
 
+    def count_for_object(self, content_type, object_id, site: int = None,
+                         public: bool = False) -> int:
+        """
+        Retrieve a count of comments for the object with the given content
+        type and id. Only public comments are counted if `public` is True.
 
-        qs = user_flags_for_model(...)
-        if len(qs):
-            return Response(qs[0])
+        The count is read from the counters stored in CommentAssociation.
+        """
+        counter = 'public_count' if public else 'total_count'
+        return self._sum_counts(counter, [content_type], object_id=object_id, site=site)
 
+    def get_queryset(self):
+        return TreeCommentQuerySet(self.model, using=self._db).order_by('path')
 
-        NOTE: qs.first() does not work the way you want.
+    def with_context(self, content_objects=True):
+        return self.get_queryset().with_context(content_objects=content_objects)
 
+    def for_listing(self):
+        return self.get_queryset().for_listing()
 
+    def user_flags_for_model(self, user, model, content_type=None):
         """
+        Retrieve a summary of flags for the given user and model
 
-        result = {'user': user.id, 'liked': [], 'disliked': [], 'reported': []}
-
-        if content_type is None:
-            content_type = ContentType.objects.get_for_model(model)
+        The return value is a dict with the lists of comment id's that the
+        user has liked, disliked and reported. `model` is either a model
+        instance, for the flags on its comments, or a model class, for the
+        flags on the comments of all its instances.
 
-        qs = TreeCommentFlag.objects
-        qs = qs.filter(user=user)
-        qs = qs.filter(comment__assoc__content_type=content_type)
+        For a model instance the lists are read from user_flag_index, in
+        one cache lookup when they are cached already. For a model class
+        they are read with one query.
+        """
         if isinstance(model, models.Model):
-            pk = model._get_pk_val()
-            qs = qs.filter(comment__assoc__object_id=pk)
-
-        if all([
-            postgres_available,
-            'postgres' in djsettings.DATABASES['default']['ENGINE']
-        ]):
-            # Okay to use postgres
-            qs = qs.values('user')  # This cause a crucial "group_by"
-
-            qs = qs.annotate(
-                liked=ArrayAgg(
-                    'comment__pk',
-                    filter=Q(flag=LIKEDIT_FLAG)))
-            qs = qs.annotate(
-                disliked=ArrayAgg(
-                    'comment__pk',
-                    filter=Q(flag=DISLIKEDIT_FLAG)))
-            qs = qs.annotate(
-                reported=ArrayAgg(
-                    'comment__pk',
-                    filter=Q(flag=TreeCommentFlag.SUGGEST_REMOVAL)))
-
-            if qs:
-                return qs[0]
+            key = self._root_key(model, None)
+            if content_type is not None:
+                key = (content_type.pk,) + key[1:]
+            entry = root_cache.get(key)
+            if entry is None:
+                root = self.get_root(model)
+                assoc_ids = [] if root is None else [root.assoc_id]
+            else:
+                assoc_ids = [entry[0]]
         else:
-            qs = qs.values('user', 'comment', 'flag')  # This cause a crucial "group_by"
-            result = {'user': user.id, 'liked': [], 'disliked': [], 'reported': []}
-            mm = {LIKEDIT_FLAG: 'liked',
-                  DISLIKEDIT_FLAG: 'disliked',
-                  TreeCommentFlag.SUGGEST_REMOVAL: 'reported'}
-            for q in qs.all():
-                key = mm[q['flag']]
-                result[key].append(q['comment'])
-
-        return result
+            if content_type is None:
+                content_type = ContentType.objects.get_for_model(model)
+            return user_flag_index.load(user, comment__assoc__content_type=content_type)
+        return user_flag_index.get(user, assoc_ids)
 
 
 class CommentAssociation(models.Model):
@@ -292,10 +441,97 @@ class CommentAssociation(models.Model):
     # Metadata about the comment
     site = models.ForeignKey(Site, on_delete=models.CASCADE)
 
+    # Comment counters, kept up to date by TreeComment.save() and the
+    # post_delete handler below. The root node is not counted.
+    public_count = models.PositiveIntegerField(default=0, editable=False)
+    total_count = models.PositiveIntegerField(default=0, editable=False)
+    pending_count = models.PositiveIntegerField(default=0, editable=False)
+    last_activity = models.DateTimeField(null=True, blank=True, editable=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['content_type', 'object_id', 'site'],
+                                    name='comments_tree_assoc_object_uniq'),
+        ]
+
     @property
     def object_pk(self):
         return str(self.object_id)
 
+    @staticmethod
+    def counters_for(is_public, is_removed):
+        """ Return the counters a comment in the given state is counted in """
+        if is_public:
+            return ('total_count', 'public_count')
+        elif not is_removed:
+            return ('total_count', 'pending_count')
+        return ('total_count',)
+
+    @classmethod
+    def update_counts(cls, assoc_id, deltas):
+        """
+        Apply the deltas, a dict of counter name to increment, to the counters
+        of the given association, and mark it as active now.
+        """
+        updates = {counter: Greatest(F(counter) + delta, 0)
+                   for counter, delta in deltas.items() if delta}
+        updates['last_activity'] = timezone.now()
+        cls.objects.filter(pk=assoc_id).update(**updates)
+
+    @staticmethod
+    def cache_version_key(content_type_id, object_id, site_id):
+        return "comments-tree-version-%s-%s-%s" % (content_type_id, object_id, site_id)
+
+    @classmethod
+    def get_cache_version(cls, content_type_id, object_id, site_id):
+        """
+        Return the version of the cached API responses for the comments of an
+        object. It is part of the cache keys, so bumping it invalidates them.
+        """
+        key = cls.cache_version_key(content_type_id, object_id, site_id)
+        version = cache.get(key)
+        if version is None:
+            # Start from the clock, so that a version lost to eviction does
+            # not start over from a value already used in cache keys.
+            cache.add(key, int(time.time() * 1000), None)
+            version = cache.get(key)
+        return version
+
+    def bump_cache_version(self):
+        """
+        Invalidate the cached API responses for the comments of this
+        association, once the current transaction commits.
+        """
+        key = self.cache_version_key(self.content_type_id, self.object_id, self.site_id)
+
+        def bump():
+            try:
+                cache.incr(key)
+            except ValueError:
+                cache.add(key, int(time.time() * 1000), None)
+
+        transaction.on_commit(bump)
+
+    @classmethod
+    def bump_cache_versions(cls, assoc_ids):
+        """ Call bump_cache_version() for the associations with the given ids """
+        if assoc_ids:
+            for assoc in cls.objects.filter(pk__in=assoc_ids).only(
+                    'content_type_id', 'object_id', 'site_id'):
+                assoc.bump_cache_version()
+
+    def refresh_counts(self):
+        """ Recount the comments of this association and store the counters """
+        counts = TreeComment.objects.filter(assoc=self, depth__gt=1).order_by().aggregate(
+            total_count=Count('pk'),
+            public_count=Count('pk', filter=Q(is_public=True)),
+            pending_count=Count('pk', filter=Q(is_public=False, is_removed=False)),
+        )
+        counts['last_activity'] = timezone.now()
+        CommentAssociation.objects.filter(pk=self.pk).update(**counts)
+        for name, value in counts.items():
+            setattr(self, name, value)
+
     def __str__(self):
         return (f"CommentAssociation pk={self.pk} "
                 f"oid={self.object_id} ct_id={self.content_type_id} root_id={self.root_id}")
@@ -335,14 +571,97 @@ class TreeComment(MP_Node, CommentAbstractModel):
                               blank=True,
                               null=True)
 
+    # Digest of the author, text and day of the comment, see
+    # utils.get_content_hash. Used to find duplicated comments.
+    content_hash = models.CharField(max_length=32, blank=True, editable=False)
+
     def __init__(self, *args, **kwargs):
         self._association = None
+        self._counted_as = None
         super().__init__(*args, **kwargs)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._counted_as = instance._counted_state()
+        return instance
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self._counted_as = self._counted_state()
+
+    def _counted_state(self):
+        """
+        Return (assoc_id, counters) for the association counters this comment
+        is part of, None if it is not counted, or UNKNOWN_STATE when the
+        fields needed to tell were deferred.
+        """
+        if not {'depth', 'assoc_id', 'is_public', 'is_removed'} <= self.__dict__.keys():
+            return UNKNOWN_STATE
+        if self.depth is None or self.depth <= 1 or self.assoc_id is None:
+            return None
+        return (self.assoc_id,
+                CommentAssociation.counters_for(self.is_public, self.is_removed))
+
+    def _update_assoc_counts(self):
+        """
+        Move this comment between association counters as its state changed.
+        Return the ids of the associations affected.
+        """
+        old, new = self._counted_as, self._counted_state()
+        self._counted_as = new
+        if old is UNKNOWN_STATE or new is UNKNOWN_STATE:
+            assoc_ids = {self.assoc_id} if self.assoc_id else set()
+            for assoc in CommentAssociation.objects.filter(pk__in=assoc_ids):
+                assoc.refresh_counts()
+            return assoc_ids
+
+        deltas = defaultdict(Counter)
+        if old is not None:
+            for counter in old[1]:
+                deltas[old[0]][counter] -= 1
+        if new is not None:
+            for counter in new[1]:
+                deltas[new[0]][counter] += 1
+        for assoc_id, assoc_deltas in deltas.items():
+            CommentAssociation.update_counts(assoc_id, assoc_deltas)
+        return set(deltas)
+
     followup = models.BooleanField(blank=True, default=False,
                                    help_text=_("Notify follow-up comments"))
+
+    # Flag counters. They are maintained by TreeCommentFlag.objects, and
+    # can be rebuilt with the 'rebuild_flag_counters' management command.
+    likes_count = models.PositiveIntegerField(default=0, editable=False)
+    dislikes_count = models.PositiveIntegerField(default=0, editable=False)
+    reports_count = models.PositiveIntegerField(default=0, editable=False)
+
+    COUNTER_FIELDS = ('likes_count', 'dislikes_count', 'reports_count')
+
+    # Association columns the serializers and templates listing comments
+    # never read. The comment's own columns are all loaded: markupfield gives
+    # comment_markup_type and _comment_rendered the creation_counter of
+    # submit_date and updated_on, so Django can't tell them apart and both
+    # only() and defer() on this model drop one of each pair.
+    LISTING_DEFERRED_FIELDS = (
+        'assoc__root', 'assoc__public_count', 'assoc__total_count',
+        'assoc__pending_count', 'assoc__last_activity',
+    )
+
+    CONTENT_HASH_FIELDS = ('user_name', 'user_email', 'comment', 'submit_date')
+
     objects = CommentManager()
 
+    class Meta:
+        indexes = [
+            # Public comments of an object, in tree order.
+            models.Index(fields=['assoc', 'is_public', 'path'],
+                         name='comments_tree_assoc_pub_path'),
+            # Duplicates of a comment, see CommentManager.duplicates_of.
+            models.Index(fields=['content_hash', 'assoc'],
+                         name='comments_tree_content_hash'),
+        ]
+
     def add_child(self, *args, comment=None, **kwargs):
         """
         Add a new comment.
@@ -356,8 +675,7 @@ class TreeComment(MP_Node, CommentAbstractModel):
         if depth > settings.COMMENTS_TREE_MAX_THREAD_LEVEL:
             raise MaxThreadLevelExceededException(self)
 
-        max_level = max_thread_level_for_content_type(
-            self.assoc.content_type)
+        max_level = app_model_options.max_thread_level(self.assoc.content_type_id)
         if max_level and self.thread_level > max_level:
             raise MaxThreadLevelExceededException(self)
 
@@ -375,8 +693,43 @@ class TreeComment(MP_Node, CommentAbstractModel):
     def save(self, *args, **kwargs):
         """
         Save a TreeComment
+
+        The flag counters are only written when the comment is created.
+        They are updated in place with F() expressions, so the values held
+        by this instance may be stale and must not overwrite them.
+
+        Saving an existing comment sets its updated_on date, which is what
+        the comment list API uses to tell clients what changed.
+
+        The content hash is computed again whenever the fields it digests
+        are saved.
         """
-        super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or set(update_fields) & set(self.CONTENT_HASH_FIELDS):
+            if set(self.CONTENT_HASH_FIELDS) <= self.__dict__.keys():
+                self.content_hash = get_content_hash(
+                    *(self.__dict__[f] for f in self.CONTENT_HASH_FIELDS))
+                if update_fields and 'content_hash' not in update_fields:
+                    kwargs['update_fields'] = list(update_fields) + ['content_hash']
+        if not self._state.adding:
+            self.updated_on = timezone.now()
+            update_fields = kwargs.get('update_fields')
+            if update_fields is None:
+                deferred = self.get_deferred_fields()
+                kwargs['update_fields'] = [
+                    f.name for f in self._meta.concrete_fields
+                    if not f.primary_key and f.name not in self.COUNTER_FIELDS
+                    and f.attname not in deferred
+                ]
+            elif update_fields and 'updated_on' not in update_fields:
+                kwargs['update_fields'] = list(update_fields) + ['updated_on']
+        with transaction.atomic(using=kwargs.get('using'), savepoint=False):
+            super().save(*args, **kwargs)
+            assoc_ids = self._update_assoc_counts()
+            if self.assoc_id in assoc_ids and TreeComment.assoc.is_cached(self):
+                assoc_ids.discard(self.assoc_id)
+                self.assoc.bump_cache_version()
+            CommentAssociation.bump_cache_versions(assoc_ids)
 
     def update_assoc(self):
         """ Set or update the assoc value """
@@ -390,7 +743,8 @@ class TreeComment(MP_Node, CommentAbstractModel):
         return reverse("comments-tree-reply", kwargs={"cid": self.pk})
 
     def allow_thread(self):
-        if self.get_depth() < max_thread_level_for_content_type(self.content_type):
+        assoc = self.association
+        if self.get_depth() < app_model_options.max_thread_level(assoc.content_type_id):
             return True
         else:
             return False
@@ -424,6 +778,9 @@ class TreeComment(MP_Node, CommentAbstractModel):
         """
         assoc = self.association
         if assoc:
+            if not CommentAssociation.content_type.is_cached(assoc):
+                # From the ContentType cache, instead of a query per comment.
+                assoc.content_type = ContentType.objects.get_for_id(assoc.content_type_id)
             return assoc.content_type
 
         return None
@@ -439,15 +796,13 @@ class TreeComment(MP_Node, CommentAbstractModel):
 
     @property
     def content_object(self):
-        """ Get and return the object associated with this comment stream """
+        """
+        Get and return the object associated with this comment stream.
+        It is cached on the association, or prefetched with with_context().
+        """
         assoc = self.association
         if assoc:
-            ct = assoc.content_type
-            try:
-                return ct.get_object_for_this_type(
-                    pk=assoc.object_id)
-            except ObjectDoesNotExist:
-                pass
+            return assoc.content_object
 
         return None
 
@@ -471,56 +826,41 @@ class TreeComment(MP_Node, CommentAbstractModel):
         :return:
         """
 
-        # Build a path lookup table
-        # Faster than using node.get_parent(), which can cause another query
-        path_to_node = {c.path: c for c in queryset}
-
-        def parent_id_for(cnode):
-            basepath = cnode._get_basepath(cnode.path, cnode.depth - 1)
-            if basepath in path_to_node:
-                return path_to_node.get(basepath).id
-            return None
-
-        # Now I can build the data structure directly
+        # Single pass over the rows. Each node is indexed by its path, and the
+        # parent is found by stripping the last step off the path, so there is
+        # no need for node.get_parent() or for scanning the index per node.
+        # Rows whose parent shows up later in the queryset wait in `orphans`
+        # until it does, so any ordering of the queryset is supported.
+        steplen = cls.steplen
+        data_class = get_structured_data_class()
         flat_data = []
-        by_id = {}
-        details_by_id = {}  # Store data that I don't want to send to client
+        path_to_data = {}
+        orphans = {}
         for c in queryset:
-            data = get_structured_data_class()(
+            data = data_class(
                 id=c.id,
                 comment=c.comment.raw,
                 comment_rendered=c.comment.rendered,
-                parent_id=parent_id_for(c),
+                likes=c.likes_count,
+                parent_id=None,
                 depth=c.depth - 1,
             )
 
             if annotate_cb:
                 data = annotate_cb(c, data)
             flat_data.append(data)
-            by_id[c.id] = data
-            details_by_id[c.id] = {
-                'path': c.path,
-                'depth': c.depth,
-            }
-
-        if queryset.count() == 0:
-            return {'comments': []}
-
-        # Now, build the tree structure... a bit trickier
-        steplen = queryset[0].steplen
-
-        def get_child_ids(node):
-            details = details_by_id.get(node.id)
-            path = details.get("path")
-            depth = details.get("depth")
-            keys = [k for k in path_to_node.keys()
-                    if (not path or k.startswith(path))
-                    and len(k) / steplen == depth + 1]
+            path_to_data[c.path] = data
 
-            return [path_to_node[k].id for k in keys]
+            for child in orphans.pop(c.path, ()):
+                child.parent_id = data.id
+                data.children.append(child.id)
 
-        for node in flat_data:
-            node.children = get_child_ids(node)
+            parent = path_to_data.get(c.path[:-steplen])
+            if parent is not None:
+                data.parent_id = parent.id
+                parent.children.append(data.id)
+            else:
+                orphans.setdefault(c.path[:-steplen], []).append(data)
 
         return {'comments': flat_data}
 
@@ -558,36 +898,37 @@ class TreeComment(MP_Node, CommentAbstractModel):
         """
         Return a recursive structure with comments and their children,
         starting at the given root.
+
+        All the descendants are read in one query, ordered by depth, so
+        that every parent is seen before its children. Comments whose
+        parent was filtered out are left out too. When given, max_depth
+        is the number of levels below the root to include.
         """
-        print(f"Current Depth: {root.depth}")
-        retval = []
-        children = root.get_children().order_by('submit_date')
+        # Not get_descendants(), which trusts a possibly stale numchild.
+        nodes = cls.objects.for_listing().filter(path__startswith=root.path,
+                                                 depth__gt=root.depth)
         if filter_public:
-            children = children.filter(is_public=True)
-
+            nodes = nodes.filter(is_public=True)
         if start:
-            time_range = Q(updated_on__gt=start)
-            if end:
-                time_range = time_range & Q(updated_on__lt=end)
-            children = children.filter(time_range)
-        for child in children:
-            if (child.numchild > 0
-                    and (max_depth is None or root.depth > max_depth)):
-                my_children = cls.tree_from_comment(
-                    child,
-                    filter_public=filter_public,
-                    start=start,
-                    end=end,
-                    max_depth=max_depth
-                )
-            else:
-                my_children = []
+            nodes = nodes.filter(updated_on__gt=start)
+        if end:
+            nodes = nodes.filter(updated_on__lt=end)
+        if max_depth is not None:
+            nodes = nodes.filter(depth__lte=root.depth + max_depth)
+        nodes = nodes.order_by('depth', 'submit_date', 'path')
+
+        retval = []
+        children_of = {root.path: retval}
+        for node in nodes:
+            siblings = children_of.get(node.path[:-cls.steplen])
+            if siblings is None:
+                continue
             data = {
-                "comment": child,
-                "children": my_children
+                "comment": node,
+                "children": []
             }
-
-            retval.append(data)
+            children_of[node.path] = data["children"]
+            siblings.append(data)
         return retval
 
     @classmethod
@@ -607,7 +948,49 @@ class TreeComment(MP_Node, CommentAbstractModel):
 @receiver(comment_was_flagged)
 def unpublish_nested_comments_on_removal_flag(sender, comment, flag, **kwargs):
     if flag.flag == TreeCommentFlag.MODERATOR_DELETION:
-        comment.get_descendants().update(is_public=False)
+        comment.get_descendants().update(is_public=False,
+                                         updated_on=timezone.now())
+        if comment.assoc is not None:
+            comment.assoc.refresh_counts()
+            comment.assoc.bump_cache_version()
+
+
+@receiver(comments_were_flagged)
+def unpublish_nested_comments_on_bulk_removal(sender, comment_ids, flag, **kwargs):
+    """
+    Unpublish the replies to comments removed together. The counters of
+    their associations are left to the sender to refresh, once.
+    """
+    if flag != TreeCommentFlag.MODERATOR_DELETION or not comment_ids:
+        return
+    paths = sorted(TreeComment.objects.filter(pk__in=comment_ids)
+                   .values_list('path', flat=True))
+    # Replies to replies are already covered by the path of their ancestor.
+    tops = []
+    for path in paths:
+        if not tops or not path.startswith(tops[-1]):
+            tops.append(path)
+    now = timezone.now()
+    for i in range(0, len(tops), 100):
+        q = Q()
+        for path in tops[i:i + 100]:
+            q |= Q(path__startswith=path, depth__gt=len(path) // TreeComment.steplen)
+        TreeComment.objects.filter(q).update(is_public=False, updated_on=now)
+
+
+@receiver(post_delete, sender=TreeComment)
+def uncount_deleted_comment(sender, instance, **kwargs):
+    state = instance._counted_as
+    if state is UNKNOWN_STATE:
+        state = instance._counted_state()
+    if state and state is not UNKNOWN_STATE:
+        CommentAssociation.update_counts(state[0], {c: -1 for c in state[1]})
+        CommentAssociation.bump_cache_versions([state[0]])
+
+
+@receiver(post_delete, sender=CommentAssociation)
+def forget_deleted_association(sender, instance, **kwargs):
+    root_cache.delete((instance.content_type_id, instance.object_id, instance.site_id))
 
 
 class DummyDefaultManager:
@@ -624,7 +1007,11 @@ class DummyDefaultManager:
 
 class TmpTreeComment(dict):
     """
-    Temporary TreeComment to be pickled, zipped and appended to a URL.
+    Temporary TreeComment to be signed, zipped and appended to a URL.
+
+    Only the primary keys of related objects go into the signed key. The
+    content type, the commented object and the user are fetched from the
+    database the first time they are used.
     """
     _default_manager = DummyDefaultManager()
 
@@ -644,9 +1031,26 @@ class TmpTreeComment(dict):
     def __setattr__(self, key, value):
         self[key] = value
 
+    def __missing__(self, key):
+        if key == 'content_type' and 'content_type_key' in self:
+            value = ContentType.objects.get_by_natural_key(*self['content_type_key'])
+        elif key == 'content_object' and 'object_id' in self:
+            value = self.content_type.get_object_for_this_type(pk=self['object_id'])
+        elif key == 'user' and self.get('user_id'):
+            user_model = TreeComment._meta.get_field('user').related_model
+            value = user_model._default_manager.get(pk=self['user_id'])
+        else:
+            raise KeyError(key)
+        self[key] = value
+        return value
+
     def save(self, *args, **kwargs):
         pass
 
+    def get_content_hash(self):
+        return get_content_hash(self.user_name, self.user_email,
+                                self.comment, self.submit_date)
+
     def _get_pk_val(self):
         if self.tree_comment:
             return self.tree_comment._get_pk_val()
@@ -671,6 +1075,52 @@ class TmpTreeComment(dict):
         state['content_type_key'] = ct.natural_key()
         return (TmpTreeComment, (), state,)
 
+    def to_token(self):
+        """ Return the signed key of the comment, used to confirm it """
+        data = {}
+        for key, value in self.items():
+            if key in ('content_object', 'tree_comment', 'user'):
+                continue
+            if key == 'content_type':
+                key, value = 'content_type_key', value.natural_key()
+            elif isinstance(value, datetime.date):
+                value = value.isoformat()
+            data[key] = value
+        user = self.get('user')
+        if user is not None and user.pk is not None:
+            data['user_id'] = user.pk
+        return signed.dumps(data, compress=True,
+                            extra_key=settings.COMMENTS_TREE_SALT)
+
+    @classmethod
+    def from_token(cls, key, max_age=None):
+        """
+        Return the comment signed in the key. Raise ValueError if the key
+        is not valid, or if the comment was submitted more than max_age
+        seconds ago.
+        """
+        data = signed.loads(key, extra_key=settings.COMMENTS_TREE_SALT)
+        if isinstance(data, cls):
+            comment = data  # Pickled by earlier versions.
+        elif not isinstance(data, dict):
+            raise ValueError("The key does not hold a comment.")
+        else:
+            comment = cls(data)
+            for key, value in data.items():
+                try:
+                    field = TreeComment._meta.get_field(key)
+                except FieldDoesNotExist:
+                    continue
+                if value and isinstance(field, models.DateTimeField):
+                    comment[key] = parse_datetime(value)
+                elif value and isinstance(field, models.DateField):
+                    comment[key] = parse_date(value)
+        if max_age is not None:
+            age = timezone.now() - comment.submit_date
+            if age > datetime.timedelta(seconds=max_age):
+                raise ValueError("The key has expired.")
+        return comment
+
 
 # ----------------------------------------------------------------------
 class BlackListedDomain(models.Model):
@@ -692,6 +1142,320 @@ class BlackListedDomain(models.Model):
         ordering = ('domain',)
 
 
+class DomainBlacklist:
+    """
+    In-process set of the BlackListedDomain domains.
+
+    An email domain is blacklisted when it or any of its parent domains is
+    in the set, so checking it takes one set lookup per label. The set is
+    loaded on first use, and loaded again when the blacklist version in
+    the default cache changes. The version is bumped whenever blacklisted
+    domains are saved or deleted.
+    """
+    version_key = "comments-tree-blacklist-version"
+
+    def __init__(self):
+        self._domains = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(domain):
+        return domain.strip().strip('.').lower()
+
+    def get_version(self):
+        version = cache.get(self.version_key)
+        if version is None:
+            cache.add(self.version_key, int(time.time() * 1000), None)
+            version = cache.get(self.version_key)
+        return version
+
+    def bump_version(self):
+        """
+        Make every process load the blacklist again, once the current
+        transaction commits.
+        """
+        self._domains = None
+
+        def bump():
+            try:
+                cache.incr(self.version_key)
+            except ValueError:
+                cache.add(self.version_key, int(time.time() * 1000), None)
+
+        transaction.on_commit(bump)
+
+    def get_domains(self):
+        version = self.get_version()
+        domains = self._domains
+        # Without a shared version to compare with, load it every time.
+        if domains is None or version is None or version != self._version:
+            with self._lock:
+                domains = frozenset(
+                    self.normalize(domain) for domain in
+                    BlackListedDomain.objects.values_list('domain', flat=True).iterator())
+                self._domains, self._version = domains, version
+        return domains
+
+    def __contains__(self, domain):
+        labels = self.normalize(domain).split('.')
+        domains = self.get_domains()
+        return any('.'.join(labels[i:]) in domains for i in range(len(labels)))
+
+
+domain_blacklist = DomainBlacklist()
+
+
+@receiver(post_save, sender=BlackListedDomain)
+@receiver(post_delete, sender=BlackListedDomain)
+def forget_blacklist(sender, **kwargs):
+    domain_blacklist.bump_version()
+
+
+class TreeCommentFlagManager(models.Manager):
+    """
+    Create and delete flags while keeping the counters on TreeComment
+    in step. Flags without a counter are created and deleted as usual.
+    """
+
+    def _update_counter(self, comment_id, flag, delta, comment=None):
+        counter = TreeCommentFlag.COUNTERS.get(flag)
+        if counter is None:
+            return
+        qs = TreeComment.objects.filter(pk=comment_id)
+        if delta < 0:
+            qs = qs.filter(**{'%s__gte' % counter: -delta})
+        qs.update(**{counter: F(counter) + delta})
+        # Keep the instance at hand roughly in step, without a query.
+        if comment is not None and counter in comment.__dict__:
+            setattr(comment, counter, max(getattr(comment, counter) + delta, 0))
+
+    def add_flag(self, comment, user, flag):
+        """
+        Flag the comment on behalf of the user. Return a tuple (flag, created).
+        """
+        with transaction.atomic(using=self.db):
+            obj, created = self.get_or_create(comment=comment, user=user, flag=flag)
+            if created:
+                self._update_counter(comment.pk, flag, 1, comment)
+                CommentAssociation.bump_cache_versions([comment.assoc_id])
+        return obj, created
+
+    def toggle_flag(self, comment, user, flag, opposite=()):
+        """
+        Flag the comment on behalf of the user, or remove the flag if the
+        user had already set it. Adding the flag removes the user's flags
+        of the `opposite` kinds, like a like removes a dislike. Return a
+        tuple (flag, created).
+
+        Everything runs in one transaction, with the counters updated in
+        the same batch. On PostgreSQL it is a single statement.
+        """
+        connection = connections[self.db]
+        flags = [flag] + [f for f in opposite if f != flag]
+        now = timezone.now()
+        with transaction.atomic(using=self.db):
+            if connection.vendor == 'postgresql':
+                obj, deltas = self._toggle_flag_statement(
+                    connection, comment, user, flag, flags, now)
+            else:
+                obj, deltas = self._toggle_flag_queries(
+                    connection, comment, user, flag, flags, now)
+            if TreeComment.assoc.is_cached(comment) and comment.assoc is not None:
+                comment.assoc.bump_cache_version()
+            else:
+                CommentAssociation.bump_cache_versions([comment.assoc_id])
+        # Keep the instance at hand roughly in step, without a query.
+        for f, delta in deltas.items():
+            counter = TreeCommentFlag.COUNTERS.get(f)
+            if counter in comment.__dict__:
+                setattr(comment, counter, max(getattr(comment, counter) + delta, 0))
+        if obj is None:
+            obj = TreeCommentFlag(comment=comment, user=user, flag=flag, flag_date=now)
+        return obj, deltas.get(flag, 0) > 0
+
+    @staticmethod
+    def _toggle_deltas(flag, removed):
+        """ Return the {flag: delta} changes of a toggle, given the flags removed """
+        deltas = {f: -1 for f in removed}
+        deltas.setdefault(flag, 1)
+        return deltas
+
+    def _toggle_flag_queries(self, connection, comment, user, flag, flags, now):
+        """
+        Delete the user's `flags` on the comment, insert `flag` unless it
+        was among them and update the counters. Concurrent toggles of the
+        comment wait for the lock on its row, where the database has row
+        locks. Return the new flag, if any, and the deltas.
+        """
+        if connection.features.has_select_for_update:
+            list(TreeComment.objects.using(self.db).select_for_update()
+                 .filter(pk=comment.pk).values_list('pk'))
+        removed = []
+        for obj in self.filter(comment=comment, user=user, flag__in=flags):
+            obj.comment = comment
+            obj.delete()
+            removed.append(obj.flag)
+        obj = None
+        deltas = self._toggle_deltas(flag, removed)
+        if flag not in removed:
+            try:
+                with transaction.atomic(using=self.db):
+                    obj = self.create(comment=comment, user=user, flag=flag,
+                                      flag_date=now)
+            except IntegrityError:
+                # Inserted concurrently, where rows can't be locked.
+                deltas.pop(flag)
+        counters = {TreeCommentFlag.COUNTERS[f]: delta for f, delta in deltas.items()
+                    if f in TreeCommentFlag.COUNTERS}
+        if counters:
+            TreeComment.objects.filter(pk=comment.pk).update(**{
+                counter: Greatest(F(counter) + delta, 0)
+                for counter, delta in counters.items()})
+        return obj, deltas
+
+    def _toggle_flag_statement(self, connection, comment, user, flag, flags, now):
+        """
+        Same as _toggle_flag_queries() in one statement, for PostgreSQL.
+        The flags are deleted and inserted with data-modifying WITH
+        queries, and the counters are updated from what they returned.
+        The post_delete and post_save signals are sent afterwards, as the
+        ORM would send them.
+        """
+        comment_id, user_id = comment.pk, user.pk
+        qn = connection.ops.quote_name
+        meta = TreeCommentFlag._meta
+        counted = [f for f in flags if f in TreeCommentFlag.COUNTERS]
+        updates = ', '.join(
+            '{0} = GREATEST({0} + (SELECT COUNT(*) FROM inserted WHERE {{flag}} = %s)'
+            ' - (SELECT COUNT(*) FROM removed WHERE {{flag}} = %s), 0)'.format(
+                qn(TreeCommentFlag.COUNTERS[f]))
+            for f in counted)
+        sql = (
+            'WITH removed AS ('
+            ' DELETE FROM {flags} WHERE {comment} = %s AND {user} = %s'
+            ' AND {flag} = ANY(%s) RETURNING {pk}, {flag}'
+            '), inserted AS ('
+            ' INSERT INTO {flags} ({comment}, {user}, {flag}, {flag_date})'
+            ' SELECT %s, %s, %s, %s'
+            ' WHERE NOT EXISTS (SELECT 1 FROM removed WHERE {flag} = %s)'
+            ' ON CONFLICT DO NOTHING RETURNING {pk}, {flag}'
+            ')'
+        )
+        params = [comment_id, user_id, flags, comment_id, user_id, flag, now, flag]
+        if updates:
+            sql += ', counted AS (UPDATE {comments} SET ' + updates + ' WHERE {comment_pk} = %s)'
+            for f in counted:
+                params += [f, f]
+            params.append(comment_id)
+        sql += (' SELECT (SELECT {pk} FROM inserted),'
+                ' ARRAY(SELECT {pk} FROM removed), ARRAY(SELECT {flag} FROM removed)')
+        sql = sql.format(
+            flags=qn(meta.db_table),
+            pk=qn(meta.pk.column),
+            comment=qn(meta.get_field('comment').column),
+            user=qn(meta.get_field('user').column),
+            flag=qn(meta.get_field('flag').column),
+            flag_date=qn(meta.get_field('flag_date').column),
+            comments=qn(TreeComment._meta.db_table),
+            comment_pk=qn(TreeComment._meta.pk.column),
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            flag_id, removed_ids, removed = cursor.fetchone()
+        deltas = self._toggle_deltas(flag, removed)
+        for pk, removed_flag in zip(removed_ids, removed):
+            post_delete.send(sender=TreeCommentFlag, using=self.db,
+                             instance=TreeCommentFlag(pk=pk, comment=comment, user=user,
+                                                      flag=removed_flag))
+        obj = None
+        if flag_id is not None:
+            obj = TreeCommentFlag(pk=flag_id, comment=comment, user=user,
+                                  flag=flag, flag_date=now)
+            obj._state.adding = False
+            obj._state.db = self.db
+            post_save.send(sender=TreeCommentFlag, instance=obj, created=True,
+                           update_fields=None, raw=False, using=self.db)
+        elif flag not in removed:
+            # Inserted concurrently, by another toggle of the same user.
+            deltas.pop(flag)
+        return obj, deltas
+
+    def add_flags(self, comment_ids, user, flag):
+        """
+        Flag many comments on behalf of the user with a few queries. Return
+        the ids of the comments that didn't have the flag yet.
+
+        The comments are locked first, where the database has row locks,
+        and only the flags actually inserted are counted: those carrying
+        this call's flag_date.
+        """
+        comment_ids = set(comment_ids)
+        with transaction.atomic(using=self.db):
+            if connections[self.db].features.has_select_for_update:
+                list(TreeComment.objects.using(self.db).select_for_update()
+                     .filter(pk__in=comment_ids).order_by('pk').values_list('pk'))
+            comment_ids.difference_update(
+                self.filter(comment__in=comment_ids, user=user, flag=flag)
+                .values_list('comment', flat=True))
+            now = timezone.now()
+            self.bulk_create([
+                TreeCommentFlag(comment_id=pk, user=user, flag=flag, flag_date=now)
+                for pk in sorted(comment_ids)
+            ], ignore_conflicts=True)
+            if comment_ids:
+                # Flags inserted concurrently were ignored by the insert.
+                comment_ids = set(
+                    self.filter(comment__in=comment_ids, user=user, flag=flag,
+                                flag_date=now).values_list('comment', flat=True))
+            counter = TreeCommentFlag.COUNTERS.get(flag)
+            if counter is not None and comment_ids:
+                TreeComment.objects.filter(pk__in=comment_ids).update(
+                    **{counter: F(counter) + 1})
+        return sorted(comment_ids)
+
+    def remove_flag(self, obj):
+        """
+        Delete the given flag. Return True if it was still in the database.
+        """
+        with transaction.atomic(using=self.db):
+            deleted, _ = self.filter(pk=obj.pk).delete()
+            if deleted:
+                self._update_counter(obj.comment_id, obj.flag, -deleted)
+                CommentAssociation.bump_cache_versions(list(
+                    TreeComment.objects.filter(pk=obj.comment_id)
+                    .values_list('assoc', flat=True)))
+        return bool(deleted)
+
+    def remove_flags(self, comment, user, flags):
+        """
+        Delete the user's flags of the given kinds from the comment.
+        """
+        with transaction.atomic(using=self.db):
+            for flag in flags:
+                deleted, _ = self.filter(comment=comment, user=user, flag=flag).delete()
+                if deleted:
+                    self._update_counter(comment.pk, flag, -deleted, comment)
+                    CommentAssociation.bump_cache_versions([comment.assoc_id])
+
+    def rebuild_counters(self, comments=None):
+        """
+        Recount the flags of the given comments, all of them by default, and
+        store the results in their counter fields. Return the number of
+        comments updated.
+        """
+        if comments is None:
+            comments = TreeComment.objects.all()
+        counts = {}
+        for flag, counter in TreeCommentFlag.COUNTERS.items():
+            subquery = (self.filter(comment=OuterRef('pk'), flag=flag)
+                        .order_by().values('comment')
+                        .annotate(count=Count('pk')).values('count'))
+            counts[counter] = Coalesce(
+                Subquery(subquery, output_field=models.PositiveIntegerField()), 0)
+        return comments.order_by().update(**counts)
+
+
 class TreeCommentFlag(models.Model):
     """
     Records a flag on a comment. This is intentionally flexible; right now, a
@@ -728,8 +1492,21 @@ class TreeCommentFlag(models.Model):
 
     MODERATOR_APPROVAL = "moderator approval"
 
+    # Flags counted in TreeComment fields.
+    COUNTERS = {
+        LIKEDIT_FLAG: 'likes_count',
+        DISLIKEDIT_FLAG: 'dislikes_count',
+        SUGGEST_REMOVAL: 'reports_count',
+    }
+
+    objects = TreeCommentFlagManager()
+
     class Meta:
         unique_together = [('user', 'comment', 'flag')]
+        indexes = [
+            models.Index(fields=['comment', 'flag'],
+                         name='comments_tree_flag_comment'),
+        ]
         verbose_name = _('comment flag')
         verbose_name_plural = _('comment flags')
 
@@ -742,3 +1519,110 @@ class TreeCommentFlag(models.Model):
         if self.flag_date is None:
             self.flag_date = timezone.now()
         super().save(*args, **kwargs)
+
+
+class UserFlagIndex:
+    """
+    Ids of the comments each user liked, disliked and reported, per
+    association.
+
+    Entries are kept in the default cache, one per user and association,
+    for COMMENTS_TREE_USER_FLAGS_CACHE_TIMEOUT seconds, and loaded from the
+    database for all the missing associations at once. Users without flags
+    on an association get no entry, so the cache only grows with the
+    flags. Entries are deleted whenever the user's flags on comments of
+    the association are saved or deleted.
+    """
+    FLAGS = {
+        LIKEDIT_FLAG: 'liked',
+        DISLIKEDIT_FLAG: 'disliked',
+        TreeCommentFlag.SUGGEST_REMOVAL: 'reported',
+    }
+
+    @staticmethod
+    def cache_key(user_id, assoc_id):
+        return "comments-tree-user-flags-%s-%s" % (user_id, assoc_id)
+
+    def load(self, user, **filters):
+        """
+        Return a dict with the ids of the comments the user flagged, among
+        the flags matching `filters`, read with one query.
+        """
+        result = {'user': user.pk}
+        result.update((name, []) for name in self.FLAGS.values())
+        flags = (TreeCommentFlag.objects
+                 .filter(user=user, flag__in=self.FLAGS, **filters)
+                 .order_by('comment')
+                 .values_list('comment', 'flag'))
+        for comment_id, flag in flags:
+            result[self.FLAGS[flag]].append(comment_id)
+        return result
+
+    def get(self, user, assoc_ids):
+        """
+        Return a dict with the ids of the comments the user flagged, for
+        the comments of the given associations.
+        """
+        result = {'user': user.pk}
+        result.update((name, []) for name in self.FLAGS.values())
+        keys = {self.cache_key(user.pk, assoc_id): assoc_id for assoc_id in assoc_ids}
+        entries = cache.get_many(keys) if keys else {}
+        missing = [assoc_id for key, assoc_id in keys.items() if key not in entries]
+        if missing:
+            loaded = {}
+            flags = (TreeCommentFlag.objects
+                     .filter(user=user, flag__in=self.FLAGS,
+                             comment__assoc__in=missing)
+                     .order_by('comment')
+                     .values_list('comment__assoc', 'comment', 'flag'))
+            for assoc_id, comment_id, flag in flags:
+                entry = loaded.setdefault(
+                    self.cache_key(user.pk, assoc_id),
+                    {name: [] for name in self.FLAGS.values()})
+                entry[self.FLAGS[flag]].append(comment_id)
+            if loaded:
+                cache.set_many(loaded, settings.COMMENTS_TREE_USER_FLAGS_CACHE_TIMEOUT)
+            entries.update(loaded)
+        for entry in entries.values():
+            for name, ids in entry.items():
+                result[name].extend(ids)
+        if len(entries) > 1:
+            for name in self.FLAGS.values():
+                result[name].sort()
+        return result
+
+    def forget(self, user_id, assoc_ids):
+        """
+        Delete the entries of the user for the given associations, now and
+        again when the current transaction commits, so that they are not
+        loaded back from rows about to change.
+        """
+        keys = [self.cache_key(user_id, assoc_id) for assoc_id in assoc_ids]
+        if keys:
+            cache.delete_many(keys)
+            transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+user_flag_index = UserFlagIndex()
+
+
+@receiver(post_save, sender=TreeCommentFlag)
+@receiver(post_delete, sender=TreeCommentFlag)
+def forget_user_flags(sender, instance, **kwargs):
+    if instance.flag in UserFlagIndex.FLAGS:
+        comment = TreeCommentFlag.comment.field.get_cached_value(instance, None)
+        if comment is not None:
+            assoc_ids = [comment.assoc_id]
+        else:
+            assoc_ids = list(TreeComment.objects.filter(pk=instance.comment_id)
+                             .values_list('assoc', flat=True))
+        user_flag_index.forget(instance.user_id, assoc_ids)
+
+
+@receiver(comments_were_flagged)
+def forget_bulk_user_flags(sender, comment_ids, flag, created_ids, request, **kwargs):
+    # Flags created in bulk are not saved one by one.
+    if flag in UserFlagIndex.FLAGS and created_ids:
+        user_flag_index.forget(request.user.pk, set(
+            TreeComment.objects.filter(pk__in=created_ids)
+            .values_list('assoc', flat=True)))
@@ -71,11 +71,12 @@ from django.template import Context, loader
 from django_comments_tree import get_model
 from django_comments_tree.signals import (comment_will_be_posted,
                                           comment_was_posted,
-                                          comment_was_flagged)
+                                          comment_was_flagged,
+                                          comments_were_flagged)
 from django_comments_tree.models import TreeCommentFlag
 
 from django_comments_tree.conf import settings
-from django_comments_tree.models import BlackListedDomain, TmpTreeComment
+from django_comments_tree.models import TmpTreeComment, domain_blacklist
 from django_comments_tree.signals import confirmation_received
 from django_comments_tree.utils import send_mail
 
@@ -340,6 +341,10 @@ class SpamModerator(TreeCommentModerator):
     ``SpamModerator`` uses the additional ``django_comments_tree`` model:
      * ``BlackListedDomain``
 
+    Subdomains of blacklisted domains are discarded too. The domains are
+    kept in memory, see ``DomainBlacklist``. Load large lists with the
+    ``load_blacklist`` management command.
+
     Remember to update the content regularly through an external Spam
     filtering service.
     """
@@ -350,7 +355,7 @@ class SpamModerator(TreeCommentModerator):
         except IndexError:
             return False
         else:
-            if (BlackListedDomain.objects.filter(domain=domain).count()):
+            if domain in domain_blacklist:
                 return False
             return super().allow(comment, content_object,
                                  request)
@@ -476,6 +481,8 @@ class TreeModerator(Moderator):
                                       sender=TmpTreeComment)
         comment_was_flagged.connect(self.comment_flagged,
                                     sender=get_model())
+        comments_were_flagged.connect(self.comments_flagged,
+                                      sender=get_model())
         super().connect()
 
     def comment_flagged(self, sender, comment, flag, created, request,
@@ -489,5 +496,19 @@ class TreeModerator(Moderator):
                                                         comment.association.content_object,
                                                         request)
 
+    def comments_flagged(self, sender, created_ids, flag, request, **kwargs):
+        if flag != TreeCommentFlag.SUGGEST_REMOVAL or not created_ids:
+            return
+        comments = (sender.objects.filter(pk__in=created_ids)
+                    .select_related('assoc__content_type')
+                    .prefetch_related('assoc__content_object'))
+        for comment in comments:
+            model = comment.content_type.model_class()
+            if model not in self._registry:
+                continue
+            self._registry[model].notify_removal_suggestion(comment,
+                                                            comment.assoc.content_object,
+                                                            request)
+
 
 moderator = TreeModerator()
@@ -0,0 +1,212 @@
+"""
+Follow-up notifications.
+
+Posting a comment only hands the comment over to a notification
+dispatcher. The dispatcher decides when and where the followers of the
+thread get notified. The dispatcher in use is given by the setting
+``COMMENTS_TREE_NOTIFICATION_DISPATCHER``.
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import close_old_connections, transaction
+from django.template import loader
+from django.urls import reverse
+from django.utils.module_loading import import_string
+from django.utils.translation import ugettext as _
+
+from django_comments_tree import get_model as get_comment_model, signed
+from django_comments_tree.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_followers(comment):
+    """
+    Return a dict {email: follower comment} with one comment per email
+    address that asked for follow-up notifications in the thread of
+    `comment`, excluding the author of `comment`.
+    """
+    root = comment.get_root()
+    previous_comments = comment.__class__.objects.filter(
+        path__startswith=root.path, depth__gt=root.depth,
+        is_public=True, followup=True
+    ).exclude(user_email=comment.user_email).exclude(user_email='')
+
+    followers = {}
+    for instance in previous_comments.order_by('path'):
+        followers.setdefault(instance.user_email, instance)
+    return followers
+
+
+def get_mute_key(comment):
+    """ Return the key of the link to stop notifications to the comment """
+    return signed.dumps({'mute': comment.pk, 'email': comment.user_email,
+                         'followup': comment.followup},
+                        extra_key=settings.COMMENTS_TREE_SALT)
+
+
+def get_muted_comment(key):
+    """
+    Return the comment of a mute key, or None if it does not exist anymore.
+    Raise ValueError if the key is not valid.
+    """
+    data = signed.loads(key, extra_key=settings.COMMENTS_TREE_SALT)
+    if isinstance(data, dict) and data.get('followup'):
+        pk, email = data.get('mute'), data.get('email')
+    elif not isinstance(data, dict) and getattr(data, 'followup', False):
+        # Keys of earlier versions hold a pickled comment.
+        pk, email = data.pk, data.user_email
+    else:
+        return None
+    return get_comment_model().objects.filter(pk=pk, user_email=email).first()
+
+
+def get_followup_messages(comment, connection=None):
+    """ Build one follow-up message per follower of the comment """
+    followers = get_followers(comment)
+    if not followers:
+        return []
+
+    subject = _("new comment posted")
+    text_message_template = loader.get_template(
+        "django_comments_tree/email_followup_comment.txt")
+    html_message_template = None
+    if settings.COMMENTS_TREE_SEND_HTML_EMAIL:
+        html_message_template = loader.get_template(
+            "django_comments_tree/email_followup_comment.html")
+
+    content_object = comment.content_object
+    site = comment.site
+    messages = []
+    for email, instance in followers.items():
+        mute_url = reverse('comments-tree-mute',
+                           args=[get_mute_key(instance).decode('utf-8')])
+        message_context = {'user_name': instance.user_name,
+                           'comment': comment,
+                           'content_object': content_object,
+                           'mute_url': mute_url,
+                           'site': site}
+        msg = EmailMultiAlternatives(
+            subject, text_message_template.render(message_context),
+            settings.COMMENTS_TREE_FROM_EMAIL, [email],
+            connection=connection)
+        if html_message_template is not None:
+            msg.attach_alternative(
+                html_message_template.render(message_context), "text/html")
+        messages.append(msg)
+    return messages
+
+
+def send_followup_notifications(comment, batch_size=100):
+    """
+    Email the followers of the comment's thread. Messages are sent
+    in batches of `batch_size` over a single mail connection each.
+    Return the number of messages sent.
+    """
+    connection = get_connection()
+    messages = get_followup_messages(comment, connection=connection)
+    sent = 0
+    for start in range(0, len(messages), batch_size):
+        sent += connection.send_messages(messages[start:start + batch_size]) or 0
+    return sent
+
+
+class SyncDispatcher:
+    """ Send follow-up notifications right away, in the current thread """
+
+    def dispatch(self, comment):
+        send_followup_notifications(comment)
+
+
+class ThreadedDispatcher:
+    """
+    Send follow-up notifications from a bounded pool of worker threads,
+    once the transaction that saved the comment commits.
+
+    A comment whose notifications are queued or being sent is not queued
+    again. At most COMMENTS_TREE_NOTIFICATION_QUEUE_SIZE comments wait
+    for a worker. When they are that many, `submit` waits up to
+    COMMENTS_TREE_MAIL_QUEUE_TIMEOUT seconds for room and then drops the
+    comment's notifications.
+    """
+
+    def __init__(self, max_workers=None, queue_size=None):
+        self.max_workers = (max_workers
+                            or settings.COMMENTS_TREE_NOTIFICATION_WORKERS)
+        self.queue_size = (queue_size
+                           or settings.COMMENTS_TREE_NOTIFICATION_QUEUE_SIZE)
+        self._executor = None
+        self._pending = set()
+        self._slots = threading.BoundedSemaphore(self.max_workers + self.queue_size)
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix='comments-tree-notify')
+            return self._executor
+
+    def dispatch(self, comment):
+        transaction.on_commit(lambda: self.submit(comment.pk))
+
+    def submit(self, comment_pk):
+        with self._lock:
+            if comment_pk in self._pending:
+                return None
+            self._pending.add(comment_pk)
+        if not self._slots.acquire(timeout=settings.COMMENTS_TREE_MAIL_QUEUE_TIMEOUT):
+            with self._lock:
+                self._pending.discard(comment_pk)
+            logger.warning("Notification queue full, dropped the follow-up "
+                           "notifications for comment %s.", comment_pk)
+            return None
+        return self.executor.submit(self.run, comment_pk)
+
+    def run(self, comment_pk):
+        close_old_connections()
+        try:
+            comment = get_comment_model().objects.filter(pk=comment_pk).first()
+            if comment is not None and comment.is_public:
+                send_followup_notifications(comment)
+        except Exception:
+            logger.exception("Can't send follow-up notifications for "
+                             "comment %s.", comment_pk)
+        finally:
+            with self._lock:
+                self._pending.discard(comment_pk)
+            self._slots.release()
+            close_old_connections()
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+_dispatchers = {}
+
+
+def get_dispatcher():
+    """ Return the dispatcher given by COMMENTS_TREE_NOTIFICATION_DISPATCHER """
+    path = settings.COMMENTS_TREE_NOTIFICATION_DISPATCHER
+    if path is None:
+        if settings.COMMENTS_TREE_THREADED_EMAILS:
+            path = 'django_comments_tree.notifications.ThreadedDispatcher'
+        else:
+            path = 'django_comments_tree.notifications.SyncDispatcher'
+    if path not in _dispatchers:
+        _dispatchers[path] = import_string(path)()
+    return _dispatchers[path]
+
+
+def notify_followers(comment):
+    """ Queue the follow-up notifications of a newly published comment """
+    get_dispatcher().dispatch(comment)
@@ -0,0 +1,132 @@
+"""
+Find profanities in comments.
+
+The words in ``PROFANITIES_LIST`` are compiled into an Aho-Corasick
+automaton, which finds every word of the list in a single pass over the
+comment, however long the list is. The automaton is built on first use
+and again after the list or the matching options change.
+"""
+import threading
+
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from django_comments_tree.conf import settings
+
+
+LEETSPEAK = str.maketrans({
+    '0': 'o', '1': 'i', '3': 'e', '4': 'a', '5': 's', '7': 't',
+    '@': 'a', '$': 's', '!': 'i', '|': 'l',
+})
+
+
+class ProfanityMatcher:
+    """
+    Aho-Corasick automaton over a list of words.
+
+    Matching is case insensitive. With `whole_words`, words only match
+    when they are not part of a longer word. With `leetspeak`, digits and
+    symbols that stand for letters are read as those letters, so that
+    "h3ll0" matches "hello".
+    """
+
+    def __init__(self, words, whole_words=False, leetspeak=False):
+        self.words = list(words)
+        self.whole_words = whole_words
+        self.leetspeak = leetspeak
+        # Node 0 is the root. goto[node] maps characters to child nodes,
+        # fail[node] is the node of the longest proper suffix in the trie
+        # and out[node] the indexes of the words ending at the node.
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [()]
+        self.lengths = [len(self.normalize(word)) for word in self.words]
+        for index, word in enumerate(self.words):
+            self._add(self.normalize(word), index)
+        self._link()
+
+    def normalize(self, text):
+        text = text.lower()
+        if self.leetspeak:
+            text = text.translate(LEETSPEAK)
+        return text
+
+    def _add(self, word, index):
+        if not word:
+            return
+        node = 0
+        for char in word:
+            child = self.goto[node].get(char)
+            if child is None:
+                child = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append(())
+                self.goto[node][char] = child
+            node = child
+        self.out[node] += (index,)
+
+    def _link(self):
+        """ Set the failure links, breadth first """
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for char, child in self.goto[node].items():
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                self.out[child] += self.out[self.fail[child]]
+                queue.append(child)
+
+    def iter_matches(self, text):
+        """ Yield (start, end, word index) for every match in the text """
+        text = self.normalize(text)
+        goto, fail, out, lengths = self.goto, self.fail, self.out, self.lengths
+        node = 0
+        for end, char in enumerate(text, 1):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for index in out[node]:
+                start = end - lengths[index]
+                if self.whole_words and (
+                        (start > 0 and is_word_char(text[start - 1]))
+                        or (end < len(text) and is_word_char(text[end]))):
+                    continue
+                yield start, end, index
+
+    def find(self, text):
+        """ Return the words of the list found in the text, in list order """
+        indexes = {index for start, end, index in self.iter_matches(text)}
+        return [self.words[index] for index in sorted(indexes)]
+
+
+def is_word_char(char):
+    return char.isalnum() or char == '_'
+
+
+_matcher = None
+_lock = threading.Lock()
+
+
+def get_profanity_matcher():
+    """ Return the matcher for PROFANITIES_LIST and the current options """
+    global _matcher
+    whole_words = settings.COMMENTS_TREE_PROFANITIES_WHOLE_WORDS
+    leetspeak = settings.COMMENTS_TREE_PROFANITIES_LEETSPEAK
+    matcher = _matcher
+    if (matcher is None or matcher.whole_words != whole_words
+            or matcher.leetspeak != leetspeak):
+        with _lock:
+            matcher = _matcher = ProfanityMatcher(
+                getattr(settings, 'PROFANITIES_LIST', ()),
+                whole_words=whole_words, leetspeak=leetspeak)
+    return matcher
+
+
+@receiver(setting_changed)
+def forget_profanity_matcher(setting, **kwargs):
+    global _matcher
+    if setting in ('PROFANITIES_LIST', 'COMMENTS_TREE_PROFANITIES_WHOLE_WORDS',
+                   'COMMENTS_TREE_PROFANITIES_LEETSPEAK'):
+        _matcher = None
@@ -1,4 +1,5 @@
 import json
+from functools import lru_cache
 
 from draftjs_exporter import html as htmlexporter
 from draftjs_exporter.constants import BLOCK_TYPES, ENTITY_TYPES
@@ -54,6 +55,15 @@ _config = {
 }
 
 
+@lru_cache(maxsize=None)
+def get_draftjs_renderer():
+    """
+    Return the Draft.js exporter shared by the process. Building it maps
+    the whole configuration, while rendering keeps no state in it.
+    """
+    return htmlexporter.HTML(_config)
+
+
 def render_draftjs(content_data):
     try:
         cstate = json.loads(content_data)
@@ -61,9 +71,7 @@ def render_draftjs(content_data):
         # invalid json data
         # Should log something...
         return ''
-    renderer = htmlexporter.HTML(_config)
-    html = renderer.render(cstate)
-    return html
+    return get_draftjs_renderer().render(cstate)
 
 
 def render_plain(content_data):
@@ -26,6 +26,13 @@ comment_was_posted = Signal(providing_args=["comment", "request"])
 # comment, or some other custom user flag.
 comment_was_flagged = Signal(providing_args=["comment", "flag", "created", "request"])
 
+# Sent once after many comments were flagged together, like from the admin
+# actions. `comment_ids` are the ids of all the comments, `created_ids` those
+# of the comments that didn't have the flag yet, and `flag` the kind of flag.
+comments_were_flagged = Signal(
+    providing_args=["comment_ids", "flag", "created_ids", "request"]
+)
+
 # Sent after a comment is `Liked` or `Disliked`
 comment_feedback_toggled = Signal(
     providing_args=["flag", "comment", "created", "request"]
@@ -35,53 +35,88 @@ start of the base64 pickle.
 
 There are 65 url-safe characters: the 64 used by url-safe base64 and the '.'.
 These functions make use of all of them.
+
+Version 2
+---------
+
+Tokens built by dumps() are now JSON instead of pickles, and are signed with
+HMAC/SHA256. They start with the version marker '2~', which can't appear in
+the old format:
+
+>>> signed.dumps({'id': 1})
+'2~eyJpZCI6MX0.W4HuQiRkyvmPIoIu2Jm6YLYxcU8jorlCKJODkJqbp7k'
+
+Only JSON types can be signed. loads() still accepts the old pickle tokens,
+so that confirmation and mute links sent before the upgrade keep working.
 """
 from __future__ import unicode_literals
 
 import base64
 import hmac
+import json
 import pickle
 import hashlib
+import zlib
 
 from django.utils import six
 from django_comments_tree.conf import settings
 
 
+VERSION_2 = b'2~'
+
+
 def dumps(obj, key=None, compress=False, extra_key=b''):
     """
-    Returns URL-safe, sha1 signed base64 compressed pickle. If key is
-    None, settings.SECRET_KEY is used instead.
+    Returns URL-safe, sha256 signed base64 JSON of obj. If key is None,
+    settings.SECRET_KEY is used instead.
 
     If compress is True (not the default) checks if compressing using zlib can
     save some space. Prepends a '.' to signify compression. This is included
     in the signature, to protect against zip bombs.
 
-    extra_key can be used to further salt the hash, in case you're worried
-    that the NSA might try to brute-force your SHA-1 protected secret.
+    extra_key can be used to further salt the hash.
     """
-    pickled = pickle.dumps(obj)
+    data = json.dumps(obj, separators=(',', ':')).encode('utf-8')
     is_compressed = False  # Flag for if it's been compressed or not
     if compress:
-        import zlib  # Avoid zlib dependency unless compress is being used
-        compressed = zlib.compress(pickled)
-        if len(compressed) < (len(pickled) - 1):
-            pickled = compressed
+        compressed = zlib.compress(data)
+        if len(compressed) < (len(data) - 1):
+            data = compressed
             is_compressed = True
-    base64d = encode(pickled).strip(b'=')
+    base64d = encode(data)
     if is_compressed:
         base64d = b'.' + base64d
-    return sign(base64d,
-                (key or settings.SECRET_KEY.encode('ascii')) + extra_key)
+    key = (key or settings.SECRET_KEY.encode('ascii')) + extra_key
+    value = VERSION_2 + base64d
+    return value + b'.' + base64_hmac(value, key, hashlib.sha256)
 
 
 def loads(s, key=None, extra_key=b''):
     "Reverse of dumps(), raises ValueError if signature fails"
     if isinstance(s, six.text_type):
         s = s.encode('utf8')  # base64 works on bytestrings
-    try:
-        base64d = unsign(s, (key or settings.SECRET_KEY.encode('ascii')) + extra_key)
-    except ValueError:
-        raise
+    key = (key or settings.SECRET_KEY.encode('ascii')) + extra_key
+    if not s.startswith(VERSION_2):
+        return loads_v1(s, key)
+    if s.find(b'.', len(VERSION_2) + 1) == -1:
+        raise BadSignature('Missing sig (no . found in value)')
+    value, sig = s.rsplit(b'.', 1)
+    if not hmac.compare_digest(base64_hmac(value, key, hashlib.sha256), sig):
+        raise BadSignature('Signature failed: %s' % sig)
+    base64d = value[len(VERSION_2):]
+    decompress = False
+    if base64d.startswith(b'.'):
+        base64d = base64d[1:]
+        decompress = True
+    data = decode(base64d)
+    if decompress:
+        data = zlib.decompress(data)
+    return json.loads(data.decode('utf-8'))
+
+
+def loads_v1(s, key):
+    """ Load the signed pickles built by earlier versions """
+    base64d = unsign(s, key)
     decompress = False
     if base64d.startswith(b'.'):
         # It's compressed; uncompress it first
@@ -89,7 +124,6 @@ def loads(s, key=None, extra_key=b''):
         decompress = True
     pickled = decode(base64d)
     if decompress:
-        import zlib
         pickled = zlib.decompress(pickled)
     return pickle.loads(pickled)
 
@@ -130,5 +164,5 @@ def unsign(signed_value, key=None):
         raise BadSignature('Signature failed: %s' % sig)
 
 
-def base64_hmac(value, key):
-    return encode(hmac.new(key, value, hashlib.sha1).digest())
+def base64_hmac(value, key, digestmod=hashlib.sha1):
+    return encode(hmac.new(key, value, digestmod).digest())
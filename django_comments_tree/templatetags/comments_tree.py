@@ -36,12 +36,11 @@ class TreeCommentCountNode(Node):
     def __init__(self, as_varname, content_types):
         """Class method to parse get_treecomment_list and return a Node."""
         self.as_varname = as_varname
-        # ToDo: This returns None or a qs
-        self.qs = TreeComment.objects.for_content_types(content_types,
-                                                        site=settings.SITE_ID)
+        self.content_types = content_types
 
     def render(self, context):
-        context[self.as_varname] = self.qs.count()
+        context[self.as_varname] = TreeComment.objects.count_for_content_types(
+            self.content_types, site=settings.SITE_ID)
         return ''
 
 
@@ -103,7 +102,7 @@ class RenderLastTreeCommentsNode(BaseLastTreeCommentsNode):
         # ToDo: what does it mean if content_types is a list?
         self.qs = TreeComment.objects.for_content_types(
             self.content_types,
-            site=settings.SITE_ID).order_by('submit_date')[:self.count]
+            site=settings.SITE_ID).with_context().order_by('submit_date')[:self.count]
 
         strlist = []
         context_dict = context.flatten()
@@ -136,7 +135,7 @@ class GetLastTreeCommentsNode(BaseLastTreeCommentsNode):
         # ToDo: This returns None or a qs
         self.qs = TreeComment.objects.for_content_types(
             self.content_types,
-            site=settings.SITE_ID)
+            site=settings.SITE_ID).with_context()
 
         self.qs = self.qs.order_by('submit_date')[:self.count]
         context[self.as_varname] = self.qs
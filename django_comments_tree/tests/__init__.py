@@ -1,5 +1,6 @@
 import os
 import sys
+import unittest
 
 
 def setup_django_settings():
@@ -29,3 +30,14 @@ def run_tests():
     test_suite = runner(verbosity=2, interactive=True, failfast=False)
     results = test_suite.run_tests(["django_comments_tree"])
     return results
+
+
+def benchmark(test_item):
+    """
+    Mark a test as a benchmark. Benchmarks are left out of the unit
+    suite and only run when COMMENTS_TREE_BENCHMARKS is set, e.g.
+    ``COMMENTS_TREE_BENCHMARKS=1 pytest``.
+    """
+    return unittest.skipUnless(
+        os.environ.get("COMMENTS_TREE_BENCHMARKS"),
+        "set COMMENTS_TREE_BENCHMARKS=1 to run benchmarks")(test_item)
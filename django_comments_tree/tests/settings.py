@@ -112,6 +112,8 @@ COMMENTS_TREE_CONFIRM_EMAIL = True
 COMMENTS_TREE_SALT = b"es-war-einmal-una-bella-princesa-in-a-beautiful-castle"
 COMMENTS_TREE_MAX_THREAD_LEVEL = 5
 COMMENTS_TREE_MAX_THREAD_LEVEL_BY_APP_MODEL = {'tests.diary': 0}
+COMMENTS_TREE_NOTIFICATION_DISPATCHER = \
+    'django_comments_tree.notifications.SyncDispatcher'
 
 COMMENTS_TREE_APP_MODEL_OPTIONS = {
     'tests.diary': {
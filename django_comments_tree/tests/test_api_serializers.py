@@ -5,9 +5,11 @@ from django.contrib.sites.models import Site
 from django.test import TestCase
 
 from django_comments_tree.api.serializers import (APICommentSerializer,
+                                                  ReadCommentSerializer,
                                                   WriteCommentSerializer)
-from django_comments_tree.models import (TreeComment)
-from django_comments_tree.tests.models import Article
+from django_comments_tree.models import (TreeComment, TreeCommentFlag,
+                                         LIKEDIT_FLAG, DISLIKEDIT_FLAG)
+from django_comments_tree.tests.models import Article, Diary
 from django.contrib.auth.models import User
 from django.urls import reverse
 
@@ -87,3 +89,111 @@ class TestWriteSerializer(TestSerializerBase):
     def test_write_serializer_save(self):
         """ This is a big method to test """
 
+
+
+class TestReadSerializerFlags(TestCase):
+
+    def setUp(self):
+        self.request_factory = APIRequestFactory()
+        self.diary = Diary.objects.create(body="What I did on October...")
+        self.root = TreeComment.objects.get_or_create_root(self.diary)
+        self.comments = [self.root.add_child(comment=f"comment {x}")
+                         for x in range(10)]
+        self.alice = User.objects.create_user("alice", "", "pwd")
+        self.bob = User.objects.create_user("bob", "", "pwd")
+        for comment in self.comments[:5]:
+            TreeCommentFlag.objects.add_flag(comment, self.alice, LIKEDIT_FLAG)
+            TreeCommentFlag.objects.add_flag(comment, self.bob, DISLIKEDIT_FLAG)
+        TreeCommentFlag.objects.add_flag(self.comments[0], self.bob,
+                                         TreeCommentFlag.SUGGEST_REMOVAL)
+
+    def get_request(self, user):
+        request = self.request_factory.get('/')
+        request.user = user
+        return request
+
+    def serialize(self, user, comments):
+        serializer = ReadCommentSerializer(comments, many=True,
+                                           context={'request': self.get_request(user)})
+        return {item['id']: item['flags'] for item in serializer.data}
+
+    def test_flags_for_page(self):
+        flags = self.serialize(self.alice, TreeComment.objects.filter(depth=2))
+        first = flags[self.comments[0].pk]
+        self.assertEqual(first['like']['count'], 1)
+        self.assertTrue(first['like']['active'])
+        self.assertEqual(first['like']['users'], ["%d:alice" % self.alice.pk])
+        self.assertEqual(first['dislike']['count'], 1)
+        self.assertFalse(first['dislike']['active'])
+        self.assertEqual(first['dislike']['users'], ["%d:bob" % self.bob.pk])
+        self.assertFalse(first['removal']['active'])
+        self.assertIsNone(first['removal']['count'])
+
+        last = flags[self.comments[-1].pk]
+        self.assertEqual(last['like'], {'active': False, 'count': 0, 'users': []})
+
+        flags = self.serialize(self.bob, TreeComment.objects.filter(depth=2))
+        first = flags[self.comments[0].pk]
+        self.assertFalse(first['like']['active'])
+        self.assertTrue(first['dislike']['active'])
+        self.assertTrue(first['removal']['active'])
+
+    def test_single_comment_matches_page(self):
+        page = self.serialize(self.alice, TreeComment.objects.filter(depth=2))
+        serializer = ReadCommentSerializer(self.comments[0],
+                                           context={'request': self.get_request(self.alice)})
+        self.assertEqual(serializer.data['flags'], page[self.comments[0].pk])
+
+    def test_flag_queries_do_not_grow_with_page_size(self):
+        serializer = ReadCommentSerializer(context={'request': self.get_request(self.alice)})
+        comments = list(TreeComment.objects.filter(depth=2)
+                        .select_related('assoc__content_type'))
+        self.alice.has_perm("django_comments.can_moderate")  # Fill perm cache.
+        # One query for the user's own flags, and one for the users shown
+        # by 'show_feedback'. Counts come from the comments themselves.
+        with self.assertNumQueries(2):
+            serializer.prefetch_flags(comments)
+            for comment in comments:
+                serializer.get_flags(comment)
+
+
+class TestReadSerializerParents(TestSerializerBase):
+
+    def setUp(self):
+        super().setUp()
+        self.reply = self.comment.add_child(comment="a reply")
+        self.reply_to_reply = self.reply.add_child(comment="a reply to a reply")
+        self.expected = {self.comment.pk: None,
+                         self.reply.pk: self.comment.pk,
+                         self.reply_to_reply.pk: self.reply.pk}
+
+    def serialize(self, comments):
+        request = self.request_factory.get('/')
+        request.user = self.user
+        serializer = ReadCommentSerializer(comments, many=True,
+                                           context={'request': request})
+        return {item['id']: item['parent_id'] for item in serializer.data}
+
+    def test_annotated_queryset(self):
+        qs = TreeComment.objects.filter(depth__gt=1).with_parent_id()
+        self.assertEqual({c.pk: c.parent_pk for c in qs}, self.expected)
+        self.assertEqual(self.serialize(qs), self.expected)
+
+    def test_parents_from_paths(self):
+        qs = TreeComment.objects.filter(depth__gt=1)
+        self.assertEqual(self.serialize(qs), self.expected)
+
+    def test_parent_outside_of_page(self):
+        qs = TreeComment.objects.filter(depth=4)
+        self.assertEqual(self.serialize(qs),
+                         {self.reply_to_reply.pk: self.reply.pk})
+
+    def test_parents_resolved_in_bulk(self):
+        request = self.request_factory.get('/')
+        serializer = ReadCommentSerializer(context={'request': request})
+        comments = list(TreeComment.objects.filter(depth__gt=2))
+        with self.assertNumQueries(1):
+            serializer.prefetch_parents(comments)
+            parents = {c.pk: serializer.get_parent_id(c) for c in comments}
+        self.assertEqual(parents, {self.reply.pk: self.comment.pk,
+                                   self.reply_to_reply.pk: self.reply.pk})
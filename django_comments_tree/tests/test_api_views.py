@@ -1,5 +1,8 @@
 from __future__ import unicode_literals
 
+import json
+from datetime import timedelta
+
 try:
     from unittest.mock import patch
 except ImportError:
@@ -7,13 +10,20 @@ except ImportError:
 
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
-from django.test import TestCase
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
 from rest_framework.test import APIRequestFactory, force_authenticate
 
 import django_comments_tree
+from django_comments_tree.api.frontend import commentbox_props
 from django_comments_tree.api.views import CommentCreate
+from django_comments_tree.models import (CommentAssociation, TreeComment,
+                                         TreeCommentFlag, LIKEDIT_FLAG)
+from django_comments_tree.views.moderation import perform_approve, perform_delete
 from django_comments_tree.tests.models import Article, Diary
 
 
@@ -59,3 +69,341 @@ class CommentCreateTestCase(TestCase):
         self.assertTrue('name' in response.data)
         self.assertTrue('email' in response.data)
         self.assertEqual(self.mock_mailer.call_count, 0)
+
+
+class CommentCountTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.article = Article.objects.create(
+            title="October", slug="october", body="What I did on October...")
+        self.root = TreeComment.objects.get_or_create_root(self.article)
+        self.root.add_child(comment="Es war einmal eine kleine...")
+        self.root.add_child(comment="In moderation", is_public=False)
+
+    def test_count_reads_association(self):
+        url = reverse('comments-tree-api-count',
+                      kwargs={'content_type': 'tests.article',
+                              'object_pk': self.article.pk})
+        # The content type lookup is cached, leaving the association.
+        ContentType.objects.get_for_model(self.article)
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual(response.data, {'count': 1})
+
+    def test_commentbox_props_count(self):
+        user = User.objects.create_user("bob", "", "pwd")
+        props = commentbox_props(self.article, user)
+        self.assertEqual(props['comment_count'], 1)
+
+
+class CommentCacheInvalidationTestCase(TransactionTestCase):
+    # Cache versions are bumped when transactions commit.
+
+    def setUp(self):
+        cache.clear()
+        self.article = Article.objects.create(
+            title="October", slug="october", body="What I did on October...")
+        self.root = TreeComment.objects.get_or_create_root(self.article)
+        self.comment = self.root.add_child(comment="Es war einmal eine kleine...")
+        self.user = User.objects.create_user("bob", "", "pwd")
+        self.request = APIRequestFactory().post('/')
+        self.request.user = self.user
+        self.url = reverse('comments-tree-api-count',
+                           kwargs={'content_type': 'tests.article',
+                                   'object_pk': self.article.pk})
+
+    def version(self):
+        assoc = self.root.commentassociation
+        return CommentAssociation.get_cache_version(assoc.content_type_id,
+                                                    assoc.object_id,
+                                                    assoc.site_id)
+
+    def get_count(self):
+        return json.loads(self.client.get(self.url).content)['count']
+
+    def test_new_comment_invalidates_count(self):
+        self.assertEqual(self.get_count(), 1)
+        self.assertEqual(self.get_count(), 1)  # Served from the cache.
+        self.root.add_child(comment="Another one")
+        self.assertEqual(self.get_count(), 2)
+
+    def test_moderation_bumps_version(self):
+        version = self.version()
+        perform_delete(self.request, self.comment)
+        self.assertGreater(self.version(), version)
+
+        version = self.version()
+        perform_approve(self.request, self.comment)
+        self.assertGreater(self.version(), version)
+
+    def test_flags_bump_version(self):
+        version = self.version()
+        flag, created = TreeCommentFlag.objects.add_flag(self.comment, self.user,
+                                                         LIKEDIT_FLAG)
+        self.assertGreater(self.version(), version)
+
+        version = self.version()
+        TreeCommentFlag.objects.remove_flag(flag)
+        self.assertGreater(self.version(), version)
+
+    def test_delete_bumps_version(self):
+        version = self.version()
+        TreeComment.objects.get(pk=self.comment.pk).delete()
+        self.assertGreater(self.version(), version)
+
+
+class CommentListCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.diary = Diary.objects.create(body="About Today...")
+        self.root = TreeComment.objects.get_or_create_root(self.diary)
+        self.comment = self.root.add_child(comment="Es war einmal eine kleine...")
+        self.alice = User.objects.create_user("alice", "", "pwd")
+        self.bob = User.objects.create_user("bob", "", "pwd")
+        self.url = reverse('comments-tree-api-list',
+                           kwargs={'content_type': 'tests.diary',
+                                   'object_pk': self.diary.pk})
+
+    def get_like(self, user=None):
+        if user is None:
+            self.client.logout()
+        else:
+            self.client.force_login(user)
+        return json.loads(self.client.get(self.url).content)[0]['flags']['like']
+
+    def test_flags_are_not_shared(self):
+        # The like is added without bumping the cache version, so the
+        # responses below may come from the cache.
+        TreeCommentFlag.objects.create(comment=self.comment, user=self.alice,
+                                       flag=LIKEDIT_FLAG)
+        self.assertFalse(self.get_like()['active'])
+        self.assertTrue(self.get_like(self.alice)['active'])
+        self.assertFalse(self.get_like(self.bob)['active'])
+        self.assertTrue(self.get_like(self.alice)['active'])
+        self.assertFalse(self.get_like()['active'])
+
+
+class CommentListPaginationTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.article = Article.objects.create(
+            title="October", slug="october", body="What I did on October...")
+        self.root = TreeComment.objects.get_or_create_root(self.article)
+        self.threads = []
+        for i in range(5):
+            top = self.root.add_child(comment="Thread %d" % i)
+            reply = top.add_child(comment="Reply to thread %d" % i)
+            reply.add_child(comment="Reply to reply %d" % i)
+            self.threads.append([top.pk, reply.pk, reply.pk + 1])
+        self.url = reverse('comments-tree-api-list',
+                           kwargs={'content_type': 'tests.article',
+                                   'object_pk': self.article.pk})
+
+    def get(self, url, **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def get_all_pages(self, **params):
+        pages = []
+        data = self.get(self.url, **params)
+        pages.append([c['id'] for c in data['results']])
+        while data['next']:
+            data = self.get(data['next'])
+            pages.append([c['id'] for c in data['results']])
+        return pages
+
+    def test_not_paginated_by_default(self):
+        data = self.get(self.url)
+        self.assertEqual([c['id'] for c in data],
+                         [pk for thread in self.threads for pk in thread])
+
+    def test_pages_hold_whole_threads(self):
+        pages = self.get_all_pages(page_size=2)
+        self.assertEqual(pages, [
+            self.threads[0] + self.threads[1],
+            self.threads[2] + self.threads[3],
+            self.threads[4],
+        ])
+
+    def test_pages_in_desc_order(self):
+        pages = self.get_all_pages(page_size=2, order='desc')
+        self.assertEqual(pages, [
+            self.threads[4] + self.threads[3],
+            self.threads[2] + self.threads[1],
+            self.threads[0],
+        ])
+
+    def test_replies_to_hidden_threads(self):
+        hidden = [thread[0] for thread in self.threads]
+        TreeComment.objects.filter(pk__in=hidden).update(is_public=False)
+        replies = [pk for thread in self.threads for pk in thread[1:]]
+        self.assertEqual([c['id'] for c in self.get(self.url)], replies)
+        for order in ('asc', 'desc'):
+            listed = [c['id'] for c in self.get(self.url, order=order)]
+            self.assertEqual(sorted(listed), replies)
+            self.assertEqual(self.get_all_pages(page_size=2, order=order),
+                             [listed])
+
+    def test_page_size_setting(self):
+        with patch.multiple('django_comments_tree.conf.settings',
+                            COMMENTS_TREE_API_PAGE_SIZE=3):
+            pages = self.get_all_pages()
+        self.assertEqual([len(page) for page in pages], [9, 6])
+
+    def test_cursor_is_stable_on_new_threads(self):
+        data = self.get(self.url, page_size=2)
+        self.root.add_child(comment="A new thread")
+        cache.clear()
+        data = self.get(data['next'])
+        self.assertEqual([c['id'] for c in data['results']],
+                         self.threads[2] + self.threads[3])
+
+    def test_invalid_cursor(self):
+        for cursor in ['not base64!', 'MDA=']:
+            response = self.client.get(self.url, {'page_size': 2, 'cursor': cursor})
+            self.assertEqual(response.status_code, 404)
+
+    def test_deep_pages_cost_as_much_as_the_first(self):
+        first = self.get(self.url, page_size=1)
+        self.get(self.url, page_size=1)
+        next_url = first['next']
+        for i in range(3):
+            next_url = self.get(next_url)['next']
+        cache.clear()
+        # Warm the content type cache so both requests run the same queries.
+        ContentType.objects.get_for_model(self.article)
+        with CaptureQueriesContext(connection) as first_page:
+            self.get(self.url, page_size=1)
+        cache.clear()
+        with CaptureQueriesContext(connection) as last_page:
+            data = self.get(next_url)
+        self.assertEqual([c['id'] for c in data['results']], self.threads[4])
+        self.assertEqual(len(first_page), len(last_page))
+        for query in last_page:
+            self.assertNotIn('OFFSET', query['sql'])
+
+
+class CommentListChangesTestCase(TransactionTestCase):
+    # Responses are cached by the version bumped when transactions commit.
+
+    def setUp(self):
+        cache.clear()
+        self.article = Article.objects.create(
+            title="October", slug="october", body="What I did on October...")
+        self.root = TreeComment.objects.get_or_create_root(self.article)
+        self.comment = self.root.add_child(comment="Es war einmal eine kleine...")
+        self.reply = self.comment.add_child(comment="A reply")
+        self.user = User.objects.create_user("bob", "", "pwd")
+        self.request = APIRequestFactory().post('/')
+        self.request.user = self.user
+        self.url = reverse('comments-tree-api-list',
+                           kwargs={'content_type': 'tests.article',
+                                   'object_pk': self.article.pk})
+
+    def get_changes(self, since):
+        response = self.client.get(self.url, {'since': since})
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_no_changes(self):
+        since = self.reply.updated_on.isoformat()
+        data = self.get_changes(since)
+        self.assertEqual(data['comments'], [])
+        self.assertEqual(data['hidden'], [])
+        self.assertEqual(self.get_changes(data['cursor']), data)
+
+    def test_new_and_edited_comments(self):
+        data = self.get_changes(self.reply.updated_on.isoformat())
+        new = self.root.add_child(comment="Another one")
+        self.comment.comment = "Edited"
+        self.comment.save()
+        data = self.get_changes(data['cursor'])
+        self.assertEqual([c['id'] for c in data['comments']],
+                         [new.pk, self.comment.pk])
+        self.assertEqual(self.get_changes(data['cursor'])['comments'], [])
+
+    def test_moderated_comments(self):
+        data = self.get_changes(self.reply.updated_on.isoformat())
+        perform_delete(self.request, self.comment)
+        data = self.get_changes(data['cursor'])
+        # The removed comment is still listed, its reply is unpublished.
+        self.assertEqual([c['id'] for c in data['comments']], [self.comment.pk])
+        self.assertTrue(data['comments'][0]['is_removed'])
+        self.assertEqual(data['hidden'], [self.reply.pk])
+
+    def test_changes_are_limited(self):
+        since = self.reply.updated_on.isoformat()
+        with patch('django_comments_tree.api.views.CommentList.max_changes', 2):
+            for i in range(3):
+                self.root.add_child(comment="Comment %d" % i)
+            data = self.get_changes(since)
+            self.assertEqual(len(data['comments']), 2)
+            data = self.get_changes(data['cursor'])
+            self.assertEqual([c['comment'] for c in data['comments']],
+                             ["<p>Comment 2</p>"])
+
+    def test_late_commits(self):
+        since = self.reply.updated_on - timedelta(seconds=10)
+        data = self.get_changes(since.isoformat())
+        self.assertEqual([c['id'] for c in data['comments']],
+                         [self.comment.pk, self.reply.pk])
+        new = self.root.add_child(comment="Another one")
+        data = self.get_changes(data['cursor'])
+        self.assertEqual([c['id'] for c in data['comments']], [new.pk])
+        # A comment saved before the new one, but committed after it was
+        # returned.
+        late = self.root.add_child(comment="A late one")
+        TreeComment.objects.filter(pk=late.pk).update(
+            updated_on=new.updated_on - timedelta(seconds=1))
+        CommentAssociation.bump_cache_versions([self.root.assoc_id])
+        data = self.get_changes(data['cursor'])
+        self.assertEqual([c['id'] for c in data['comments']], [late.pk])
+        self.assertEqual(self.get_changes(data['cursor'])['comments'], [])
+
+        # Edited again within the window, returned again.
+        new.comment = "Edited"
+        new.save()
+        data = self.get_changes(data['cursor'])
+        self.assertEqual([c['id'] for c in data['comments']], [new.pk])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url, {'since': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+
+
+class CommentListQueriesTestCase(TestCase):
+    """
+    The number of queries to list comments doesn't depend on the number
+    of comments listed.
+    """
+    def setUp(self):
+        cache.clear()
+        self.article = Article.objects.create(
+            title="October", slug="october", body="What I did on October...")
+        self.root = TreeComment.objects.get_or_create_root(self.article)
+        self.user = User.objects.create_user("bob", "bob@example.com", "pwd")
+        self.url = reverse('comments-tree-api-list',
+                           kwargs={'content_type': 'tests.article',
+                                   'object_pk': self.article.pk})
+
+    def add_comments(self, count):
+        for i in range(count):
+            top = self.root.add_child(comment="Thread %d" % i, user=self.user)
+            top.add_child(comment="Reply to thread %d" % i)
+
+    def count_queries(self):
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), len(json.loads(response.content))
+
+    def test_queries_per_list(self):
+        self.add_comments(2)
+        few, listed = self.count_queries()
+        self.assertEqual(listed, 4)
+        self.add_comments(10)
+        many, listed = self.count_queries()
+        self.assertEqual(listed, 24)
+        self.assertEqual(many, few)
@@ -0,0 +1,109 @@
+import os
+import tempfile
+from io import StringIO
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase as DjangoTestCase, TransactionTestCase
+
+from django_comments_tree.models import (BlackListedDomain, DomainBlacklist,
+                                         TmpTreeComment, domain_blacklist)
+from django_comments_tree.moderation import SpamModerator
+from django_comments_tree.tests import benchmark
+from django_comments_tree.tests.models import Diary
+
+
+class DomainBlacklistTestCase(DjangoTestCase):
+    def setUp(self):
+        cache.clear()
+        BlackListedDomain.objects.create(domain="spam.com")
+        BlackListedDomain.objects.create(domain=".Junk.example.org")
+
+    def test_subdomains(self):
+        for domain in ["spam.com", "SPAM.com", "mail.spam.com", "a.b.spam.com",
+                       "junk.example.org", "x.junk.example.org"]:
+            self.assertIn(domain, domain_blacklist)
+        for domain in ["notspam.com", "spam.com.au", "example.org", "com", ""]:
+            self.assertNotIn(domain, domain_blacklist)
+
+    def test_no_queries_once_loaded(self):
+        self.assertIn("spam.com", domain_blacklist)
+        with self.assertNumQueries(0):
+            self.assertIn("mail.spam.com", domain_blacklist)
+            self.assertNotIn("example.com", domain_blacklist)
+
+    def test_changes_are_loaded(self):
+        self.assertNotIn("example.com", domain_blacklist)
+        domain = BlackListedDomain.objects.create(domain="example.com")
+        self.assertIn("www.example.com", domain_blacklist)
+        domain.delete()
+        self.assertNotIn("www.example.com", domain_blacklist)
+
+    def test_spam_moderator(self):
+        moderator = SpamModerator(Diary)
+        diary = Diary.objects.create(body="Lorem ipsum", allow_comments=True)
+        self.assertFalse(moderator.allow(
+            TmpTreeComment(user_email="bob@mail.spam.com"), diary, None))
+        self.assertFalse(moderator.allow(
+            TmpTreeComment(user_email="bob"), diary, None))
+        self.assertTrue(moderator.allow(
+            TmpTreeComment(user_email="bob@example.com"), diary, None))
+
+
+class SharedVersionTestCase(TransactionTestCase):
+    def test_other_processes_load_changes(self):
+        cache.clear()
+        other_process = DomainBlacklist()
+        self.assertNotIn("spam.com", other_process)
+        BlackListedDomain.objects.create(domain="spam.com")
+        self.assertIn("spam.com", other_process)
+
+
+class LoadBlacklistTestCase(DjangoTestCase):
+    def setUp(self):
+        cache.clear()
+        BlackListedDomain.objects.create(domain="old.com")
+
+    def write(self, lines):
+        f = tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False)
+        with f:
+            f.write("\n".join(lines))
+        self.addCleanup(os.remove, f.name)
+        return f.name
+
+    def load(self, *args, **options):
+        out = StringIO()
+        call_command('load_blacklist', *args, stdout=out, **options)
+        return out.getvalue()
+
+    def test_load(self):
+        path = self.write(["# Joe Wein's blacklist", "", "spam.com",
+                           "Spam.com", "bob@junk.org  # an address",
+                           "old.com", "not a domain"])
+        output = self.load(path)
+        self.assertIn("Loaded 2 blacklisted domains", output)
+        self.assertIn("skipped 1 lines", output)
+        self.assertEqual(list(BlackListedDomain.objects.values_list('domain', flat=True)),
+                         ["junk.org", "old.com", "spam.com"])
+        self.assertIn("www.junk.org", domain_blacklist)
+
+        self.load(self.write(["spam.com"]), replace=True)
+        self.assertEqual(list(BlackListedDomain.objects.values_list('domain', flat=True)),
+                         ["spam.com"])
+        self.assertNotIn("old.com", domain_blacklist)
+
+    def load_many(self, count, batch_size):
+        path = self.write("spam%d.example.com" % i for i in range(count))
+        self.load(path, batch_size=batch_size)
+        self.assertEqual(BlackListedDomain.objects.count(), count + 1)
+
+        self.assertIn("www.spam%d.example.com" % (count - 1), domain_blacklist)
+        for i in range(count):
+            self.assertNotIn("mail.spam%d.example.net" % i, domain_blacklist)
+
+    def test_load_in_batches(self):
+        self.load_many(25, batch_size=10)
+
+    @benchmark
+    def test_load_large_list(self):
+        self.load_many(100000, batch_size=10000)
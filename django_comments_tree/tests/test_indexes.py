@@ -0,0 +1,151 @@
+from unittest import skipUnless
+
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase as DjangoTestCase, TransactionTestCase
+from django.utils import timezone
+
+from django_comments_tree.models import (TreeComment, TreeCommentFlag,
+                                         CommentAssociation, LIKEDIT_FLAG,
+                                         TmpTreeComment)
+from django_comments_tree.tests.models import Article
+
+
+class QueryPlanTestCase(DjangoTestCase):
+    """
+    Check that the hot association-scoped queries are served by the
+    composite indexes added in migration 0012, and duplicate lookups by
+    the content hash index of migration 0014.
+    """
+
+    def setUp(self):
+        self.article = Article.objects.create(
+            title="September", slug="september", body="During September...")
+        self.root = TreeComment.objects.get_or_create_root(self.article)
+        self.root.add_child(comment="just a testing comment")
+        self.assoc = self.root.commentassociation
+
+    def query_plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                # Tables are tiny here, make the planner use indexes anyway.
+                cursor.execute("SET LOCAL enable_seqscan = off")
+                cursor.execute("EXPLAIN " + sql, params)
+            else:
+                cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            return "\n".join(str(row[-1]) for row in cursor.fetchall())
+
+    def assertUsesIndex(self, queryset, index_name, sqlite_columns=None):
+        plan = self.query_plan(queryset)
+        if connection.vendor == 'sqlite' and sqlite_columns:
+            # SQLite names the index of a unique constraint itself.
+            self.assertIn("USING INDEX", plan)
+            self.assertIn(sqlite_columns, plan)
+        else:
+            self.assertIn(index_name, plan)
+
+    @skipUnless(connection.vendor in ('sqlite', 'postgresql'),
+                "Query plans are only checked on SQLite and PostgreSQL")
+    def test_public_comments_of_object(self):
+        qs = TreeComment.objects.filter(assoc=self.assoc, is_public=True,
+                                        depth__gt=1).order_by('path')
+        self.assertUsesIndex(qs, 'comments_tree_assoc_pub_path')
+
+    @skipUnless(connection.vendor in ('sqlite', 'postgresql'),
+                "Query plans are only checked on SQLite and PostgreSQL")
+    def test_association_of_object(self):
+        qs = CommentAssociation.objects.filter(content_type=self.assoc.content_type_id,
+                                               object_id=self.assoc.object_id,
+                                               site=self.assoc.site_id)
+        self.assertUsesIndex(qs, 'comments_tree_assoc_object_uniq',
+                             "content_type_id=? AND object_id=? AND site_id=?")
+
+    @skipUnless(connection.vendor in ('sqlite', 'postgresql'),
+                "Query plans are only checked on SQLite and PostgreSQL")
+    def test_flags_of_comments(self):
+        qs = TreeCommentFlag.objects.filter(comment__in=[self.root.pk],
+                                            flag=LIKEDIT_FLAG)
+        self.assertUsesIndex(qs, 'comments_tree_flag_comment')
+
+    @skipUnless(connection.vendor in ('sqlite', 'postgresql'),
+                "Query plans are only checked on SQLite and PostgreSQL")
+    def test_duplicates_of_comment(self):
+        comment = self.root.get_children().get()
+        tmp_comment = TmpTreeComment(
+            content_type=self.assoc.content_type, object_id=self.assoc.object_id,
+            site_id=self.assoc.site_id, user_name=comment.user_name,
+            user_email=comment.user_email, comment="just a testing comment",
+            submit_date=comment.submit_date)
+        qs = TreeComment.objects.duplicates_of(tmp_comment)
+        self.assertTrue(qs.exists())
+        self.assertUsesIndex(qs, 'comments_tree_content_hash')
+
+
+class MergeDuplicateAssociationsTestCase(TransactionTestCase):
+    """
+    Migration 0012 merges the associations of the same object before
+    making them unique.
+    """
+    app = 'django_comments_tree'
+
+    def migrate(self, name):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        target = [(self.app, name)]
+        executor.migrate(target)
+        return executor.loader.project_state(target).apps
+
+    def setUp(self):
+        leaf = MigrationExecutor(connection).loader.graph.leaf_nodes(self.app)[0]
+        self.addCleanup(self.migrate, leaf[1])
+        self.article = Article.objects.create(
+            title="September", slug="september", body="During September...")
+
+    def test_duplicates_are_merged(self):
+        apps = self.migrate('0011_commentassociation_counts')
+        Association = apps.get_model(self.app, 'CommentAssociation')
+        Comment = apps.get_model(self.app, 'TreeComment')
+        ContentType = apps.get_model('contenttypes', 'ContentType')
+        content_type = ContentType.objects.get(app_label='tests', model='article')
+        now = timezone.now()
+
+        def add(path, assoc, numchild=0, **fields):
+            return Comment.objects.create(path=path, depth=len(path) // 4,
+                                          numchild=numchild, assoc=assoc,
+                                          submit_date=now, **fields)
+
+        trees = [
+            ['0001', '00010001', '000100010001', '00010002'],
+            ['0002', '00020001', '000200010001'],
+            ['0003'],
+        ]
+        assocs = []
+        for tree in trees:
+            assoc = Association.objects.create(
+                content_type=content_type, object_id=self.article.pk, site_id=1,
+                total_count=len(tree) - 1, public_count=len(tree) - 1)
+            for path in tree:
+                node = add(path, assoc, comment=path,
+                           numchild=sum(1 for p in tree
+                                        if p[:-4] == path))
+                if len(path) == 4:
+                    assoc.root = node
+                    assoc.save()
+            assocs.append(assoc)
+
+        apps = self.migrate('0012_composite_indexes')
+        Association = apps.get_model(self.app, 'CommentAssociation')
+        Comment = apps.get_model(self.app, 'TreeComment')
+        assoc = Association.objects.get()
+        self.assertEqual(assoc.pk, assocs[0].pk)
+        self.assertEqual((assoc.total_count, assoc.public_count), (5, 5))
+        self.assertEqual(
+            list(Comment.objects.order_by('path')
+                 .values_list('path', 'comment', 'numchild', 'assoc')),
+            [('0001', '0001', 3, assoc.pk),
+             ('00010001', '00010001', 1, assoc.pk),
+             ('000100010001', '000100010001', 0, assoc.pk),
+             ('00010002', '00010002', 0, assoc.pk),
+             ('00010003', '00020001', 1, assoc.pk),
+             ('000100030001', '000200010001', 0, assoc.pk)])
@@ -0,0 +1,170 @@
+import json
+import os
+import tempfile
+from datetime import datetime, timedelta
+from io import StringIO
+from unittest.mock import patch
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase as DjangoTestCase
+
+from django_comments_tree.management.commands.migrate_xtd_comments import Command
+from django_comments_tree.models import CommentAssociation, TreeComment
+from django_comments_tree.tests.models import Article
+
+
+LEGACY_TABLES = [
+    """
+    CREATE TABLE django_comments (
+        id integer PRIMARY KEY, content_type_id integer, object_pk varchar(64),
+        site_id integer, user_id integer NULL, user_name varchar(50),
+        user_email varchar(254), user_url varchar(200), comment text,
+        submit_date datetime, ip_address varchar(39) NULL, is_public bool,
+        is_removed bool)
+    """,
+    """
+    CREATE TABLE django_comments_xtd_xtdcomment (
+        comment_ptr_id integer PRIMARY KEY, thread_id integer, parent_id integer,
+        level smallint, "order" integer, followup bool, nested_count integer)
+    """,
+]
+
+
+class MigrateXtdCommentsTestCase(DjangoTestCase):
+    def setUp(self):
+        with connection.cursor() as cursor:
+            for sql in LEGACY_TABLES:
+                cursor.execute(sql)
+        self.article_1 = Article.objects.create(
+            title="September", slug="september", body="During September...")
+        self.article_2 = Article.objects.create(
+            title="October", slug="october", body="What I did on October...")
+        self.ct = ContentType.objects.get_for_model(Article)
+        self.date = datetime(2019, 10, 1, 12, 0)
+        self.next_id = 1
+        checkpoint = tempfile.NamedTemporaryFile(suffix='.json', delete=False)
+        checkpoint.close()
+        os.remove(checkpoint.name)
+        self.checkpoint = checkpoint.name
+        self.addCleanup(lambda: os.path.exists(self.checkpoint) and os.remove(self.checkpoint))
+
+    def add_legacy(self, obj, text, parent=None, is_public=True, object_pk=None):
+        pk = self.next_id
+        self.next_id += 1
+        thread_id = parent[1] if parent else pk
+        level = parent[2] + 1 if parent else 0
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO django_comments VALUES "
+                "(%s, %s, %s, 1, NULL, 'bob', 'bob@example.com', '', %s, %s, NULL, %s, %s)",
+                [pk, self.ct.pk, object_pk or str(obj.pk), text,
+                 self.date + timedelta(minutes=pk), is_public, False])
+            cursor.execute(
+                "INSERT INTO django_comments_xtd_xtdcomment VALUES (%s, %s, %s, %s, %s, %s, 0)",
+                [pk, thread_id, parent[0] if parent else pk, level, pk, False])
+        return (pk, thread_id, level)
+
+    def make_legacy_comments(self):
+        c1 = self.add_legacy(self.article_1, "Comment 1")
+        r1 = self.add_legacy(self.article_1, "Reply 1", parent=c1)
+        self.add_legacy(self.article_1, "Reply to reply 1", parent=r1)
+        self.add_legacy(self.article_1, "Reply 2", parent=c1, is_public=False)
+        self.add_legacy(self.article_2, "Comment 2")
+        self.add_legacy(self.article_1, "Comment 3")
+        self.add_legacy(self.article_1, "Orphan", object_pk="999")
+
+    def migrate(self, **options):
+        out = StringIO()
+        call_command('migrate_xtd_comments', checkpoint=self.checkpoint,
+                     stdout=out, **options)
+        return out.getvalue()
+
+    def tree_of(self, obj):
+        root = TreeComment.objects.get_or_create_root(obj)
+        root.refresh_from_db()
+        return [(c.comment.raw, c.depth, c.numchild)
+                for c in TreeComment.get_tree(root).filter(depth__gt=1)]
+
+    def test_migrate(self):
+        self.make_legacy_comments()
+        output = self.migrate(batch_size=2)
+        self.assertIn("Migrated 6 comments.", output)
+        self.assertIn("rows/s", output)
+
+        self.assertEqual(self.tree_of(self.article_1), [
+            ("Comment 1", 2, 2),
+            ("Reply 1", 3, 1),
+            ("Reply to reply 1", 4, 0),
+            ("Reply 2", 3, 0),
+            ("Comment 3", 2, 0),
+        ])
+        self.assertEqual(self.tree_of(self.article_2), [("Comment 2", 2, 0)])
+        root = TreeComment.objects.get_or_create_root(self.article_1)
+        self.assertEqual(root.numchild, 2)
+        self.assertEqual(root.get_children_count(), 2)
+        # New comments still fit in the migrated tree.
+        root.add_child(comment="Comment 4")
+        self.assertEqual(self.tree_of(self.article_1)[-1], ("Comment 4", 2, 0))
+
+        assoc = CommentAssociation.objects.get(root=root)
+        self.assertEqual((assoc.total_count, assoc.public_count), (6, 5))
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_resume(self):
+        self.make_legacy_comments()
+        flush = Command.flush
+
+        def interrupted_flush(command, thread_id):
+            flush(command, thread_id)
+            raise KeyboardInterrupt
+
+        with patch.object(Command, 'flush', interrupted_flush):
+            with self.assertRaises(KeyboardInterrupt):
+                self.migrate(batch_size=2)
+        with open(self.checkpoint) as f:
+            self.assertEqual(json.load(f), {'thread_id': 1, 'imported': 4})
+
+        output = self.migrate(batch_size=2, resume=True)
+        self.assertIn("Migrated 6 comments.", output)
+        self.assertEqual([c[0] for c in self.tree_of(self.article_1)],
+                         ["Comment 1", "Reply 1", "Reply to reply 1", "Reply 2",
+                          "Comment 3"])
+        self.assertEqual(TreeComment.objects.filter(depth__gt=1).count(), 6)
+
+    def test_resume_after_unsaved_checkpoint(self):
+        self.make_legacy_comments()
+        self.add_legacy(self.article_2, "Comment 4")
+        save_checkpoint = Command.save_checkpoint
+        calls = []
+
+        def interrupted_save_checkpoint(command, thread_id):
+            # The second batch is committed, but its checkpoint is lost.
+            calls.append(thread_id)
+            if len(calls) == 2:
+                raise KeyboardInterrupt
+            save_checkpoint(command, thread_id)
+
+        with patch.object(Command, 'save_checkpoint', interrupted_save_checkpoint):
+            with self.assertRaises(KeyboardInterrupt):
+                self.migrate(batch_size=2)
+        with open(self.checkpoint) as f:
+            self.assertEqual(json.load(f), {'thread_id': 1, 'imported': 4})
+        self.assertEqual(TreeComment.objects.filter(depth__gt=1).count(), 6)
+
+        output = self.migrate(batch_size=2, resume=True)
+        self.assertIn("Migrated 7 comments.", output)
+        self.assertEqual(self.tree_of(self.article_1), [
+            ("Comment 1", 2, 2),
+            ("Reply 1", 3, 1),
+            ("Reply to reply 1", 4, 0),
+            ("Reply 2", 3, 0),
+            ("Comment 3", 2, 0),
+        ])
+        self.assertEqual(self.tree_of(self.article_2),
+                         [("Comment 2", 2, 0), ("Comment 4", 2, 0)])
+        root = TreeComment.objects.get_or_create_root(self.article_1)
+        self.assertEqual(root.numchild, 2)
+        assoc = CommentAssociation.objects.get(root=root)
+        self.assertEqual((assoc.total_count, assoc.public_count), (5, 4))
@@ -6,11 +6,14 @@ from django.db import connection, reset_queries
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
 from django.conf import settings
-from django.test import TestCase as DjangoTestCase, override_settings
+from django.contrib.auth.models import User
+from django.test import (RequestFactory, TestCase as DjangoTestCase,
+                         override_settings)
 
 from django_comments_tree.models import (TreeComment, CommentAssociation,
                                          MaxThreadLevelExceededException)
 from django_comments_tree.tests.models import Article, Diary
+from django_comments_tree.views.moderation import perform_approve, perform_delete
 
 
 class ArticleBaseTestCase(DjangoTestCase):
@@ -56,8 +59,9 @@ class CommentAssociationTestCase(ArticleBaseTestCase):
 
         self.assertEqual(comment.assoc, root.commentassociation)
 
-        # Only the insert of comment and update of root depth
-        self.assertEqual(len(connection.queries), 2)
+        # Only the insert of comment, the update of the association
+        # counters and the update of root depth
+        self.assertEqual(len(connection.queries), 3)
 
     @override_settings(DEBUG=True)
     def test_association_is_added_at_depth(self):
@@ -70,8 +74,9 @@ class CommentAssociationTestCase(ArticleBaseTestCase):
         self.assertEqual(comment2.assoc, root.commentassociation)
         self.assertEqual(comment3.assoc, root.commentassociation)
 
-        # Only the insert of comment and update of root depth
-        self.assertEqual(len(connection.queries), 6)
+        # Only the insert of comment, the update of the association
+        # counters and the update of root depth
+        self.assertEqual(len(connection.queries), 9)
 
     def test_association_is_updated_on_change(self):
         root = self.root
@@ -83,3 +88,78 @@ class CommentAssociationTestCase(ArticleBaseTestCase):
         self.assertEqual(comment3.assoc, root.commentassociation)
 
 
+
+
+class CommentAssociationCountsTestCase(ArticleBaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.root = TreeComment.objects.get_or_create_root(self.article_1)
+        self.user = User.objects.create_user("bob", "", "pwd")
+        self.request = RequestFactory().post('/')
+        self.request.user = self.user
+
+    def counts(self):
+        assoc = CommentAssociation.objects.get(root=self.root)
+        return assoc.total_count, assoc.public_count, assoc.pending_count
+
+    def test_counts_on_create(self):
+        comment = self.add_comment(self.root)
+        self.add_comment(comment)
+        self.root.add_child(comment="In moderation", is_public=False)
+        self.assertEqual(self.counts(), (3, 2, 1))
+        assoc = CommentAssociation.objects.get(root=self.root)
+        self.assertIsNotNone(assoc.last_activity)
+
+    def test_counts_on_moderation(self):
+        comment = self.add_comment(self.root)
+        reply = self.add_comment(comment)
+
+        comment = TreeComment.objects.get(pk=comment.pk)
+        comment.is_public = False
+        comment.save()
+        self.assertEqual(self.counts(), (2, 1, 1))
+
+        perform_approve(self.request, comment)
+        self.assertEqual(self.counts(), (2, 2, 0))
+
+        # Removing a comment unpublishes its replies, which leaves them
+        # waiting for moderation.
+        perform_delete(self.request, comment)
+        self.assertEqual(self.counts(), (2, 1, 1))
+
+        reply.refresh_from_db()
+        perform_approve(self.request, reply)
+        self.assertEqual(self.counts(), (2, 2, 0))
+
+    def test_counts_with_deferred_fields(self):
+        comment = self.add_comment(self.root)
+        comment = TreeComment.objects.only('id', 'path').get(pk=comment.pk)
+        comment.is_public = False
+        comment.save()
+        self.assertEqual(self.counts(), (1, 0, 1))
+
+    def test_counts_on_delete(self):
+        comment = self.add_comment(self.root)
+        self.add_comment(comment)
+        self.add_comment(self.root)
+        TreeComment.objects.get(pk=comment.pk).delete()
+        self.assertEqual(self.counts(), (1, 1, 0))
+
+    def test_refresh_counts(self):
+        self.add_comment(self.root)
+        CommentAssociation.objects.update(total_count=0, public_count=0)
+        assoc = CommentAssociation.objects.get(root=self.root)
+        assoc.refresh_counts()
+        self.assertEqual(self.counts(), (1, 1, 0))
+
+    def test_count_for_object(self):
+        self.add_comment(self.root)
+        self.root.add_child(comment="In moderation", is_public=False)
+        content_type = ContentType.objects.get_for_model(self.article_1)
+        with self.assertNumQueries(1):
+            total = TreeComment.objects.count_for_object(content_type,
+                                                         self.article_1.pk)
+        self.assertEqual(total, 2)
+        self.assertEqual(TreeComment.objects.count_for_model(self.article_1,
+                                                             public=True), 1)
+        self.assertEqual(TreeComment.objects.count_for_model(self.article_2), 0)
@@ -1,15 +1,19 @@
 from datetime import datetime
 from textwrap import dedent
 from os.path import join, dirname
+from unittest.mock import patch
 
 from django.db import connection, reset_queries
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
-from django.conf import settings
+from django_comments_tree.conf import settings
+from django.core.cache import cache
 from django.test import TestCase as DjangoTestCase, override_settings
 
 from django_comments_tree.models import (TreeComment, CommentAssociation,
-                                         MaxThreadLevelExceededException)
+                                         MaxThreadLevelExceededException,
+                                         UserFlagIndex, root_cache)
+from django_comments_tree.tests import benchmark
 from django_comments_tree.tests.models import Article, Diary
 
 from django_comments_tree.models import (LIKEDIT_FLAG, DISLIKEDIT_FLAG,
@@ -76,3 +80,149 @@ class TestModelManager(ManagerTestBase):
         self.assertEqual(len(dislikes), 2)
         self.assertEqual(len(reported), 1)
         self.assertEqual(likes, [self.c1list[0].id, self.c1list[2].id, self.c1list[7].id])
+
+
+class UserFlagIndexTestCase(ManagerTestBase):
+    def setUp(self):
+        cache.clear()
+        root_cache.clear()
+
+    def flags(self, model=None):
+        return TreeComment.objects.user_flags_for_model(self.user1,
+                                                        model or self.article_1)
+
+    def test_cached(self):
+        self.flags()
+        with self.assertNumQueries(0):
+            result = self.flags()
+        self.assertEqual(result['liked'],
+                         [self.c1list[0].id, self.c1list[2].id, self.c1list[7].id])
+        self.assertEqual(result['reported'], [self.c1list[7].id])
+
+    def test_flag_changes_are_seen(self):
+        self.flags()
+        flag, created = TreeCommentFlag.objects.add_flag(self.c1list[5], self.user1,
+                                                         LIKEDIT_FLAG)
+        self.assertIn(self.c1list[5].id, self.flags()['liked'])
+        TreeCommentFlag.objects.remove_flag(flag)
+        self.assertNotIn(self.c1list[5].id, self.flags()['liked'])
+        TreeCommentFlag.objects.remove_flags(self.c1list[7], self.user1,
+                                             [TreeCommentFlag.SUGGEST_REMOVAL])
+        self.assertEqual(self.flags()['reported'], [])
+        TreeCommentFlag.objects.add_flags([self.c1list[8].id], self.user1,
+                                          TreeCommentFlag.SUGGEST_REMOVAL)
+        self.assertEqual(self.flags()['reported'], [])
+
+    def test_other_users_and_objects(self):
+        TreeCommentFlag.objects.add_flag(self.c2list[0], self.user1, LIKEDIT_FLAG)
+        TreeCommentFlag.objects.add_flag(self.c1list[4], self.user2, LIKEDIT_FLAG)
+        self.assertEqual(len(self.flags()['liked']), 3)
+        self.assertEqual(self.flags(self.article_2)['liked'], [self.c2list[0].id])
+        self.assertEqual(self.flags(Article)['liked'],
+                         sorted([self.c1list[0].id, self.c1list[2].id,
+                                 self.c1list[7].id, self.c2list[0].id]))
+        self.assertEqual(self.flags(ArticleFactory.create())['liked'], [])
+
+    def test_model_class_in_one_query(self):
+        with self.assertNumQueries(1):
+            self.flags(Article)
+        with self.assertNumQueries(1):
+            self.flags(Article)
+
+    def test_users_without_flags_are_not_cached(self):
+        TreeComment.objects.user_flags_for_model(self.user2, self.article_1)
+        self.assertIsNone(cache.get(UserFlagIndex.cache_key(self.user2.pk,
+                                                            self.root_1.assoc_id)))
+        with patch('django_comments_tree.models.cache.set_many') as set_many:
+            self.flags()
+        self.assertEqual(set_many.call_args[0][1],
+                         settings.COMMENTS_TREE_USER_FLAGS_CACHE_TIMEOUT)
+
+
+@benchmark
+class UserFlagIndexBenchmark(DjangoTestCase):
+    """
+    Load the flags of a user on a thread of 10,000 comments, from the
+    database and from the cache.
+    """
+    count = 10000
+
+    def test_large_thread(self):
+        cache.clear()
+        article = ArticleFactory.create()
+        user = UserFactory.create()
+        root = TreeComment.objects.get_or_create_root(article)
+        TreeComment.objects.bulk_create([
+            TreeComment(path=TreeComment._get_path(root.path, 2, i + 1), depth=2,
+                        assoc=root.assoc, comment="Comment %d" % i)
+            for i in range(self.count)
+        ])
+        flags = [LIKEDIT_FLAG, DISLIKEDIT_FLAG, LIKEDIT_FLAG]
+        TreeCommentFlag.objects.bulk_create([
+            TreeCommentFlag(comment_id=pk, user=user, flag=flags[i % 3],
+                            flag_date=datetime.now())
+            for i, pk in enumerate(TreeComment.objects.filter(depth=2)
+                                   .values_list('pk', flat=True))
+        ])
+
+        result = TreeComment.objects.user_flags_for_model(user, article)
+        with self.assertNumQueries(0):
+            self.assertEqual(TreeComment.objects.user_flags_for_model(user, article),
+                             result)
+        self.assertEqual(len(result['liked']) + len(result['disliked']), self.count)
+
+
+class RootCacheTestCase(DjangoTestCase):
+    def setUp(self):
+        cache.clear()
+        root_cache.clear()
+        self.article_1 = ArticleFactory.create()
+        self.article_2 = ArticleFactory.create()
+        self.root_1 = TreeComment.objects.get_or_create_root(self.article_1)
+        self.root_2 = TreeComment.objects.get_or_create_root(self.article_2)
+        # Roots created in a transaction are cached when it commits.
+        TreeComment.objects.get_or_create_root(self.article_1)
+        TreeComment.objects.get_or_create_root(self.article_2)
+
+    def key(self, article):
+        return (ContentType.objects.get_for_model(article).pk, article.pk,
+                settings.SITE_ID)
+
+    def test_existing_root_in_one_query(self):
+        with self.assertNumQueries(1):
+            root = TreeComment.objects.get_or_create_root(self.article_1)
+        self.assertEqual(root, self.root_1)
+        # Only the writes: no lookup of the association or content type.
+        with self.assertNumQueries(3):
+            root.add_child(comment="A comment")
+
+    def test_shared_cache(self):
+        root_cache.clear()
+        with self.assertNumQueries(1):
+            root = TreeComment.objects.get_root(self.article_2)
+        self.assertEqual(root, self.root_2)
+
+    def test_process_cache_size(self):
+        with patch.multiple('django_comments_tree.conf.settings',
+                            COMMENTS_TREE_ROOT_CACHE_SIZE=1):
+            root_cache.clear()
+            TreeComment.objects.get_root(self.article_1)
+            TreeComment.objects.get_root(self.article_2)
+        self.assertEqual(list(root_cache.local), [self.key(self.article_2)])
+
+    def test_stale_entry_is_checked(self):
+        # An entry pointing to the root of another object.
+        root_cache.set(self.key(self.article_1),
+                       (self.root_2.commentassociation.pk, self.root_2.pk))
+        root = TreeComment.objects.get_or_create_root(self.article_1)
+        self.assertEqual(root, self.root_1)
+        self.assertEqual(root_cache.get(self.key(self.article_1)),
+                         (self.root_1.commentassociation.pk, self.root_1.pk))
+
+    def test_deleted_association_is_forgotten(self):
+        CommentAssociation.objects.get(root=self.root_1).delete()
+        self.assertIsNone(root_cache.get(self.key(self.article_1)))
+        self.assertIsNone(TreeComment.objects.get_root(self.article_1))
+        root = TreeComment.objects.get_or_create_root(self.article_1)
+        self.assertNotEqual(root.pk, self.root_1.pk)
+        self.assertEqual(root.commentassociation.object_id, self.article_1.pk)
@@ -1,15 +1,27 @@
-from datetime import datetime
+import threading
+from datetime import datetime, timedelta
+from io import StringIO
 from textwrap import dedent
 from os.path import join, dirname
+from unittest import skipUnless
+from unittest.mock import patch
 
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
 from django.conf import settings
-from django.test import TestCase as DjangoTestCase
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.db.models.signals import post_delete, post_save
+from django.test import TestCase as DjangoTestCase, TransactionTestCase
+from django.utils import timezone
 
 from django_comments_tree.models import (TreeComment, CommentAssociation,
-                                         MaxThreadLevelExceededException)
+                                         TmpTreeComment, TreeCommentFlag,
+                                         MaxThreadLevelExceededException,
+                                         LIKEDIT_FLAG, DISLIKEDIT_FLAG)
 from django_comments_tree.tests.models import Article, Diary
+from django_comments_tree.utils import get_content_hash
 
 
 class ArticleBaseTestCase(DjangoTestCase):
@@ -442,6 +454,42 @@ class DiaryBaseTestCase(DjangoTestCase):
             c.add_child(comment="Comment should cause an exception now")
 
 
+class WithContextTestCase(ArticleBaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.diary = Diary.objects.create(body="About Today...")
+        for obj in (self.article_1, self.article_2, self.diary):
+            root = TreeComment.objects.get_or_create_root(obj)
+            for i in range(3):
+                root.add_child(comment="Comment %d" % i)
+
+    def read(self, comments):
+        return [(c.content_type.model, c.object_id, c.site.pk, c.content_object,
+                 c.get_absolute_url(), c.allow_thread()) for c in comments]
+
+    def test_constant_queries(self):
+        plain = self.read(TreeComment.objects.filter(depth=2))
+        # The comments, the articles and the diary entries.
+        with self.assertNumQueries(3):
+            comments = list(TreeComment.objects.with_context().filter(depth=2))
+            self.assertEqual(self.read(comments), plain)
+        self.assertEqual({c.content_object for c in comments},
+                         {self.article_1, self.article_2, self.diary})
+
+    def test_without_content_objects(self):
+        with self.assertNumQueries(1):
+            comments = list(TreeComment.objects.filter(depth=2)
+                            .with_context(content_objects=False))
+            for comment in comments:
+                comment.content_type, comment.site, comment.get_absolute_url()
+
+    def test_content_object_is_cached(self):
+        comment = TreeComment.objects.filter(depth=2).first()
+        comment.content_object
+        with self.assertNumQueries(0):
+            self.assertEqual(comment.content_object, self.article_1)
+
+
 class TestCommentsForModel(ArticleBaseTestCase):
 
     def setUp(self):
@@ -504,3 +552,290 @@ class TestCommentsManager(ArticleBaseTestCase):
 
 
 
+
+
+class TestFlagCounters(ArticleBaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.root = TreeComment.objects.get_or_create_root(self.article_1)
+        self.comment = self.root.add_child(comment="just a testing comment")
+        self.alice = User.objects.create_user("alice", "", "pwd")
+        self.bob = User.objects.create_user("bob", "", "pwd")
+
+    def counters(self):
+        return TreeComment.objects.values_list(
+            'likes_count', 'dislikes_count', 'reports_count').get(pk=self.comment.pk)
+
+    def test_add_and_remove_flags(self):
+        flags = TreeCommentFlag.objects
+        flags.add_flag(self.comment, self.alice, LIKEDIT_FLAG)
+        flags.add_flag(self.comment, self.bob, LIKEDIT_FLAG)
+        flags.add_flag(self.comment, self.bob, DISLIKEDIT_FLAG)
+        flag, created = flags.add_flag(self.comment, self.bob,
+                                       TreeCommentFlag.SUGGEST_REMOVAL)
+        self.assertTrue(created)
+        self.assertEqual(self.counters(), (2, 1, 1))
+        self.assertEqual(self.comment.likes_count, 2)
+
+        # Flagging twice is not counted twice.
+        flag, created = flags.add_flag(self.comment, self.bob,
+                                       TreeCommentFlag.SUGGEST_REMOVAL)
+        self.assertFalse(created)
+        self.assertEqual(self.counters(), (2, 1, 1))
+
+        self.assertTrue(flags.remove_flag(flag))
+        self.assertFalse(flags.remove_flag(flag))
+        flags.remove_flags(self.comment, self.bob, [LIKEDIT_FLAG, DISLIKEDIT_FLAG])
+        self.assertEqual(self.counters(), (1, 0, 0))
+
+    def test_add_flags_counts_only_inserted_flags(self):
+        other = self.root.add_child(comment="another comment")
+        bulk_create = TreeCommentFlag.objects.bulk_create
+
+        def concurrent_bulk_create(objs, **kwargs):
+            # Another request reports the first comment in the meantime.
+            TreeCommentFlag.objects.create(
+                comment=self.comment, user=self.alice,
+                flag=TreeCommentFlag.SUGGEST_REMOVAL,
+                flag_date=timezone.now() - timedelta(seconds=1))
+            TreeComment.objects.filter(pk=self.comment.pk).update(reports_count=1)
+            return bulk_create(objs, **kwargs)
+
+        with patch.object(TreeCommentFlag.objects, 'bulk_create', concurrent_bulk_create):
+            created = TreeCommentFlag.objects.add_flags(
+                [self.comment.pk, other.pk], self.alice, TreeCommentFlag.SUGGEST_REMOVAL)
+        self.assertEqual(created, [other.pk])
+        self.assertEqual(self.counters(), (0, 0, 1))
+        self.assertEqual(TreeComment.objects.get(pk=other.pk).reports_count, 1)
+
+    def test_uncounted_flags(self):
+        TreeCommentFlag.objects.add_flag(self.comment, self.alice,
+                                         TreeCommentFlag.MODERATOR_DELETION)
+        self.assertEqual(self.counters(), (0, 0, 0))
+
+    def test_save_does_not_overwrite_counters(self):
+        stale = TreeComment.objects.get(pk=self.comment.pk)
+        TreeCommentFlag.objects.add_flag(self.comment, self.alice, LIKEDIT_FLAG)
+        stale.is_public = False
+        stale.save()
+        self.assertEqual(self.counters(), (1, 0, 0))
+
+    def test_rebuild_counters(self):
+        TreeCommentFlag.objects.create(comment=self.comment, user=self.alice,
+                                       flag=LIKEDIT_FLAG)
+        TreeCommentFlag.objects.create(comment=self.comment, user=self.bob,
+                                       flag=TreeCommentFlag.SUGGEST_REMOVAL)
+        self.assertEqual(self.counters(), (0, 0, 0))
+
+        call_command('rebuild_flag_counters', stdout=StringIO())
+        self.assertEqual(self.counters(), (1, 0, 1))
+
+    def test_structured_data_likes(self):
+        TreeCommentFlag.objects.add_flag(self.comment, self.alice, LIKEDIT_FLAG)
+        data = TreeComment.structured_tree_data(self.root)
+        self.assertEqual(data['comments'][0].likes, 1)
+
+    def test_toggle_flag(self):
+        flags = TreeCommentFlag.objects
+        flag, created = flags.toggle_flag(self.comment, self.alice, LIKEDIT_FLAG,
+                                          opposite=[DISLIKEDIT_FLAG])
+        self.assertTrue(created)
+        self.assertEqual(self.counters(), (1, 0, 0))
+        self.assertEqual(self.comment.likes_count, 1)
+
+        # Disliking removes the like.
+        flag, created = flags.toggle_flag(self.comment, self.alice, DISLIKEDIT_FLAG,
+                                          opposite=[LIKEDIT_FLAG])
+        self.assertTrue(created)
+        self.assertEqual(self.counters(), (0, 1, 0))
+        self.assertEqual(list(flags.values_list('flag', flat=True)), [DISLIKEDIT_FLAG])
+
+        # Disliking again removes the dislike.
+        flag, created = flags.toggle_flag(self.comment, self.alice, DISLIKEDIT_FLAG,
+                                          opposite=[LIKEDIT_FLAG])
+        self.assertFalse(created)
+        self.assertEqual(self.counters(), (0, 0, 0))
+        self.assertFalse(flags.exists())
+
+    def test_toggle_flag_saves_flags(self):
+        saved, deleted = [], []
+        post_save.connect(lambda instance, created, **kw: saved.append((instance, created)),
+                          sender=TreeCommentFlag, weak=False, dispatch_uid='test-saved')
+        post_delete.connect(lambda instance, **kw: deleted.append((instance.pk,
+                                                                   instance.flag)),
+                            sender=TreeCommentFlag, weak=False, dispatch_uid='test-deleted')
+        self.addCleanup(post_save.disconnect, sender=TreeCommentFlag,
+                        dispatch_uid='test-saved')
+        self.addCleanup(post_delete.disconnect, sender=TreeCommentFlag,
+                        dispatch_uid='test-deleted')
+
+        flag, created = TreeCommentFlag.objects.toggle_flag(
+            self.comment, self.alice, LIKEDIT_FLAG, opposite=[DISLIKEDIT_FLAG])
+        self.assertTrue(created)
+        self.assertIsNotNone(flag.pk)
+        self.assertEqual(TreeCommentFlag.objects.get().pk, flag.pk)
+        self.assertEqual([(f.pk, c) for f, c in saved], [(flag.pk, True)])
+
+        TreeCommentFlag.objects.toggle_flag(
+            self.comment, self.alice, DISLIKEDIT_FLAG, opposite=[LIKEDIT_FLAG])
+        self.assertEqual(deleted, [(flag.pk, LIKEDIT_FLAG)])
+        self.assertEqual(self.counters(), (0, 1, 0))
+
+    def test_toggle_flag_statement(self):
+        saved, deleted = [], []
+        post_save.connect(lambda instance, created, **kw: saved.append((instance, created)),
+                          sender=TreeCommentFlag, weak=False, dispatch_uid='test-saved')
+        post_delete.connect(lambda instance, **kw: deleted.append((instance.pk,
+                                                                   instance.flag)),
+                            sender=TreeCommentFlag, weak=False, dispatch_uid='test-deleted')
+        self.addCleanup(post_save.disconnect, sender=TreeCommentFlag,
+                        dispatch_uid='test-saved')
+        self.addCleanup(post_delete.disconnect, sender=TreeCommentFlag,
+                        dispatch_uid='test-deleted')
+
+        flags = [LIKEDIT_FLAG, DISLIKEDIT_FLAG]
+        now = timezone.now()
+        if connection.vendor == 'postgresql':
+            TreeCommentFlag.objects.add_flag(self.comment, self.alice, DISLIKEDIT_FLAG)
+            disliked = TreeCommentFlag.objects.get().pk
+            obj, deltas = TreeCommentFlag.objects._toggle_flag_statement(
+                connection, self.comment, self.alice, LIKEDIT_FLAG, flags, now)
+            self.assertEqual(TreeCommentFlag.objects.get().pk, obj.pk)
+            self.assertEqual(self.counters(), (1, 0, 0))
+        else:
+            # Run the PostgreSQL statement path against a canned result.
+            disliked = 40
+            with patch.object(connection, 'cursor') as cursor:
+                execute = cursor.return_value.__enter__.return_value
+                execute.fetchone.return_value = (41, [disliked], [DISLIKEDIT_FLAG])
+                obj, deltas = TreeCommentFlag.objects._toggle_flag_statement(
+                    connection, self.comment, self.alice, LIKEDIT_FLAG, flags, now)
+            params = execute.execute.call_args[0][1]
+            self.assertEqual(params[:2], [self.comment.pk, self.alice.pk])
+            self.assertEqual(obj.pk, 41)
+
+        self.assertEqual(deltas, {LIKEDIT_FLAG: 1, DISLIKEDIT_FLAG: -1})
+        self.assertEqual((obj.comment, obj.user, obj.flag),
+                         (self.comment, self.alice, LIKEDIT_FLAG))
+        self.assertEqual([(f.pk, c) for f, c in saved], [(obj.pk, True)])
+        self.assertEqual(deleted, [(disliked, DISLIKEDIT_FLAG)])
+
+    def test_toggle_flag_queries(self):
+        TreeCommentFlag.objects.add_flag(self.comment, self.alice, DISLIKEDIT_FLAG)
+        # Read the flags, delete the dislike, insert the like and update
+        # the counters, in one statement on PostgreSQL. Elsewhere the
+        # comment is locked where possible, and the dislike deleted and the
+        # like created by the ORM, with two savepoints.
+        if connection.vendor == 'postgresql':
+            queries = 3
+        else:
+            queries = 8 + connection.features.has_select_for_update
+        with self.assertNumQueries(queries):
+            TreeCommentFlag.objects.toggle_flag(self.comment, self.alice, LIKEDIT_FLAG,
+                                                opposite=[DISLIKEDIT_FLAG])
+        self.assertEqual(self.counters(), (1, 0, 0))
+
+
+@skipUnless(connection.features.has_select_for_update,
+            "Concurrent toggles are only serialized with row locks")
+class ConcurrentToggleTestCase(TransactionTestCase):
+    """
+    Toggle the likes and dislikes of many users on one comment from many
+    threads at once, with every thread also toggling the like of the first
+    user, like double clicks. The counters must match the flags, and each
+    user must end up with a like or nothing.
+    """
+    threads = 8
+    toggles = 5
+
+    def test_hammer_one_comment(self):
+        article = Article.objects.create(
+            title="September", slug="september", body="During September...")
+        root = TreeComment.objects.get_or_create_root(article)
+        comment = root.add_child(comment="just a testing comment")
+        users = [User.objects.create_user("user%d" % i, "", "pwd")
+                 for i in range(self.threads)]
+        errors = []
+
+        def toggle(user):
+            try:
+                for i in range(self.toggles):
+                    for flag, opposite in ((LIKEDIT_FLAG, DISLIKEDIT_FLAG),
+                                           (DISLIKEDIT_FLAG, LIKEDIT_FLAG)):
+                        if i == self.toggles - 1 and flag == DISLIKEDIT_FLAG:
+                            break
+                        TreeCommentFlag.objects.toggle_flag(
+                            TreeComment.objects.get(pk=comment.pk), user, flag,
+                            opposite=[opposite])
+                    # And a double click on the same user's like.
+                    TreeCommentFlag.objects.toggle_flag(
+                        TreeComment.objects.get(pk=comment.pk), users[0], LIKEDIT_FLAG,
+                        opposite=[DISLIKEDIT_FLAG])
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=toggle, args=(user,)) for user in users]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        likes = TreeCommentFlag.objects.filter(comment=comment, flag=LIKEDIT_FLAG).count()
+        dislikes = TreeCommentFlag.objects.filter(comment=comment,
+                                                  flag=DISLIKEDIT_FLAG).count()
+        comment.refresh_from_db()
+        self.assertEqual((comment.likes_count, comment.dislikes_count), (likes, dislikes))
+        self.assertEqual(dislikes, 0)
+        self.assertGreaterEqual(likes, self.threads - 1)
+
+
+class ContentHashTestCase(ArticleBaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.root = TreeComment.objects.get_or_create_root(self.article_1)
+        self.comment = self.root.add_child(
+            comment="Es war einmal\n eine  kleine...", user_name="Bob",
+            user_email="bob@example.com")
+
+    def tmp_comment(self, article, **kwargs):
+        data = dict(content_type=ContentType.objects.get_for_model(article),
+                    object_id=str(article.pk), site_id=settings.SITE_ID,
+                    user_name="Bob", user_email="Bob@example.com",
+                    comment="es war einmal eine kleine...",
+                    submit_date=self.comment.submit_date)
+        data.update(kwargs)
+        return TmpTreeComment(data)
+
+    def test_content_hash(self):
+        self.assertEqual(
+            self.comment.content_hash,
+            get_content_hash("Bob", "bob@example.com", "Es war einmal eine kleine...",
+                             self.comment.submit_date))
+        self.assertEqual(TreeComment.objects.get(pk=self.comment.pk).content_hash,
+                         self.comment.content_hash)
+
+        comment = TreeComment.objects.get(pk=self.comment.pk)
+        comment.comment = "Once upon a time..."
+        comment.save(update_fields=['comment'])
+        self.assertEqual(
+            TreeComment.objects.get(pk=self.comment.pk).content_hash,
+            get_content_hash("Bob", "bob@example.com", "Once upon a time...",
+                             self.comment.submit_date))
+
+    def test_duplicates_of(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                list(TreeComment.objects.duplicates_of(self.tmp_comment(self.article_1))),
+                [self.comment])
+        for tmp_comment in [
+                self.tmp_comment(self.article_2),
+                self.tmp_comment(self.article_1, comment="Another comment"),
+                self.tmp_comment(self.article_1, user_name="Alice"),
+                self.tmp_comment(self.article_1,
+                                 submit_date=timezone.now() + timedelta(days=1)),
+        ]:
+            self.assertFalse(TreeComment.objects.duplicates_of(tmp_comment).exists())
@@ -10,13 +10,17 @@ from datetime import datetime, timedelta
 
 import django
 from django.contrib.auth.models import AnonymousUser, User
+from django.db import connection
 from django.test import TestCase, RequestFactory
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
-from django_comments_tree.models import TreeCommentFlag
+from django_comments_tree.models import TreeComment, TreeCommentFlag
 
 import django_comments_tree
+from django_comments_tree.signals import comments_were_flagged
 from django_comments_tree.views import comments as views
+from django_comments_tree.views import moderation
 from django_comments_tree.models import LIKEDIT_FLAG, DISLIKEDIT_FLAG
 from django_comments_tree.tests.models import Diary
 from django_comments_tree.tests.test_views import (confirm_comment_url,
@@ -374,3 +378,77 @@ class FlaggingLikedItAndDislikedIt(TestCase):
                                            user=self.user,
                                            flag=DISLIKEDIT_FLAG)
         self.assertEqual(flags.count(), 1, f"Expected value to be 1")
+
+
+class BulkModeration(TestCase):
+    """Scenario to test moderating many comments at once, as the admin does"""
+
+    def setUp(self):
+        patcher = patch('django_comments_tree.moderation.send_mail')
+        self.mailer = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.diary_entry = Diary.objects.create(
+            body="What I did on October...",
+            allow_comments=True,
+            publish=datetime.now())
+        self.root = TreeComment.objects.get_or_create_root(self.diary_entry)
+        self.comments = [self.root.add_child(comment="Comment %d" % i,
+                                             is_public=False)
+                         for i in range(5)]
+        self.reply = self.comments[0].add_child(comment="A reply")
+        self.user = User.objects.create_superuser("alice", "alice@example.com", "pwd")
+        self.received = []
+        comments_were_flagged.connect(self.receive)
+        self.addCleanup(comments_were_flagged.disconnect, self.receive)
+
+    def receive(self, sender, **kwargs):
+        self.received.append(kwargs)
+
+    def perform(self, action, pks):
+        request = request_factory.post('/admin/')
+        request.user = self.user
+        return action(request, TreeComment.objects.filter(pk__in=pks))
+
+    def test_approve(self):
+        pks = [c.pk for c in self.comments]
+        self.assertEqual(self.perform(moderation.perform_bulk_approve, pks), 5)
+        self.assertEqual(TreeComment.objects.filter(pk__in=pks, is_public=True).count(), 5)
+        self.assertEqual(TreeCommentFlag.objects.filter(
+            flag=TreeCommentFlag.MODERATOR_APPROVAL).count(), 5)
+        self.assertEqual(len(self.received), 1)
+        self.assertEqual(self.received[0]['comment_ids'], sorted(pks))
+        self.assertEqual(self.received[0]['created_ids'], sorted(pks))
+        self.root.assoc.refresh_from_db()
+        self.assertEqual(self.root.assoc.public_count, 6)
+
+        # Approving again doesn't add flags.
+        self.perform(moderation.perform_bulk_approve, pks)
+        self.assertEqual(self.received[1]['created_ids'], [])
+        self.assertEqual(TreeCommentFlag.objects.count(), 5)
+
+    def test_delete_unpublishes_replies(self):
+        self.perform(moderation.perform_bulk_delete, [self.comments[0].pk])
+        self.comments[0].refresh_from_db()
+        self.reply.refresh_from_db()
+        self.assertTrue(self.comments[0].is_removed)
+        self.assertFalse(self.reply.is_public)
+        self.comments[1].refresh_from_db()
+        self.assertFalse(self.comments[1].is_removed)
+        self.root.assoc.refresh_from_db()
+        self.assertEqual(self.root.assoc.public_count, 0)
+
+    def test_flag(self):
+        pks = [c.pk for c in self.comments[:2]]
+        self.perform(moderation.perform_bulk_flag, pks)
+        self.perform(moderation.perform_bulk_flag, pks)
+        self.assertEqual(list(TreeComment.objects.filter(pk__in=pks)
+                              .values_list('reports_count', flat=True)), [1, 1])
+        self.assertEqual(self.mailer.call_count, 2)
+
+    def test_queries_do_not_grow(self):
+        counts = []
+        for comments in (self.comments[:1], self.comments):
+            with CaptureQueriesContext(connection) as queries:
+                self.perform(moderation.perform_bulk_delete, [c.pk for c in comments])
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
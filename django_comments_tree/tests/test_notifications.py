@@ -0,0 +1,127 @@
+import threading
+from unittest.mock import patch
+
+from django.core import mail
+from django.core.mail.backends import locmem
+from django.db import transaction
+from django.test import (TestCase as DjangoTestCase, TransactionTestCase,
+                         override_settings)
+
+from django_comments_tree import notifications
+from django_comments_tree.models import TreeComment
+from django_comments_tree.notifications import (SyncDispatcher,
+                                                ThreadedDispatcher,
+                                                get_dispatcher,
+                                                send_followup_notifications)
+from django_comments_tree.tests.models import Article
+
+
+class CountingBackend(locmem.EmailBackend):
+    batches = []
+
+    def send_messages(self, messages):
+        self.batches.append(len(messages))
+        return super().send_messages(messages)
+
+
+class SendFollowupNotificationsTestCase(DjangoTestCase):
+    def setUp(self):
+        self.article = Article.objects.create(
+            title="September", slug="september", body="During September...")
+        self.root = TreeComment.objects.get_or_create_root(self.article)
+        CountingBackend.batches = []
+
+    def add_comment(self, email, followup=True, **kwargs):
+        return self.root.add_child(comment="A comment", user_email=email,
+                                   user_name=email.split('@')[0],
+                                   followup=followup, **kwargs)
+
+    def test_one_message_per_follower(self):
+        bob = self.add_comment("bob@example.com")
+        bob.add_child(comment="Bob again", user_email="bob@example.com",
+                      followup=True)
+        self.add_comment("alice@example.com")
+        self.add_comment("charlie@example.com", followup=False)
+        self.add_comment("dave@example.com", is_public=False)
+        comment = self.add_comment("alice@example.com")
+
+        self.assertEqual(send_followup_notifications(comment), 1)
+        self.assertEqual([m.to for m in mail.outbox], [["bob@example.com"]])
+        self.assertIn("/mute/", mail.outbox[0].body)
+        self.assertEqual(len(mail.outbox[0].alternatives), 1)
+
+    @override_settings(EMAIL_BACKEND=(
+        'django_comments_tree.tests.test_notifications.CountingBackend'))
+    def test_messages_are_sent_in_batches(self):
+        for i in range(5):
+            self.add_comment("user%d@example.com" % i)
+        comment = self.add_comment("alice@example.com")
+
+        with self.assertNumQueries(4):
+            # The root, the followers, the site and the article.
+            self.assertEqual(send_followup_notifications(comment, batch_size=2), 5)
+        self.assertEqual(CountingBackend.batches, [2, 2, 1])
+        self.assertEqual(len(mail.outbox), 5)
+
+    def test_get_dispatcher(self):
+        self.assertIsInstance(get_dispatcher(), SyncDispatcher)
+        with patch.multiple('django_comments_tree.conf.settings',
+                            COMMENTS_TREE_NOTIFICATION_DISPATCHER=None,
+                            COMMENTS_TREE_THREADED_EMAILS=True):
+            self.assertIsInstance(get_dispatcher(), ThreadedDispatcher)
+            self.assertIs(get_dispatcher(), get_dispatcher())
+
+
+class ThreadedDispatcherTestCase(TransactionTestCase):
+    def setUp(self):
+        self.article = Article.objects.create(
+            title="September", slug="september", body="During September...")
+        self.root = TreeComment.objects.get_or_create_root(self.article)
+        self.dispatcher = ThreadedDispatcher(max_workers=1)
+        self.addCleanup(self.dispatcher.shutdown)
+
+    def test_dispatch_after_commit_once(self):
+        comment = self.root.add_child(comment="A comment")
+        release = threading.Event()
+        sent = []
+
+        def send(comment):
+            release.wait(5)
+            sent.append(comment.pk)
+
+        with patch.object(notifications, 'send_followup_notifications', send):
+            with transaction.atomic():
+                self.dispatcher.dispatch(comment)
+                self.dispatcher.dispatch(comment)
+                self.assertEqual(self.dispatcher._pending, set())
+            self.assertEqual(self.dispatcher._pending, {comment.pk})
+            self.assertIsNone(self.dispatcher.submit(comment.pk))
+            release.set()
+            self.dispatcher.shutdown()
+
+        self.assertEqual(sent, [comment.pk])
+        self.assertEqual(self.dispatcher._pending, set())
+
+    @patch.multiple('django_comments_tree.conf.settings',
+                    COMMENTS_TREE_MAIL_QUEUE_TIMEOUT=0)
+    def test_drop_when_full(self):
+        dispatcher = ThreadedDispatcher(max_workers=1, queue_size=1)
+        self.addCleanup(dispatcher.shutdown)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        sent = []
+
+        def send(comment):
+            release.wait(5)
+            sent.append(comment.pk)
+
+        comments = [self.root.add_child(comment="Comment %d" % i) for i in range(3)]
+        with patch.object(notifications, 'send_followup_notifications', send):
+            self.assertIsNotNone(dispatcher.submit(comments[0].pk))
+            self.assertIsNotNone(dispatcher.submit(comments[1].pk))
+            with self.assertLogs('django_comments_tree.notifications', 'WARNING'):
+                self.assertIsNone(dispatcher.submit(comments[2].pk))
+            self.assertNotIn(comments[2].pk, dispatcher._pending)
+            release.set()
+            dispatcher.shutdown()
+        self.assertEqual(sent, [comments[0].pk, comments[1].pk])
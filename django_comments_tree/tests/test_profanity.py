@@ -0,0 +1,131 @@
+import random
+import string
+import time
+from unittest.mock import patch
+
+from django.test import TestCase as DjangoTestCase, SimpleTestCase, override_settings
+
+import django_comments_tree
+from django_comments_tree.profanity import ProfanityMatcher, get_profanity_matcher
+from django_comments_tree.tests import benchmark
+from django_comments_tree.tests.models import Article
+
+
+class ProfanityMatcherTestCase(SimpleTestCase):
+    def test_find(self):
+        matcher = ProfanityMatcher(["shit", "ass", "hell"])
+        self.assertEqual(matcher.find("What the HELL, you ass!"), ["ass", "hell"])
+        self.assertEqual(matcher.find("A classic shell"), ["ass", "hell"])
+        self.assertEqual(matcher.find("Es war einmal..."), [])
+        self.assertEqual(matcher.find(""), [])
+
+    def test_overlapping_words(self):
+        matcher = ProfanityMatcher(["he", "she", "his", "hers"])
+        self.assertEqual(matcher.find("ushers"), ["he", "she", "hers"])
+        self.assertEqual(sorted(matcher.iter_matches("ushers")),
+                         [(1, 4, 1), (2, 4, 0), (2, 6, 3)])
+
+    def test_whole_words(self):
+        matcher = ProfanityMatcher(["ass", "hell"], whole_words=True)
+        self.assertEqual(matcher.find("A classic shell"), [])
+        self.assertEqual(matcher.find("Hell, you ass."), ["ass", "hell"])
+        self.assertEqual(matcher.find("hello_hell"), [])
+
+    def test_leetspeak(self):
+        self.assertEqual(ProfanityMatcher(["hello"]).find("h3ll0"), [])
+        matcher = ProfanityMatcher(["hello", "ass"], leetspeak=True)
+        self.assertEqual(matcher.find("H3LL0 you @$$"), ["hello", "ass"])
+
+    def test_empty_words_are_ignored(self):
+        self.assertEqual(ProfanityMatcher(["", "ass"]).find("ass"), ["ass"])
+
+    def test_same_words_as_the_naive_loop(self):
+        words, texts = random_words_and_texts(2000, 5, 3000)
+        matcher = ProfanityMatcher(words)
+        for text in texts:
+            self.assertEqual(matcher.find(text),
+                             [w for w in words if w in text.lower()])
+
+
+class ProfanityFormTestCase(DjangoTestCase):
+    def setUp(self):
+        self.article = Article.objects.create(title="September",
+                                              slug="september",
+                                              body="What I did on September...")
+
+    def clean(self, text):
+        form = django_comments_tree.get_form()(self.article)
+        data = {"name": "Bob", "email": "bob@example.com", "followup": False,
+                "reply_to": 0, "comment": text}
+        data.update(form.initial)
+        form = django_comments_tree.get_form()(self.article, data)
+        form.is_valid()
+        return form.errors.get('comment')
+
+    @override_settings(COMMENTS_ALLOW_PROFANITIES=False,
+                       PROFANITIES_LIST=["shit", "ass"])
+    def test_clean_comment(self):
+        self.assertIsNone(self.clean("Es war einmal..."))
+        errors = self.clean("Oh SHIT, you ass")
+        self.assertEqual(len(errors), 1)
+        self.assertIn('"s--t" and "a-s"', errors[0])
+        self.assertIsNotNone(self.clean("A classic"))
+        with patch.multiple('django_comments_tree.conf.settings',
+                            COMMENTS_TREE_PROFANITIES_WHOLE_WORDS=True):
+            self.assertIsNone(self.clean("A classic"))
+
+    def test_list_changes(self):
+        with override_settings(PROFANITIES_LIST=["ass"]):
+            self.assertEqual(get_profanity_matcher().words, ["ass"])
+            with override_settings(PROFANITIES_LIST=["hell"]):
+                self.assertEqual(get_profanity_matcher().find("hello"), ["hell"])
+            self.assertEqual(get_profanity_matcher().words, ["ass"])
+
+    @override_settings(COMMENTS_ALLOW_PROFANITIES=False,
+                       PROFANITIES_LIST=["ass"])
+    def test_options_follow_overrides(self):
+        self.assertIsNotNone(self.clean("A classic"))
+        with override_settings(COMMENTS_TREE_PROFANITIES_WHOLE_WORDS=True):
+            self.assertIsNone(self.clean("A classic"))
+            with override_settings(PROFANITIES_LIST=["classic"]):
+                self.assertIsNotNone(self.clean("A classic"))
+            self.assertIsNone(self.clean("A classic"))
+        with override_settings(COMMENTS_TREE_PROFANITIES_LEETSPEAK=True):
+            self.assertIsNotNone(self.clean("You @$$"))
+        self.assertIsNone(self.clean("You @$$"))
+
+
+def random_words_and_texts(words, comments, length):
+    rnd = random.Random(0)
+    letters = string.ascii_lowercase
+    words = [''.join(rnd.choice(letters) for i in range(rnd.randint(5, 9)))
+             for i in range(words)]
+    texts = [' '.join(''.join(rnd.choice(letters) for i in range(6))
+                      for j in range(length // 7))
+             for k in range(comments)]
+    return words, texts
+
+
+@benchmark
+class ProfanityBenchmark(SimpleTestCase):
+    """
+    Compare the matcher with looking for each word of a long list in the
+    comment, as comments were checked before.
+    """
+    words = 10000
+    comments = 20
+    length = 3000
+
+    def test_long_list(self):
+        words, texts = random_words_and_texts(self.words, self.comments,
+                                              self.length)
+        matcher = ProfanityMatcher(words)
+        start = time.perf_counter()
+        found = [matcher.find(text) for text in texts]
+        matched = time.perf_counter() - start
+        start = time.perf_counter()
+        expected = [[w for w in words if w in text.lower()] for text in texts]
+        naive = time.perf_counter() - start
+
+        self.assertEqual(found, expected)
+        self.assertLess(matched, naive)
@@ -176,6 +176,29 @@ class TestTreeCommentQueries(ArticleBaseTestCase):
         self.assertEqual(len(tree[0]['children'][1]['children']), 1,
                          "Expected 1 reply to second comment reply")
 
+    def test_tree_in_one_query(self):
+        root = TreeComment.objects.get(pk=self.root_1_pk)
+        with self.assertNumQueries(1):
+            tree = TreeComment.tree_from_comment(root)
+        self.assertEqual([c['comment'].comment.raw for c in tree],
+                         ['Comment 1', 'Comment 2'])
+        self.assertEqual([c['comment'].comment.raw for c in tree[1]['children']],
+                         ['Comment 2, Reply 1', 'Comment 2, Reply 2'])
+
+    def test_max_depth(self):
+        tree = TreeComment.tree_from_comment(self.root_1, max_depth=1)
+        self.assertEqual(len(tree), 2)
+        self.assertEqual(tree[0]['children'], [])
+
+        tree = TreeComment.tree_from_comment(self.root_1, max_depth=2)
+        self.assertEqual(len(tree[0]['children']), 2)
+        self.assertEqual(tree[0]['children'][1]['children'], [])
+
+    def test_filtered_out_parent_drops_replies(self):
+        tree = TreeComment.tree_from_comment(self.root_1, start=utime(1.4))
+        # Only replies changed in the last 1.4 days, whose parents are older.
+        self.assertEqual(tree, [])
+
     @skip('Not ready yet')
     def test_filter_old_messages(self):
         # there is no comment posted yet to article_1 nor article_2
@@ -0,0 +1,171 @@
+import json
+from io import StringIO
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.test import TestCase as DjangoTestCase
+
+from django_comments_tree.models import TreeComment
+from django_comments_tree.render import get_draftjs_renderer, render_draftjs
+from django_comments_tree.tests import benchmark
+from django_comments_tree.tests.models import Article
+
+
+DRAFTJS_CONTENT = json.dumps({
+    'entityMap': {},
+    'blocks': [
+        {'key': 'a', 'type': 'unstyled', 'depth': 0, 'text': 'Hello world',
+         'inlineStyleRanges': [{'offset': 0, 'length': 5, 'style': 'BOLD'}],
+         'entityRanges': []},
+        {'key': 'b', 'type': 'unordered-list-item', 'depth': 0, 'text': 'An item',
+         'inlineStyleRanges': [], 'entityRanges': []},
+    ],
+})
+
+SAMPLES = {
+    'plain': "Es war einmal eine kleine... http://example.com\n\nAnd <more>.",
+    'markdown': "Es war *einmal* eine **kleine**...\n\n* one\n* two\n",
+    'draftjs': DRAFTJS_CONTENT,
+}
+
+
+def counting(renderer):
+    """ Wrap a renderer to count its calls """
+    def render(content):
+        render.calls += 1
+        return renderer(content)
+    render.calls = 0
+    return render
+
+
+class MarkupRenderTestCase(DjangoTestCase):
+    def setUp(self):
+        self.article = Article.objects.create(
+            title="September", slug="september", body="During September...")
+        self.root = TreeComment.objects.get_or_create_root(self.article)
+        self.field = TreeComment._meta.get_field('comment')
+
+    def patch_renderer(self, markup_type):
+        renderer = counting(self.field.markup_choices_dict[markup_type])
+        patcher = patch.dict(self.field.markup_choices_dict, {markup_type: renderer})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return renderer
+
+    def test_draftjs_renderer_is_shared(self):
+        self.assertIs(get_draftjs_renderer(), get_draftjs_renderer())
+        html = render_draftjs(DRAFTJS_CONTENT)
+        self.assertIn('<strong>Hello</strong>', html)
+        self.assertIn('<li>An item</li>', html)
+        self.assertEqual(render_draftjs('{not json'), '')
+
+    def test_rendered_on_create(self):
+        renderer = self.patch_renderer('plain')
+        comment = self.root.add_child(comment="A <b>comment</b>")
+        self.assertEqual(renderer.calls, 1)
+        self.assertEqual(comment.comment.rendered, "<p>A &lt;b&gt;comment&lt;/b&gt;</p>")
+
+    def test_not_rendered_on_read_or_unchanged_save(self):
+        comment = self.root.add_child(comment="A comment")
+        renderer = self.patch_renderer('plain')
+
+        comment.is_public = False
+        comment.save()
+        loaded = TreeComment.objects.get(pk=comment.pk)
+        str(loaded.comment)
+        loaded.is_removed = True
+        loaded.save()
+        self.assertEqual(renderer.calls, 0)
+        self.assertEqual(TreeComment.objects.get(pk=comment.pk).comment.rendered,
+                         "<p>A comment</p>")
+
+    def test_rendered_when_changed(self):
+        comment = self.root.add_child(comment="A comment")
+        loaded = TreeComment.objects.get(pk=comment.pk)
+        loaded.comment = "*Edited*"
+        loaded.save()
+        self.assertEqual(loaded.comment.rendered, "<p>*Edited*</p>")
+
+        loaded.comment_markup_type = 'markdown'
+        loaded.save()
+        loaded = TreeComment.objects.get(pk=comment.pk)
+        self.assertEqual(loaded.comment.rendered, "<p><em>Edited</em></p>")
+
+    def test_rendered_when_built_with_pk(self):
+        comment = self.root.add_child(comment="A comment")
+        TreeComment.objects.filter(pk=comment.pk).update(_comment_rendered="stale")
+        loaded = TreeComment.objects.get(pk=comment.pk)
+        loaded.comment = "A comment"
+        loaded.save(update_fields=['comment'])
+        # Same raw text as loaded, so the stored HTML is kept.
+        self.assertEqual(TreeComment.objects.get(pk=comment.pk).comment.rendered, "stale")
+
+        loaded = TreeComment.objects.get(pk=comment.pk)
+        copy = TreeComment(pk=comment.pk, path=loaded.path, depth=loaded.depth,
+                           assoc=loaded.assoc, comment="A comment")
+        copy.save()
+        self.assertEqual(TreeComment.objects.get(pk=comment.pk).comment.rendered,
+                         "<p>A comment</p>")
+
+    def test_rerender_comments_command(self):
+        plain = self.root.add_child(comment="A comment")
+        markdown = self.root.add_child(comment="*A comment*",
+                                       comment_markup_type='markdown')
+        TreeComment.objects.update(_comment_rendered="stale")
+
+        out = StringIO()
+        call_command('rerender_comments', markup_types=['markdown'], stdout=out)
+        self.assertIn("Rendered 1 comments, updated 1.", out.getvalue())
+        self.assertEqual(TreeComment.objects.get(pk=plain.pk).comment.rendered, "stale")
+        self.assertEqual(TreeComment.objects.get(pk=plain.pk).updated_on, plain.updated_on)
+        self.assertEqual(TreeComment.objects.get(pk=markdown.pk).comment.rendered,
+                         "<p><em>A comment</em></p>")
+        self.assertGreater(TreeComment.objects.get(pk=markdown.pk).updated_on,
+                           markdown.updated_on)
+
+        out = StringIO()
+        call_command('rerender_comments', batch_size=1, stdout=out)
+        self.assertIn("updated 2.", out.getvalue())
+        self.assertEqual(TreeComment.objects.get(pk=plain.pk).comment.rendered,
+                         "<p>A comment</p>")
+
+
+@benchmark
+class MarkupRenderBenchmark(DjangoTestCase):
+    """
+    Render, read and save many comments of every markup type.
+    Only writes that change a comment may render it.
+    """
+    count = 200
+
+    def setUp(self):
+        self.article = Article.objects.create(
+            title="September", slug="september", body="During September...")
+        self.root = TreeComment.objects.get_or_create_root(self.article)
+        self.field = TreeComment._meta.get_field('comment')
+
+    def benchmark(self, markup_type):
+        content = SAMPLES[markup_type]
+        renderer = counting(self.field.markup_choices_dict[markup_type])
+        with patch.dict(self.field.markup_choices_dict, {markup_type: renderer}):
+            for i in range(self.count):
+                self.root.add_child(comment=content, comment_markup_type=markup_type)
+            self.assertEqual(renderer.calls, self.count)
+
+            comments = list(TreeComment.objects.filter(comment_markup_type=markup_type,
+                                                       depth__gt=1))
+            html = [str(c.comment) for c in comments]
+            for comment in comments:
+                comment.is_public = False
+                comment.save()
+            self.assertEqual(renderer.calls, self.count)
+        self.assertEqual(html, [self.field.markup_choices_dict[markup_type](content)] * self.count)
+
+    def test_plain(self):
+        self.benchmark('plain')
+
+    def test_markdown(self):
+        self.benchmark('markdown')
+
+    def test_draftjs(self):
+        self.benchmark('draftjs')
@@ -0,0 +1,158 @@
+import pickle
+import time
+import zlib
+from datetime import timedelta
+
+from django.contrib.contenttypes.models import ContentType
+from django.test import TestCase as DjangoTestCase
+from django.utils import timezone
+
+from django_comments_tree import signed
+from django_comments_tree.conf import settings
+from django_comments_tree.models import TmpTreeComment, TreeComment
+from django_comments_tree.notifications import get_mute_key, get_muted_comment
+from django_comments_tree.tests import benchmark
+from django_comments_tree.tests.models import Article
+
+
+def dumps_v1(obj):
+    """ Build a key the way earlier versions did """
+    key = settings.SECRET_KEY.encode('ascii') + settings.COMMENTS_TREE_SALT
+    return signed.sign(b'.' + signed.encode(zlib.compress(pickle.dumps(obj))), key)
+
+
+class SignedTestCase(DjangoTestCase):
+    def test_dumps_and_loads(self):
+        obj = {'id': 1, 'comment': "Es war einmal... " * 20}
+        for compress in (False, True):
+            key = signed.dumps(obj, compress=compress, extra_key=b'salt')
+            self.assertTrue(key.startswith(b'2~'))
+            self.assertEqual(signed.loads(key, extra_key=b'salt'), obj)
+            self.assertEqual(signed.loads(key.decode('ascii'), extra_key=b'salt'), obj)
+        self.assertTrue(key.startswith(b'2~.'))
+
+    def test_bad_signature(self):
+        key = signed.dumps({'id': 1}, extra_key=b'salt')
+        with self.assertRaises(signed.BadSignature):
+            signed.loads(key, extra_key=b'pepper')
+        with self.assertRaises(signed.BadSignature):
+            signed.loads(key[:-1], extra_key=b'salt')
+        with self.assertRaises(signed.BadSignature):
+            signed.loads(b'2~' + key[3:], extra_key=b'salt')
+        with self.assertRaises(signed.BadSignature):
+            signed.loads(b'2~eyJpZCI6MX0', extra_key=b'salt')
+
+    def test_loads_v1(self):
+        key = dumps_v1({'id': 1})
+        self.assertEqual(signed.loads(key, extra_key=settings.COMMENTS_TREE_SALT),
+                         {'id': 1})
+        with self.assertRaises(signed.BadSignature):
+            signed.loads(key[:-1], extra_key=settings.COMMENTS_TREE_SALT)
+
+
+class CommentTokenTestCase(DjangoTestCase):
+    def setUp(self):
+        self.article = Article.objects.create(
+            title="September", slug="september", body="During September...")
+        self.tmp_comment = TmpTreeComment(
+            content_type=ContentType.objects.get_for_model(self.article),
+            object_id=str(self.article.pk),
+            content_object=self.article,
+            user_name="Bob",
+            user_email="bob@example.com",
+            user_url="",
+            comment="Es war einmal eine kleine...",
+            submit_date=timezone.now(),
+            site_id=1,
+            is_public=True,
+            is_removed=False,
+            reply_to=0,
+            followup=True)
+
+    def test_confirmation_token(self):
+        key = self.tmp_comment.to_token()
+        with self.assertNumQueries(0):
+            comment = TmpTreeComment.from_token(key.decode('ascii'))
+            self.assertEqual(comment.user_email, "bob@example.com")
+            self.assertEqual(comment.submit_date, self.tmp_comment['submit_date'])
+            self.assertNotIn('content_object', comment)
+        self.assertEqual(comment.content_type, self.tmp_comment['content_type'])
+        with self.assertNumQueries(1):
+            self.assertEqual(comment.content_object, self.article)
+            self.assertEqual(comment.content_object, self.article)
+
+    def test_confirmation_token_v1(self):
+        key = dumps_v1(self.tmp_comment)
+        comment = TmpTreeComment.from_token(key.decode('ascii'))
+        self.assertEqual(comment.user_email, "bob@example.com")
+        self.assertEqual(comment.content_object, self.article)
+
+    def test_expired_confirmation_token(self):
+        self.tmp_comment['submit_date'] = timezone.now() - timedelta(days=3)
+        for key in (self.tmp_comment.to_token(), dumps_v1(self.tmp_comment)):
+            comment = TmpTreeComment.from_token(key)
+            self.assertEqual(comment.user_email, "bob@example.com")
+            comment = TmpTreeComment.from_token(key, max_age=4 * 24 * 3600)
+            self.assertEqual(comment.user_email, "bob@example.com")
+            with self.assertRaisesMessage(ValueError, "expired"):
+                TmpTreeComment.from_token(key, max_age=2 * 24 * 3600)
+
+    def test_not_a_comment(self):
+        key = signed.dumps([1, 2], extra_key=settings.COMMENTS_TREE_SALT)
+        with self.assertRaises(ValueError):
+            TmpTreeComment.from_token(key)
+
+    def test_mute_key(self):
+        root = TreeComment.objects.get_or_create_root(self.article)
+        comment = root.add_child(comment="A comment", user_email="bob@example.com",
+                                 followup=True)
+        self.assertEqual(get_muted_comment(get_mute_key(comment)), comment)
+        self.assertEqual(get_muted_comment(dumps_v1(comment)), comment)
+
+        comment.user_email = "alice@example.com"
+        self.assertIsNone(get_muted_comment(get_mute_key(comment)))
+        comment.user_email = "bob@example.com"
+        comment.followup = False
+        self.assertIsNone(get_muted_comment(dumps_v1(comment)))
+        self.assertIsNone(get_muted_comment(get_mute_key(comment)))
+
+    def test_mute_key_is_compact(self):
+        root = TreeComment.objects.get_or_create_root(self.article)
+        comment = root.add_child(comment="A comment", user_name="Bob",
+                                 user_email="bob@example.com", followup=True)
+        comment = TreeComment.objects.get(pk=comment.pk)
+        self.assertLess(len(get_mute_key(comment)), len(dumps_v1(comment)) / 5)
+
+
+@benchmark
+class TokenBenchmark(DjangoTestCase):
+    """
+    Compare the time to build and load pickled (v1) and JSON (v2) keys.
+    """
+    count = 1000
+
+    def setUp(self):
+        self.article = Article.objects.create(
+            title="September", slug="september", body="During September...")
+        root = TreeComment.objects.get_or_create_root(self.article)
+        self.comment = root.add_child(comment="A comment", user_name="Bob",
+                                      user_email="bob@example.com", followup=True)
+        self.comment = TreeComment.objects.get(pk=self.comment.pk)
+
+    def measure(self, dumps, loads):
+        start = time.perf_counter()
+        for i in range(self.count):
+            key = dumps(self.comment)
+        encoded = (time.perf_counter() - start) / self.count
+        start = time.perf_counter()
+        for i in range(self.count):
+            loads(key)
+        decoded = (time.perf_counter() - start) / self.count
+        return encoded, decoded
+
+    def test_mute_keys(self):
+        salt = settings.COMMENTS_TREE_SALT
+        v1 = self.measure(dumps_v1, lambda key: signed.loads(key, extra_key=salt))
+        v2 = self.measure(get_mute_key, lambda key: signed.loads(key, extra_key=salt))
+        self.assertLess(v2[0], v1[0])
+        self.assertLess(v2[1], v1[1])
@@ -1,3 +1,5 @@
+import gc
+import time
 from datetime import datetime
 from textwrap import dedent
 from os.path import join, dirname
@@ -9,6 +11,7 @@ from django.test import TestCase as DjangoTestCase
 
 from django_comments_tree.models import (TreeComment, CommentAssociation,
                                          MaxThreadLevelExceededException)
+from django_comments_tree.tests import benchmark
 from django_comments_tree.tests.models import Article, Diary
 
 
@@ -100,3 +103,133 @@ class TestWithGrandchildren(StructuredDataBase):
         data = TreeComment.structured_tree_data_for_queryset(qs)
 
         self.assertIsNotNone(data)
+
+    def test_parent_and_children_follow_the_tree(self):
+        root = self.root_1
+        qs = root.get_descendants().order_by('submit_date')
+
+        data = TreeComment.structured_tree_data_for_queryset(qs)
+        by_id = {d.id: d for d in data['comments']}
+
+        for node in qs:
+            item = by_id[node.id]
+            parent = node.get_parent()
+            expected_parent = None if parent.is_root() else parent.id
+            self.assertEqual(item.parent_id, expected_parent)
+            self.assertEqual(item.children,
+                             [c.id for c in node.get_children()])
+            self.assertEqual(item.depth, node.depth - 1)
+
+    def test_out_of_order_rows(self):
+        root = self.root_1
+        qs = list(root.get_descendants().order_by('submit_date'))
+
+        forward = TreeComment.structured_tree_data_for_queryset(qs)
+        backward = TreeComment.structured_tree_data_for_queryset(qs[::-1])
+
+        parents = {d.id: d.parent_id for d in forward['comments']}
+        for item in backward['comments']:
+            self.assertEqual(item.parent_id, parents[item.id])
+            self.assertEqual(sorted(item.children),
+                             sorted(by.id for by in forward['comments']
+                                    if by.parent_id == item.id))
+
+    def test_runs_no_queries_for_evaluated_rows(self):
+        qs = list(self.root_1.get_descendants().order_by('submit_date'))
+        with self.assertNumQueries(0):
+            TreeComment.structured_tree_data_for_queryset(qs)
+
+
+def make_unsaved_tree(count, fanout=10):
+    """
+    Build `count` unsaved nodes below a root, in path order, for
+    benchmarking the tree assembly without touching the database.
+    """
+    steplen = TreeComment.steplen
+    nodes = []
+    paths = [TreeComment._get_path(None, 1, 1)]
+    next_child = {paths[0]: 0}
+    parent_index = 0
+    while len(nodes) < count:
+        parent = paths[parent_index]
+        if next_child[parent] == fanout:
+            parent_index += 1
+            continue
+        next_child[parent] += 1
+        path = TreeComment._get_path(parent, len(parent) // steplen + 1,
+                                     next_child[parent])
+        paths.append(path)
+        next_child[path] = 0
+        nodes.append(TreeComment(id=len(nodes) + 2, path=path,
+                                 depth=len(path) // steplen,
+                                 comment=f"Comment {len(nodes)}"))
+    nodes.sort(key=lambda n: n.path)
+    return nodes
+
+
+class TestStructuredDataIndex(DjangoTestCase):
+
+    def test_tree_is_complete(self):
+        nodes = make_unsaved_tree(1000)
+        data = TreeComment.structured_tree_data_for_queryset(nodes)
+        by_path = {n.path: n.id for n in nodes}
+        steplen = TreeComment.steplen
+
+        comments = data['comments']
+        self.assertEqual(len(comments), 1000)
+        for node, item in zip(nodes, comments):
+            self.assertEqual(item.parent_id,
+                             by_path.get(node.path[:-steplen]))
+            self.assertEqual(item.children,
+                             [n.id for n in nodes
+                              if n.path[:-steplen] == node.path])
+
+    def test_rows_with_a_missing_parent_have_no_parent(self):
+        nodes = make_unsaved_tree(30, fanout=3)
+        missing = nodes[1]
+        rows = [n for n in nodes if n is not missing]
+        data = TreeComment.structured_tree_data_for_queryset(rows)
+        steplen = TreeComment.steplen
+
+        by_id = {d.id: d for d in data['comments']}
+        self.assertNotIn(missing.id, by_id)
+        for node in rows:
+            item = by_id[node.id]
+            if node.path[:-steplen] == missing.path:
+                self.assertIsNone(item.parent_id)
+            # Grandchildren are still attached to their own parents.
+            elif node.path.startswith(missing.path):
+                self.assertIsNotNone(item.parent_id)
+
+
+@benchmark
+class TestStructuredDataScaling(DjangoTestCase):
+
+    def time_assembly(self, nodes, rounds=3):
+        best = None
+        gc.disable()
+        try:
+            for _ in range(rounds):
+                start = time.perf_counter()
+                TreeComment.structured_tree_data_for_queryset(nodes)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+        finally:
+            gc.enable()
+        return best
+
+    def test_scales_linearly(self):
+        sizes = (1000, 10000, 100000)
+        timings = {n: self.time_assembly(make_unsaved_tree(n)) for n in sizes}
+
+        # A linear algorithm grows ~10x per decade; quadratic grows ~100x.
+        self.assertLess(timings[10000] / timings[1000], 30)
+        self.assertLess(timings[100000] / timings[10000], 30)
+
+    def test_large_tree_is_complete(self):
+        nodes = make_unsaved_tree(100000)
+        data = TreeComment.structured_tree_data_for_queryset(nodes)
+        comments = data['comments']
+        self.assertEqual(len(comments), 100000)
+        self.assertEqual(sum(len(c.children) for c in comments),
+                         sum(1 for c in comments if c.parent_id is not None))
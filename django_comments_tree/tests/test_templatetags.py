@@ -5,8 +5,10 @@ except ImportError:
 import unittest
 
 from django.contrib.auth.models import AnonymousUser
+from django.db import connection
 from django.template import Context, Template, TemplateSyntaxError
 from django.test import TestCase as DjangoTestCase
+from django.test.utils import CaptureQueriesContext
 
 from django_comments_tree.tests.models import Article, Diary
 from django_comments_tree.tests.test_models import (
@@ -112,3 +114,16 @@ class CommentsTestCase(DjangoTestCase):
             p2 = pos_list[x+1]
             self.assertTrue(p1 < p2)
 
+    def test_render_comment_tree_queries(self):
+        t = Template("{% load comments_tree %}"
+                     "{% render_treecomment_tree for object %}")
+        context = Context({'object': self.article, 'user': AnonymousUser()})
+        with CaptureQueriesContext(connection) as few:
+            self.assertEqual(t.render(context).count('<a name='), 9)
+        root = TreeComment.objects.get_or_create_root(self.article)
+        for i in range(20):
+            root.add_child(comment="Comment %d" % i)
+        with CaptureQueriesContext(connection) as many:
+            self.assertEqual(t.render(context).count('<a name='), 29)
+        self.assertEqual(len(many), len(few))
+
@@ -0,0 +1,262 @@
+import threading
+import time
+import tracemalloc
+from unittest.mock import patch
+
+from django.core import mail
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.contenttypes.models import ContentType
+from django.core.mail import EmailMessage
+from django.core.mail.backends import locmem
+from django.test import SimpleTestCase, TestCase as DjangoTestCase, override_settings
+from rest_framework.test import APIRequestFactory
+
+from django_comments_tree import utils
+from django_comments_tree.api.serializers import ReadCommentSerializer
+from django_comments_tree.conf import settings
+from django_comments_tree.models import TreeComment
+from django_comments_tree.tests import benchmark
+from django_comments_tree.tests.models import Article, Diary
+from django_comments_tree.utils import (MailExecutor, app_model_options,
+                                        has_app_model_option, send_mail)
+
+
+class CountingBackend(locmem.EmailBackend):
+    """ Count the connections opened """
+    opened = 0
+
+    def open(self):
+        CountingBackend.opened += 1
+        return True
+
+
+class BlockingBackend(locmem.EmailBackend):
+    started = threading.Event()
+    release = threading.Event()
+
+    def send_messages(self, messages):
+        BlockingBackend.started.set()
+        BlockingBackend.release.wait(5)
+        return super().send_messages(messages)
+
+
+def message(i=0):
+    return EmailMessage("Subject %d" % i, "Body", "alice@example.com",
+                        ["bob@example.com"])
+
+
+class MailExecutorTestCase(SimpleTestCase):
+    def setUp(self):
+        self.executor = MailExecutor(workers=2, queue_size=100)
+        self.addCleanup(self.executor.shutdown)
+
+    def test_send_mail_is_queued(self):
+        with patch.object(utils, 'mail_executor', self.executor):
+            send_mail("Subject", "Body", "alice@example.com",
+                      ["bob@example.com"], html="<p>Body</p>")
+            self.executor.join()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].alternatives, [("<p>Body</p>", "text/html")])
+        self.assertEqual(self.executor.stats, {'queued': 1, 'sent': 1})
+
+    @patch.multiple('django_comments_tree.conf.settings',
+                    COMMENTS_TREE_THREADED_EMAILS=False)
+    def test_send_mail_unthreaded(self):
+        with patch.object(utils, 'mail_executor', self.executor):
+            send_mail("Subject", "Body", "alice@example.com", ["bob@example.com"])
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(self.executor.threads, [])
+
+    @override_settings(EMAIL_BACKEND=(
+        'django_comments_tree.tests.test_utils.CountingBackend'))
+    def test_connections_are_reused(self):
+        CountingBackend.opened = 0
+        for i in range(50):
+            self.executor.submit(message(i))
+        self.executor.join()
+        self.assertEqual(len(mail.outbox), 50)
+        self.assertLessEqual(CountingBackend.opened, 2)
+
+    def test_workers_are_reused(self):
+        threads = set()
+        for r in range(3):
+            for i in range(100):
+                self.executor.submit(message(i))
+            self.executor.join()
+            threads.update(self.executor.threads)
+        self.assertEqual(len(mail.outbox), 300)
+        self.assertEqual(len(threads), 2)
+
+    @override_settings(EMAIL_BACKEND=(
+        'django_comments_tree.tests.test_utils.BlockingBackend'))
+    @patch.multiple('django_comments_tree.conf.settings',
+                    COMMENTS_TREE_MAIL_QUEUE_TIMEOUT=0)
+    def test_drop_when_full(self):
+        BlockingBackend.started.clear()
+        BlockingBackend.release.clear()
+        executor = MailExecutor(workers=1, queue_size=1)
+        self.assertTrue(executor.submit(message(1)))
+        BlockingBackend.started.wait(5)
+        self.assertTrue(executor.submit(message(2)))
+        with self.assertLogs('django_comments_tree.utils', 'WARNING'):
+            self.assertFalse(executor.submit(message(3)))
+        BlockingBackend.release.set()
+        executor.shutdown()
+        self.assertEqual([m.subject for m in mail.outbox],
+                         ["Subject 1", "Subject 2"])
+        self.assertEqual(executor.stats, {'queued': 2, 'sent': 2, 'dropped': 1})
+
+    def test_shutdown_sends_queued_mails(self):
+        for i in range(20):
+            self.executor.submit(message(i))
+        self.executor.shutdown()
+        self.assertEqual(len(mail.outbox), 20)
+        self.assertEqual(self.executor.threads, [])
+
+    @override_settings(EMAIL_BACKEND=(
+        'django_comments_tree.tests.test_utils.BlockingBackend'))
+    def test_shutdown_with_a_stuck_worker(self):
+        BlockingBackend.started.clear()
+        BlockingBackend.release.clear()
+        self.addCleanup(BlockingBackend.release.set)
+        executor = MailExecutor(workers=1, queue_size=1)
+        executor.submit(message(1))
+        BlockingBackend.started.wait(5)
+        executor.submit(message(2))
+        start = time.monotonic()
+        with self.assertLogs('django_comments_tree.utils', 'WARNING'):
+            executor.shutdown(timeout=0.2)
+        self.assertLess(time.monotonic() - start, 2)
+
+
+@benchmark
+class MailExecutorStressTest(SimpleTestCase):
+    """
+    Send a few thousand mails to the locmem backend. The number of
+    threads and the memory in use must not grow with the number of mails.
+    """
+    rounds = 5
+    per_round = 1000
+
+    def test_threads_and_memory_stay_flat(self):
+        executor = MailExecutor(workers=2, queue_size=100)
+        self.addCleanup(executor.shutdown)
+        threads = []
+        memory = []
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        for r in range(self.rounds):
+            for i in range(self.per_round):
+                executor.submit(message(i))
+            executor.join()
+            self.assertEqual(len(mail.outbox), self.per_round)
+            mail.outbox = []
+            threads.append(threading.active_count())
+            memory.append(tracemalloc.get_traced_memory()[0])
+
+        self.assertEqual(executor.stats['sent'], self.rounds * self.per_round)
+        self.assertEqual(len(set(threads)), 1)
+        # Allow for some noise, far below the size of a round of mails.
+        self.assertLess(memory[-1] - memory[0], 256 * 1024)
+
+
+class AppModelOptionsTestCase(DjangoTestCase):
+    def setUp(self):
+        self.diary_ct = ContentType.objects.get_for_model(Diary)
+        self.article_ct = ContentType.objects.get_for_model(Article)
+
+    def test_options(self):
+        options = app_model_options.options(self.diary_ct.pk)
+        self.assertEqual(dict(options), {'allow_flagging': True,
+                                         'allow_feedback': True,
+                                         'show_feedback': True})
+        self.assertEqual(dict(app_model_options.options(self.article_ct.pk)),
+                         {'allow_flagging': False,
+                          'allow_feedback': False,
+                          'show_feedback': False})
+        with self.assertRaises(TypeError):
+            options['allow_flagging'] = False
+        self.assertNotIn('default', settings.COMMENTS_TREE_APP_MODEL_OPTIONS)
+
+    def test_max_thread_level(self):
+        self.assertEqual(app_model_options.max_thread_level(self.diary_ct.pk), 0)
+        self.assertEqual(app_model_options.max_thread_level(self.article_ct.pk), 5)
+
+    def test_comment_options(self):
+        diary = Diary.objects.create(body="What I did on October...")
+        comment = TreeComment.objects.get_or_create_root(diary).add_child(
+            comment="A comment")
+        comment = TreeComment.objects.get(pk=comment.pk)
+        self.assertTrue(has_app_model_option(comment)['allow_feedback'])
+
+    def test_setting_changed(self):
+        with override_settings(COMMENTS_TREE_APP_MODEL_OPTIONS={
+                'default': {'allow_feedback': True}},
+                COMMENTS_TREE_MAX_THREAD_LEVEL_BY_APP_MODEL={'tests.article': 2}):
+            self.assertEqual(dict(app_model_options.options(self.diary_ct.pk)),
+                             {'allow_flagging': False,
+                              'allow_feedback': True,
+                              'show_feedback': False})
+            self.assertEqual(app_model_options.max_thread_level(self.article_ct.pk), 2)
+        self.assertTrue(app_model_options.options(self.diary_ct.pk)['allow_flagging'])
+        self.assertEqual(app_model_options.max_thread_level(self.article_ct.pk), 5)
+
+    def test_settings_follow_overrides(self):
+        with override_settings(COMMENTS_TREE_MAX_THREAD_LEVEL=3):
+            self.assertEqual(settings.COMMENTS_TREE_MAX_THREAD_LEVEL, 3)
+            self.assertEqual(app_model_options.max_thread_level(self.article_ct.pk), 3)
+        self.assertEqual(settings.COMMENTS_TREE_MAX_THREAD_LEVEL, 5)
+
+
+def legacy_has_app_model_option(comment):
+    """ has_app_model_option as it was before the options table """
+    content_type = comment.content_type
+    key = "%s.%s" % (content_type.app_label, content_type.model)
+    try:
+        return settings.COMMENTS_TREE_APP_MODEL_OPTIONS[key]
+    except KeyError:
+        return settings.COMMENTS_TREE_APP_MODEL_OPTIONS.get('default')
+
+
+def legacy_allow_thread(comment):
+    content_type = comment.content_type
+    app_model = "%s.%s" % (content_type.app_label, content_type.model)
+    max_level = settings.COMMENTS_TREE_MAX_THREAD_LEVEL_BY_APP_MODEL.get(
+        app_model, settings.COMMENTS_TREE_MAX_THREAD_LEVEL)
+    return comment.get_depth() < max_level
+
+
+class AppModelOptionsSerializeTestCase(DjangoTestCase):
+    """
+    Serialize comments with the options looked up in the settings for
+    every comment, as before, and with the options table.
+    """
+    count = 10
+
+    def test_serialize_comments(self):
+        diary = Diary.objects.create(body="What I did on October...")
+        root = TreeComment.objects.get_or_create_root(diary)
+        TreeComment.objects.bulk_create([
+            TreeComment(path=TreeComment._get_path(root.path, 2, i + 1), depth=2,
+                        assoc=root.assoc, comment="Comment %d" % i)
+            for i in range(self.count)
+        ])
+        request = APIRequestFactory().get('/')
+        request.user = AnonymousUser()
+
+        def serialize():
+            comments = TreeComment.objects.filter(depth=2).select_related('assoc')
+            return ReadCommentSerializer(comments, many=True,
+                                         context={'request': request}).data
+
+        with patch('django_comments_tree.api.serializers.has_app_model_option',
+                   legacy_has_app_model_option), \
+                patch.object(TreeComment, 'allow_thread', legacy_allow_thread):
+            before = serialize()
+        self.assertEqual(len(before), self.count)
+        self.assertEqual(before, serialize())
+
+
+@benchmark
+class AppModelOptionsBenchmark(AppModelOptionsSerializeTestCase):
+    count = 1000
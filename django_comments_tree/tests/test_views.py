@@ -13,8 +13,12 @@ from datetime import datetime
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
 from django.contrib.auth.models import AnonymousUser, User
+from django.core import mail
+from django.db import connection
 from django.http.response import Http404
+from django.template.loader import render_to_string
 from django.test import TestCase, RequestFactory
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
 from django_comments_tree.views.comments import CommentView
@@ -22,7 +26,7 @@ from django_comments_tree.views.comments import CommentView
 from django_comments_tree import signals, signed, get_form
 from django_comments_tree.views import comments as views
 from django_comments_tree.conf import settings
-from django_comments_tree.models import TreeComment
+from django_comments_tree.models import TmpTreeComment, TreeComment
 from django_comments_tree.tests.models import Article, Diary
 
 
@@ -131,6 +135,15 @@ class ConfirmCommentTestCase(TestCase):
         with self.assertRaises(Http404):
             confirm_comment_url(self.key[:-1])
 
+    def test_404_on_expired_key(self):
+        with patch.multiple('django_comments_tree.conf.settings',
+                            COMMENTS_TREE_CONFIRMATION_MAX_AGE=0):
+            with self.assertRaises(Http404):
+                confirm_comment_url(self.key)
+        with patch.multiple('django_comments_tree.conf.settings',
+                            COMMENTS_TREE_CONFIRMATION_MAX_AGE=60):
+            confirm_comment_url(self.key)
+
     def test_consecutive_confirmation_url_visits_fail(self):
         # test that consecutives visits to the same confirmation URL produce
         # an Http 404 code, as the comment has already been verified in the
@@ -139,6 +152,20 @@ class ConfirmCommentTestCase(TestCase):
         with self.assertRaises(Http404):
             confirm_comment_url(self.key)
 
+    def test_same_comment_posted_again_the_same_day(self):
+        # Only a second confirmation of the same key is a duplicate.
+        data = {"name": "Bob", "email": "bob@example.com", "followup": True,
+                "reply_to": 0, "level": 1, "order": 1,
+                "comment": "Es war einmal iene kleine..."}
+        data.update(self.form.initial)
+        post_article_comment(data, self.article)
+        key = str(re.search(r'http://.+/confirm/(?P<key>[\S]+)/',
+                            self.mock_mailer.call_args[0][1]).group("key"))
+        self.assertNotEqual(key, self.key)
+        confirm_comment_url(self.key)
+        confirm_comment_url(key)
+        self.assertEqual(TreeComment.objects.filter(depth__gt=1).count(), 2)
+
     def test_signal_receiver_may_discard_the_comment(self):
         # test that receivers of signal confirmation_received may return False
         # and thus rendering a template_discarded output
@@ -157,7 +184,7 @@ class ConfirmCommentTestCase(TestCase):
         # and redirects to the article detail page
         Site.objects.get_current().domain = "testserver"  # django bug #7743
         response = confirm_comment_url(self.key, follow=False)
-        data = signed.loads(self.key, extra_key=settings.COMMENTS_TREE_SALT)
+        data = TmpTreeComment.from_token(self.key)
         try:
             comment = TreeComment.objects.get(
                 user_name=data["user_name"],
@@ -189,9 +216,10 @@ class ConfirmCommentTestCase(TestCase):
         self.key = re.search(r'http://.+/confirm/(?P<key>[\S]+)/',
                              self.mock_mailer.call_args[0][1]).group("key")
         confirm_comment_url(self.key)
-        self.assertEqual(self.mock_mailer.call_count, 3)
-        self.assertTrue(self.mock_mailer.call_args[0][3] == ["bob@example.com"])
-        self.assertTrue(self.mock_mailer.call_args[0][1].find(
+        self.assertEqual(self.mock_mailer.call_count, 2)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ["bob@example.com"])
+        self.assertTrue(mail.outbox[0].body.find(
             "There is a new comment following up yours.") > -1)
 
     def test_notify_followers_dupes(self):
@@ -235,9 +263,14 @@ class ConfirmCommentTestCase(TestCase):
         self.key = re.search(r'http://.+/confirm/(?P<key>[\S]+)/',
                              self.mock_mailer.call_args[0][1]).group("key")
         confirm_comment_url(self.key)
-        self.assertEqual(self.mock_mailer.call_count, 4)
-        self.assertTrue(self.mock_mailer.call_args[0][3] == ["bob@example.com"])
-        self.assertTrue(self.mock_mailer.call_args[0][1].find(
+        self.assertEqual(self.mock_mailer.call_count, 3)
+        # The diary moderator gets notified of Charlie's comment, and only
+        # Bob gets a follow-up notification of Alice's comment.
+        followups = [m for m in mail.outbox
+                     if m.subject == "new comment posted"]
+        self.assertEqual(len(followups), 1)
+        self.assertEqual(followups[0].to, ["bob@example.com"])
+        self.assertTrue(followups[0].body.find(
             "There is a new comment following up yours.") > -1)
 
     def test_no_notification_for_same_user_email(self):
@@ -259,6 +292,7 @@ class ConfirmCommentTestCase(TestCase):
                              self.mock_mailer.call_args[0][1]).group("key")
         confirm_comment_url(self.key)
         self.assertEqual(self.mock_mailer.call_count, 2)
+        self.assertEqual(len(mail.outbox), 0)
 
 
 class ReplyNoCommentTestCase(TestCase):
@@ -332,10 +366,10 @@ class MuteFollowUpsTestCase(TestCase):
         confirm_comment_url(alicekey)  # confirm Alice's comment
 
         # Bob receives a follow-up notification
-        self.assertTrue(self.mock_mailer.call_count == 3)
+        self.assertEqual(len(mail.outbox), 1)
         self.bobs_mutekey = str(re.search(
             r'http://.+/mute/(?P<key>[\S]+)/',
-            self.mock_mailer.call_args[0][1]).group("key"))
+            mail.outbox[0].body).group("key"))
         self.addCleanup(patcher.stop)
 
     def get_mute_followup_url(self, key):
@@ -361,13 +395,14 @@ class MuteFollowUpsTestCase(TestCase):
         self.assertEqual(response.status_code, 302)
         self.assertTrue(response.url.startswith('/comments/posted/?c='))
         # Alice confirms her comment...
-        self.assertTrue(self.mock_mailer.call_count == 4)
+        self.assertTrue(self.mock_mailer.call_count == 3)
         alicekey = str(re.search(r'http://.+/confirm/(?P<key>[\S]+)/',
                                  self.mock_mailer.call_args[0][1]).group("key"))
         confirm_comment_url(alicekey)  # confirm Alice's comment
         # Alice confirmed her comment, but this time Bob won't receive any
         # notification, neither do Alice being the sender
-        self.assertTrue(self.mock_mailer.call_count == 4)
+        self.assertTrue(self.mock_mailer.call_count == 3)
+        self.assertEqual(len(mail.outbox), 1)
 
 
 class HTMLDisabledMailTestCase(TestCase):
@@ -403,3 +438,35 @@ class HTMLDisabledMailTestCase(TestCase):
         self.assertTrue(response.url.startswith('/comments/posted/?c='))
         self.assertTrue(self.mock_mailer.call_count == 1)
         self.assertTrue(self.mock_mailer.call_args[1]['html'] is not None)
+
+
+class TreeCommentListViewTestCase(TestCase):
+    def setUp(self):
+        self.article = Article.objects.create(
+            title="September", slug="september", body="During September...")
+        self.diary = Diary.objects.create(body="About Today...")
+        self.view = views.TreeCommentListView(
+            content_types=['tests.article', 'tests.diary'])
+
+    def add_comments(self, count):
+        for obj in (self.article, self.diary):
+            root = TreeComment.objects.get_or_create_root(obj)
+            for i in range(count):
+                root.add_child(comment="Comment %d" % i)
+
+    def render(self):
+        with CaptureQueriesContext(connection) as queries:
+            output = "".join(
+                render_to_string("django_comments_tree/comment.html",
+                                 {'comment': comment})
+                for comment in self.view.get_queryset())
+        return len(queries), output.count('<a name=')
+
+    def test_queries_per_list(self):
+        self.add_comments(2)
+        few, listed = self.render()
+        self.assertEqual(listed, 4)
+        self.add_comments(10)
+        many, listed = self.render()
+        self.assertEqual(listed, 24)
+        self.assertEqual(many, few)
@@ -1,64 +1,236 @@
-# Idea borrowed from Selwin Ong post:
-# http://ui.co.id/blog/asynchronous-send_mail-in-django
-
-import queue as queue  # python3
-
+import atexit
+import hashlib
+import logging
+import queue
 import threading
+import time
+from collections import Counter
+from types import MappingProxyType
 
-from django.core.mail import EmailMultiAlternatives
+from django.contrib.contenttypes.models import ContentType
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils import timezone
 
 from django_comments_tree.conf import settings
 
 
-mail_sent_queue = queue.Queue()
+logger = logging.getLogger(__name__)
 
 
-class EmailThread(threading.Thread):
-    def __init__(self, subject, body, from_email, recipient_list,
-                 fail_silently, html):
-        self.subject = subject
-        self.body = body
-        self.recipient_list = recipient_list
-        self.from_email = from_email
-        self.fail_silently = fail_silently
-        self.html = html
-        threading.Thread.__init__(self)
+class MailExecutor:
+    """
+    Send emails from a fixed number of worker threads.
 
-    def run(self):
-        _send_mail(self.subject, self.body, self.from_email,
-                   self.recipient_list, self.fail_silently, self.html)
-        mail_sent_queue.put(True)
+    Messages wait in a bounded queue. Each worker keeps its mail connection
+    open while there are messages to send, and closes it after
+    `idle_timeout` seconds without work. When the queue is full, `submit`
+    waits up to COMMENTS_TREE_MAIL_QUEUE_TIMEOUT seconds for room and then
+    drops the message. The number of messages queued, sent, failed and
+    dropped is kept in `stats`.
+    """
+    idle_timeout = 5
 
+    def __init__(self, workers=None, queue_size=None):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.queue = None
+        self.threads = []
+        self.stats = Counter()
+        self._lock = threading.Lock()
 
-def _send_mail(subject, body, from_email, recipient_list,
-               fail_silently=False, html=None):
-    msg = EmailMultiAlternatives(subject, body, from_email, recipient_list)
-    if html:
-        msg.attach_alternative(html, "text/html")
-    msg.send(fail_silently)
+    def _start(self):
+        with self._lock:
+            if self.threads:
+                return
+            workers = self.workers or settings.COMMENTS_TREE_MAIL_WORKERS
+            self.queue = queue.Queue(self.queue_size
+                                     or settings.COMMENTS_TREE_MAIL_QUEUE_SIZE)
+            for i in range(workers):
+                thread = threading.Thread(
+                    target=self._work, args=(self.queue,), daemon=True,
+                    name='comments-tree-mail-%d' % i)
+                thread.start()
+                self.threads.append(thread)
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def submit(self, message, fail_silently=False):
+        """ Queue the message. Return False if it had to be dropped. """
+        if not self.threads:
+            self._start()
+        try:
+            self.queue.put((message, fail_silently),
+                           timeout=settings.COMMENTS_TREE_MAIL_QUEUE_TIMEOUT)
+        except queue.Full:
+            self._count('dropped')
+            logger.warning("Mail queue full, dropped message to %s.",
+                           ", ".join(message.recipients()))
+            return False
+        self._count('queued')
+        return True
+
+    def _work(self, messages):
+        connection = None
+        while True:
+            try:
+                item = messages.get(
+                    timeout=self.idle_timeout if connection else None)
+            except queue.Empty:
+                connection.close()
+                connection = None
+                continue
+            if item is None:
+                messages.task_done()
+                break
+            message, fail_silently = item
+            try:
+                if connection is None:
+                    connection = get_connection()
+                    connection.open()
+                connection.send_messages([message])
+                self._count('sent')
+            except Exception:
+                self._count('failed')
+                if not fail_silently:
+                    logger.exception("Can't send message to %s.",
+                                     ", ".join(message.recipients()))
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+                connection = None
+            finally:
+                messages.task_done()
+        if connection is not None:
+            connection.close()
+
+    def join(self):
+        """ Wait until all the queued messages are handled """
+        if self.threads:
+            self.queue.join()
+
+    def shutdown(self, timeout=10):
+        """
+        Send the queued messages and stop the workers, waiting up to
+        `timeout` seconds in all. The workers are daemon threads, so those
+        still busy by then don't keep the interpreter from exiting.
+        """
+        with self._lock:
+            threads, self.threads = self.threads, []
+            messages = self.queue
+        deadline = time.monotonic() + timeout
+        for thread in threads:
+            try:
+                messages.put(None, timeout=max(deadline - time.monotonic(), 0))
+            except queue.Full:
+                logger.warning("Mail queue still full on shutdown, %d messages "
+                               "not sent.", messages.qsize())
+                break
+        for thread in threads:
+            thread.join(max(deadline - time.monotonic(), 0))
+
+
+mail_executor = MailExecutor()
+atexit.register(mail_executor.shutdown)
 
 
 def send_mail(subject, body, from_email, recipient_list,
               fail_silently=False, html=None):
+    msg = EmailMultiAlternatives(subject, body, from_email, recipient_list)
+    if html:
+        msg.attach_alternative(html, "text/html")
     if settings.COMMENTS_TREE_THREADED_EMAILS:
-        EmailThread(subject, body, from_email, recipient_list,
-                    fail_silently, html).start()
+        mail_executor.submit(msg, fail_silently)
     else:
-        _send_mail(subject, body, from_email, recipient_list,
-                   fail_silently, html)
+        msg.send(fail_silently)
 
 
-def has_app_model_option(comment):
-    _default = {
+def get_content_hash(user_name, user_email, comment, submit_date):
+    """
+    Return the digest used to find duplicated comments: the same text, but
+    for whitespace and case, posted by the same person on the same day.
+    """
+    if submit_date is not None and timezone.is_aware(submit_date):
+        submit_date = submit_date.astimezone(timezone.utc)
+    content = "\n".join([
+        user_name or "",
+        (user_email or "").lower(),
+        " ".join((comment or "").split()).casefold(),
+        submit_date.date().isoformat() if submit_date else "",
+    ])
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class AppModelOptions:
+    """
+    Commenting options and maximum thread level of each content type.
+
+    COMMENTS_TREE_APP_MODEL_OPTIONS and
+    COMMENTS_TREE_MAX_THREAD_LEVEL_BY_APP_MODEL are compiled into read-only
+    entries per "app_label.model" when the app is ready, and again when
+    either setting changes. Entries are then remembered per content type
+    id, so looking them up for a comment takes a dict lookup.
+    """
+    default_options = {
         'allow_flagging': False,
         'allow_feedback': False,
-        'show_feedback': False
+        'show_feedback': False,
     }
-    # content_type = ContentType.objects.get_for_model(comment.content_object)
-    content_type = comment.content_type
-    key = "%s.%s" % (content_type.app_label, content_type.model)
-    try:
-        return settings.COMMENTS_TREE_APP_MODEL_OPTIONS[key]
-    except KeyError:
-        return settings.COMMENTS_TREE_APP_MODEL_OPTIONS.setdefault(
-            'default', _default)
+
+    def __init__(self):
+        self._by_app_model = None
+        self._by_content_type = {}
+
+    def build(self):
+        all_options = settings.COMMENTS_TREE_APP_MODEL_OPTIONS
+        levels = settings.COMMENTS_TREE_MAX_THREAD_LEVEL_BY_APP_MODEL
+        max_level = settings.COMMENTS_TREE_MAX_THREAD_LEVEL
+        default = dict(self.default_options, **all_options.get('default', {}))
+        by_app_model = {None: (MappingProxyType(default), max_level)}
+        for key in set(all_options) | set(levels):
+            if key == 'default':
+                continue
+            options = dict(default, **all_options.get(key, {}))
+            by_app_model[key] = (MappingProxyType(options), levels.get(key, max_level))
+        self._by_content_type = {}
+        self._by_app_model = by_app_model
+
+    def get(self, content_type_id):
+        """ Return the (options, max_thread_level) of the content type """
+        try:
+            return self._by_content_type[content_type_id]
+        except KeyError:
+            pass
+        if self._by_app_model is None:
+            self.build()
+        content_type = ContentType.objects.get_for_id(content_type_id)
+        key = "%s.%s" % (content_type.app_label, content_type.model)
+        entry = self._by_app_model.get(key, self._by_app_model[None])
+        self._by_content_type[content_type_id] = entry
+        return entry
+
+    def options(self, content_type_id):
+        return self.get(content_type_id)[0]
+
+    def max_thread_level(self, content_type_id):
+        return self.get(content_type_id)[1]
+
+
+app_model_options = AppModelOptions()
+
+
+@receiver(setting_changed)
+def rebuild_app_model_options(setting, **kwargs):
+    if setting in ('COMMENTS_TREE_APP_MODEL_OPTIONS',
+                   'COMMENTS_TREE_MAX_THREAD_LEVEL_BY_APP_MODEL',
+                   'COMMENTS_TREE_MAX_THREAD_LEVEL'):
+        app_model_options.build()
+
+
+def has_app_model_option(comment):
+    """ Return the read-only options of the app model the comment belongs to """
+    return app_model_options.options(comment.association.content_type_id)
@@ -1,6 +1,5 @@
 from __future__ import unicode_literals
 
-import six
 from django import http
 from django.apps import apps
 from django.contrib.auth.decorators import login_required
@@ -22,7 +21,7 @@ from django.views.generic import ListView, View
 
 from django_comments_tree import (comment_was_posted, get_form,
                                   get_model as get_comment_model,
-                                  signals, signed)
+                                  notifications, signals, signed)
 from django_comments_tree.conf import settings
 from django_comments_tree.models import (DISLIKEDIT_FLAG, LIKEDIT_FLAG,
                                          MaxThreadLevelExceededException,
@@ -71,24 +70,23 @@ def send_email_confirmation_request(
 
 def _comment_exists(comment):
     """
-    True if exists a TreeComment with same user_name, user_email and submit_date.
+    True if the confirmed comment was already created, from an earlier
+    confirmation of the same key: a TreeComment with the same content hash,
+    submit_date and followup.
     """
-    return (TreeComment.objects.filter(
-        user_name=comment.user_name,
-        user_email=comment.user_email,
-        followup=comment.followup,
-        submit_date=comment.submit_date
-    ).count() > 0)
+    return TreeComment.objects.duplicates_of(comment).filter(
+        submit_date=comment.submit_date,
+        followup=comment.followup).exists()
 
 
 def _create_comment(tmp_comment):
     """
     Creates a TreeComment from a TmpTreeComment.
     """
-    tmp_comment.pop('content_type')
-    content_object = tmp_comment.pop('content_object')
-    tmp_comment.pop('object_id')
-    tmp_comment.pop('site_id')
+    content_object = tmp_comment.content_object
+    for key in ('content_type', 'content_type_key', 'content_object',
+                'object_id', 'site_id'):
+        tmp_comment.pop(key, None)
     reply_to = tmp_comment.pop('reply_to', None)
 
     if reply_to:
@@ -131,8 +129,7 @@ def on_comment_was_posted(sender, comment, request, **kwargs):
             if comment.is_public:
                 notify_comment_followers(new_comment)
     else:
-        key = signed.dumps(comment, compress=True,
-                           extra_key=settings.COMMENTS_TREE_SALT)
+        key = comment.to_token()
         site = get_current_site(request)
         send_email_confirmation_request(comment, key, site)
 
@@ -178,8 +175,8 @@ def sent(request, using=None):
 def confirm(request, key,
             template_discarded="django_comments_tree/discarded.html"):
     try:
-        tmp_comment = signed.loads(str(key),
-                                   extra_key=settings.COMMENTS_TREE_SALT)
+        tmp_comment = TmpTreeComment.from_token(
+            str(key), max_age=settings.COMMENTS_TREE_CONFIRMATION_MAX_AGE)
     except (ValueError, signed.BadSignature):
         raise Http404
     # the comment does exist if the URL was already confirmed, then: Http404
@@ -205,50 +202,10 @@ def confirm(request, key,
 
 def notify_comment_followers(comment):
     """
-    Updated to use MP_Nodes
-    :param comment:
-    :return:
+    Queue follow-up notifications to the followers of the comment's thread.
+    They are sent by the notification dispatcher, not within the request.
     """
-    root = comment.get_root()
-
-    followers = {}
-    kwargs = {'is_public': True,
-              'followup': True}
-    previous_comments = root.get_descendants()
-
-    previous_comments = previous_comments.filter(**kwargs)
-    previous_comments = previous_comments.exclude(user_email=comment.user_email)
-
-    for instance in previous_comments:
-        followers[instance.user_email] = (
-            instance.user_name,
-            signed.dumps(instance, compress=True,
-                         extra_key=settings.COMMENTS_TREE_SALT))
-
-    # model = apps.get_model(comment.content_type.app_label,
-    #                        comment.content_type.model)
-    # target = model._default_manager.get(pk=comment.object_id)
-    subject = _("new comment posted")
-    text_message_template = loader.get_template(
-        "django_comments_tree/email_followup_comment.txt")
-    if settings.COMMENTS_TREE_SEND_HTML_EMAIL:
-        html_message_template = loader.get_template(
-            "django_comments_tree/email_followup_comment.html")
-
-    for email, (name, key) in six.iteritems(followers):
-        mute_url = reverse('comments-tree-mute', args=[key.decode('utf-8')])
-        message_context = {'user_name': name,
-                           'comment': comment,
-                           # 'content_object': target,
-                           'mute_url': mute_url,
-                           'site': comment.site}
-        text_message = text_message_template.render(message_context)
-        if settings.COMMENTS_TREE_SEND_HTML_EMAIL:
-            html_message = html_message_template.render(message_context)
-        else:
-            html_message = None
-        send_mail(subject, text_message, settings.COMMENTS_TREE_FROM_EMAIL,
-                  [email, ], html=html_message)
+    notifications.notify_followers(comment)
 
 
 def reply(request, cid):
@@ -278,12 +235,10 @@ def reply(request, cid):
 
 def mute(request, key):
     try:
-        comment = signed.loads(str(key),
-                               extra_key=settings.COMMENTS_TREE_SALT)
+        comment = notifications.get_muted_comment(str(key))
     except (ValueError, signed.BadSignature):
         raise Http404
-    # the comment does exist if the URL was already confirmed, then: Http404
-    if not comment.followup or not _comment_exists(comment):
+    if comment is None:
         raise Http404
 
     # Send signal that the comment thread has been muted
@@ -542,15 +497,9 @@ def dislike(request, comment_id, next=None):
 
 def perform_like(request, comment):
     """Actually set the 'Likedit' flag on a comment from a request."""
-    flag, created = TreeCommentFlag.objects.get_or_create(comment=comment,
-                                                          user=request.user,
-                                                          flag=LIKEDIT_FLAG)
-    if created:
-        TreeCommentFlag.objects.filter(comment=comment,
-                                       user=request.user,
-                                       flag=DISLIKEDIT_FLAG).delete()
-    else:
-        flag.delete()
+    flag, created = TreeCommentFlag.objects.toggle_flag(comment, request.user,
+                                                        LIKEDIT_FLAG,
+                                                        opposite=[DISLIKEDIT_FLAG])
 
     signals.comment_feedback_toggled.send(
         sender=flag.__class__,
@@ -564,15 +513,9 @@ def perform_like(request, comment):
 
 def perform_dislike(request, comment):
     """Actually set the 'Dislikedit' flag on a comment from a request."""
-    flag, created = TreeCommentFlag.objects.get_or_create(comment=comment,
-                                                          user=request.user,
-                                                          flag=DISLIKEDIT_FLAG)
-    if created:
-        TreeCommentFlag.objects.filter(comment=comment,
-                                       user=request.user,
-                                       flag=LIKEDIT_FLAG).delete()
-    else:
-        flag.delete()
+    flag, created = TreeCommentFlag.objects.toggle_flag(comment, request.user,
+                                                        DISLIKEDIT_FLAG,
+                                                        opposite=[LIKEDIT_FLAG])
 
     signals.comment_feedback_toggled.send(
         sender=flag.__class__,
@@ -619,6 +562,8 @@ class TreeCommentListView(ListView):
         return TreeComment.objects \
             .for_content_types(content_types,
                                site=settings.SITE_ID) \
+            .for_listing() \
+            .prefetch_related('assoc__content_object') \
             .filter(is_removed=False) \
             .order_by('submit_date')
 
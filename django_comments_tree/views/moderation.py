@@ -2,13 +2,15 @@ from __future__ import absolute_import
 
 from django.contrib.auth.decorators import login_required, permission_required
 from django.contrib.sites.shortcuts import get_current_site
+from django.db import transaction
 from django.shortcuts import get_object_or_404, render
+from django.utils import timezone
 from django.views.decorators.csrf import csrf_protect
 
 from django_comments_tree import signals
 from django_comments_tree import get_model
 from django_comments_tree.views.utils import next_redirect, confirmation_view
-from django_comments_tree.models import TreeCommentFlag
+from django_comments_tree.models import CommentAssociation, TreeCommentFlag
 
 
 @csrf_protect
@@ -100,10 +102,10 @@ def perform_flag(request, comment):
     """
     Actually perform the flagging of a comment from a request.
     """
-    flag, created = TreeCommentFlag.objects.get_or_create(
-        comment=comment,
-        user=request.user,
-        flag=TreeCommentFlag.SUGGEST_REMOVAL
+    flag, created = TreeCommentFlag.objects.add_flag(
+        comment,
+        request.user,
+        TreeCommentFlag.SUGGEST_REMOVAL
     )
     signals.comment_was_flagged.send(
         sender=comment.__class__,
@@ -115,13 +117,13 @@ def perform_flag(request, comment):
 
 
 def perform_delete(request, comment):
-    flag, created = TreeCommentFlag.objects.get_or_create(
-        comment=comment,
-        user=request.user,
-        flag=TreeCommentFlag.MODERATOR_DELETION
+    flag, created = TreeCommentFlag.objects.add_flag(
+        comment,
+        request.user,
+        TreeCommentFlag.MODERATOR_DELETION
     )
     comment.is_removed = True
-    comment.save()
+    comment.save(update_fields=['is_removed'])
     signals.comment_was_flagged.send(
         sender=comment.__class__,
         comment=comment,
@@ -132,15 +134,15 @@ def perform_delete(request, comment):
 
 
 def perform_approve(request, comment):
-    flag, created = TreeCommentFlag.objects.get_or_create(
-        comment=comment,
-        user=request.user,
-        flag=TreeCommentFlag.MODERATOR_APPROVAL,
+    flag, created = TreeCommentFlag.objects.add_flag(
+        comment,
+        request.user,
+        TreeCommentFlag.MODERATOR_APPROVAL,
     )
 
     comment.is_removed = False
     comment.is_public = True
-    comment.save()
+    comment.save(update_fields=['is_removed', 'is_public'])
 
     signals.comment_was_flagged.send(
         sender=comment.__class__,
@@ -150,6 +152,51 @@ def perform_approve(request, comment):
         request=request,
     )
 
+
+# Set based variants of the functions above, for many comments at once.
+# They run in a single transaction and send comments_were_flagged once
+# instead of comment_was_flagged for each comment. They return the number
+# of comments.
+
+def perform_bulk_flag(request, queryset):
+    return _perform_bulk(request, queryset, TreeCommentFlag.SUGGEST_REMOVAL)
+
+
+def perform_bulk_delete(request, queryset):
+    return _perform_bulk(request, queryset, TreeCommentFlag.MODERATOR_DELETION,
+                         is_removed=True)
+
+
+def perform_bulk_approve(request, queryset):
+    return _perform_bulk(request, queryset, TreeCommentFlag.MODERATOR_APPROVAL,
+                         is_removed=False, is_public=True)
+
+
+def _perform_bulk(request, queryset, flag, **updates):
+    model = queryset.model
+    with transaction.atomic():
+        rows = list(queryset.order_by().values_list('pk', 'assoc'))
+        comment_ids = [pk for pk, assoc_id in rows]
+        created_ids = TreeCommentFlag.objects.add_flags(
+            comment_ids, request.user, flag)
+        if updates and comment_ids:
+            model.objects.filter(pk__in=comment_ids).update(
+                updated_on=timezone.now(), **updates)
+        signals.comments_were_flagged.send(
+            sender=model,
+            comment_ids=comment_ids,
+            flag=flag,
+            created_ids=created_ids,
+            request=request,
+        )
+        assoc_ids = {assoc_id for pk, assoc_id in rows if assoc_id is not None}
+        if updates or created_ids:
+            for assoc in CommentAssociation.objects.filter(pk__in=assoc_ids):
+                if updates:
+                    assoc.refresh_counts()
+                assoc.bump_cache_version()
+    return len(comment_ids)
+
 # Confirmation views.
 
 